@@ -5,7 +5,7 @@ from typing import List, Optional
 
 from bson import ObjectId
 from dateutil.tz import UTC
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
 from fastapi.responses import RedirectResponse
 from pydantic import PositiveInt
 from pymongo import UpdateMany
@@ -14,18 +14,18 @@ from starlette.requests import Request
 
 from gflbans.api.auth import AuthInfo, check_access
 from gflbans.api_util import construct_ci_resp
-from gflbans.internal.asn import VPN_DUBIOUS, VPN_YES, check_location, check_vpn
+from gflbans.internal.asn import VPN_DUBIOUS, VPN_YES, check_ip
 from gflbans.internal.avatar import process_avatar
-from gflbans.internal.config import MONGO_DB
+from gflbans.internal.config import IDENTITY_LINK_REFRESH, MONGO_DB
 from gflbans.internal.constants import NOT_AUTHED_USER, SERVER_KEY
 from gflbans.internal.database.common import DFile
+from gflbans.internal.database.identity import record_identity_links
 from gflbans.internal.database.infraction import DInfraction, build_query_dict
-from gflbans.internal.database.server import DCallData, DChatLog, DServer, DServerInfo, DUserIP
+from gflbans.internal.database.server import DCallData, DChatLog, DServer, DServerInfo, DUserIP, is_chat_command
 from gflbans.internal.discord_calladmin import (
-    claim_monitor_task,
+    attach_calladmin_image,
     execute_claim,
     execute_webhook,
-    prepare_calladmin_image,
 )
 from gflbans.internal.errors import NoSuchAdminError
 from gflbans.internal.flags import (
@@ -81,20 +81,43 @@ async def _process_heartbeat_multiple_players(app, ply_list: list[PlayerObjIPOpt
             user_list.append(DUserIP(**ply.dict(), gs_name='Unknown Player', gs_avatar=None))
         return user_list
 
-    for ply in ply_list:
+    async def build_player(ply: PlayerObjIPOptional) -> DUserIP:
         avatar: Optional[DFile] = None
         name: str = 'Unknown Player'
 
         try:
             info = info_list[ply.gs_id]
-            avatar = DFile(**await process_avatar(app, info['avatar_url']))
             name = info['name']
+            avatar = DFile(**await process_avatar(app, info['avatar_url']))
         except Exception as e:
             logger.error('Failed to fetch name or download avatar image.', exc_info=e)
 
-        user_list.append(DUserIP(**ply.dict(), gs_name=name, gs_avatar=avatar))
+        return DUserIP(**ply.dict(), gs_name=name, gs_avatar=avatar)
+
+    # All at once, so the avatars that need resizing reach the AvatarEngine together and share a batch
+    return list(await asyncio.gather(*[build_player(ply) for ply in ply_list]))
+
+
+# Heartbeats come every few seconds for every player, only the first one per IDENTITY_LINK_REFRESH writes the link.
+# The Redis markers are set in one round trip, if Redis is unavailable every link is written like before
+async def _record_seen_links(app, links: list[tuple[str, str, str]], seen: int):
+    links = list(set(links))
+
+    if not links:
+        return
+
+    try:
+        async with app.state.redis_client.pipeline(transaction=False) as pipe:
+            for gs_service, gs_id, ip in links:
+                pipe.set(f'gflbans::identity_seen:{gs_service}/{gs_id}/{ip}', 1, nx=True, ex=IDENTITY_LINK_REFRESH)
+
+            fresh = await pipe.execute()
+
+        links = [link for link, is_new in zip(links, fresh) if is_new]
+    except RedisError as e:
+        logger.warning('Failed to check identity link markers, recording every link.', exc_info=e)
 
-    return user_list
+    await record_identity_links(app.state.db[MONGO_DB], links, seen)
 
 
 @gs_router.post(
@@ -212,6 +235,16 @@ async def heartbeat(request: Request, beat: Heartbeat, auth: AuthInfo = Depends(
     srv.server_info = dsi
     await srv.commit(request.app.state.db[MONGO_DB])
 
+    # Remember which IPs each player was seen on for the alt search
+    try:
+        await _record_seen_links(
+            request.app,
+            [(ply.gs_service, ply.gs_id, ply.ip) for ply in dsi.players if ply.ip is not None],
+            int(datetime.now(tz=UTC).timestamp()),
+        )
+    except Exception as e:
+        logger.error('Failed to record identity links.', exc_info=e)
+
     # Log chat messages if provided
     if beat.messages:
         try:
@@ -240,6 +273,7 @@ async def heartbeat(request: Request, beat: Heartbeat, auth: AuthInfo = Depends(
                     server=ObjectId(auth.authenticator_id),
                     user=user_map.get(message.user.gs_id),
                     content=message.content,
+                    is_command=is_chat_command(message.content),
                 ).commit(request.app.state.db[MONGO_DB])
         except Exception as e:
             logger.error('Failed to log chat messages.', exc_info=e)
@@ -255,14 +289,13 @@ async def vpn_check(request: Request, q: CheckVPN = Depends(CheckVPN), auth: Aut
         raise HTTPException(detail='This route requires authentication', status_code=401)
     cvpn_r = CheckVPNReply(is_vpn=False, is_dubious=False, is_immune=False)
 
-    vpn_result = await check_vpn(request.app, q.player.ip)
+    vpn_result, location = await check_ip(request.app, q.player.ip)
 
     if vpn_result == VPN_YES:
         cvpn_r.is_vpn = True
     elif vpn_result == VPN_DUBIOUS:
         cvpn_r.is_dubious = True
 
-    location = await check_location(request.app, q.player.ip)
     if location:
         cvpn_r.countryName = location
 
@@ -286,7 +319,9 @@ async def vpn_check(request: Request, q: CheckVPN = Depends(CheckVPN), auth: Aut
     response_model_exclude_none=True,
     response_model_exclude_unset=True,
 )
-async def call_admin(request: Request, exe: ExecuteCallAdmin, auth: AuthInfo = Depends(check_access)):
+async def call_admin(
+    request: Request, exe: ExecuteCallAdmin, tasks: BackgroundTasks, auth: AuthInfo = Depends(check_access)
+):
     if auth.type != SERVER_KEY:
         raise HTTPException(detail='Only servers can use this route', status_code=403)
 
@@ -322,17 +357,19 @@ async def call_admin(request: Request, exe: ExecuteCallAdmin, auth: AuthInfo = D
             cooldown=((srv.last_calladmin + exe.cooldown) - datetime.now(tz=UTC).timestamp()),
         )
 
-    call_admin_image = await prepare_calladmin_image(exe.image) if exe.image else None
+    # The image is attached once the call is out, the raw payload isn't kept on the server document
+    image, exe.image = exe.image, None
 
-    ct = await execute_webhook(request.app, srv, exe, image=call_admin_image)
+    ct = await execute_webhook(request.app, srv, exe)
 
     srv.last_calladmin = datetime.now(tz=UTC).timestamp()
     srv.call_data = DCallData(claim_token=ct, call_info=exe)
 
-    asyncio.get_running_loop().create_task(claim_monitor_task(request.app, srv.id, ct))
-
     await srv.commit(request.app.state.db[MONGO_DB])
 
+    if image:
+        tasks.add_task(attach_calladmin_image, request.app, srv.id, ct, image)
+
     return ExecuteCallAdminReply(sent=True, is_banned=False, cooldown=exe.cooldown)
 
 
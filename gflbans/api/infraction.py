@@ -1,6 +1,6 @@
 import asyncio
 from datetime import datetime, timedelta
-from typing import List, Optional, Set, Union
+from typing import List, Optional, Tuple, Union
 
 import bson
 from bson import ObjectId
@@ -9,12 +9,15 @@ from fastapi import APIRouter, Depends, Header, HTTPException
 from fastapi.responses import ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from pymongo import DESCENDING
+from pymongo.errors import BulkWriteError
 from starlette.background import BackgroundTasks
 from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from gflbans.api.auth import AuthInfo, check_access, csrf_protect
 from gflbans.api_util import (
     as_infraction,
+    as_infractions,
     construct_ci_resp,
     exclude_private_comments,
     obj_id,
@@ -22,8 +25,14 @@ from gflbans.api_util import (
     str_id,
     user_str,
 )
-from gflbans.internal.config import AUTO_STACK_MAX_AGE, AUTO_STACK_MULTIPLIER, AUTO_STACK_START_TIME, MONGO_DB
-from gflbans.internal.constants import AUTHED_USER, NOT_AUTHED_USER, SERVER_KEY
+from gflbans.internal.config import (
+    AUTO_STACK_MAX_AGE,
+    AUTO_STACK_MULTIPLIER,
+    AUTO_STACK_START_TIME,
+    EXPORT_BATCH_SIZE,
+    MONGO_DB,
+)
+from gflbans.internal.constants import API_KEY, AUTHED_USER, NOT_AUTHED_USER, SERVER_KEY
 from gflbans.internal.database.audit_log import (
     EVENT_COMMENT_DELETE,
     EVENT_COMMENT_EDIT,
@@ -31,15 +40,23 @@ from gflbans.internal.database.audit_log import (
     EVENT_FILE_DELETE,
     EVENT_FILE_UPLOAD,
     EVENT_INFRACTION_EDIT,
+    EVENT_INFRACTION_IMPORT,
     EVENT_INFRACTION_NEW,
     EVENT_INFRACTION_PURGE,
     EVENT_INFRACTION_REMOVE,
     DAuditLog,
 )
 from gflbans.internal.database.common import DFile
-from gflbans.internal.database.infraction import DComment, DInfraction, build_query_dict
+from gflbans.internal.database.identity import linked_identities, record_identity_links, record_identity_links_at
+from gflbans.internal.database.infraction import (
+    INFRACTION_SUMMARY_PROJECTION,
+    DComment,
+    DInfraction,
+    build_query_dict,
+)
 from gflbans.internal.database.server import DChatLog
-from gflbans.internal.errors import SearchError
+from gflbans.internal.errors import NoSuchAdminError, SearchError
+from gflbans.internal.export import NDJSON_MEDIA_TYPE, encode_cursor, export_sort, ndjson_lines, resume_after
 from gflbans.internal.flags import (
     INFRACTION_ADMIN_CHAT_BLOCK,
     INFRACTION_BAN,
@@ -67,17 +84,20 @@ from gflbans.internal.flags import (
     PERMISSION_WEB_MODERATOR,
     str2pflag,
 )
+from gflbans.internal.fs import delete_gridfs_file
 from gflbans.internal.infraction_utils import (
     check_immunity,
     create_dinfraction,
-    discord_notify_create_infraction,
     discord_notify_purge_infraction,
     filter_badchars,
     get_permissions,
     get_user_data,
     get_vpn_data,
     modify_infraction,
-    push_state_to_nodes,
+    queue_import_enrichment,
+    queue_infraction_enrichment,
+    queue_notify_create_infraction,
+    queue_push_state,
 )
 from gflbans.internal.integrations.games import normalize_id
 from gflbans.internal.log import logger
@@ -93,6 +113,9 @@ from gflbans.internal.models.protocol import (
     EditComment,
     GetInfractions,
     GetInfractionsReply,
+    ImportInfractionError,
+    ImportInfractions,
+    ImportInfractionsReply,
     InfractionStatisticsReply,
     ModifyInfraction,
     RecursiveSearch,
@@ -100,8 +123,8 @@ from gflbans.internal.models.protocol import (
     RemoveInfractionsOfPlayerReply,
     Search,
 )
-from gflbans.internal.pyapi_utils import load_admin
-from gflbans.internal.search import contains_str, do_infraction_search
+from gflbans.internal.pyapi_utils import load_admin, load_admin_from_initiator
+from gflbans.internal.search import contains_str, do_infraction_search, id64_or_none_no_web
 from gflbans.internal.utils import slugify
 
 infraction_router = APIRouter(default_response_class=ORJSONResponse)
@@ -117,7 +140,6 @@ infraction_router = APIRouter(default_response_class=ORJSONResponse)
 async def create_infraction_from_chatlog(
     request: Request,
     query: CreateInfractionFromChatLog,
-    tasks: BackgroundTasks,
     auth: AuthInfo = Depends(check_access),
 ):
     if auth.type == NOT_AUTHED_USER:
@@ -183,7 +205,6 @@ async def create_infraction_from_chatlog(
     created_inf = await create_infraction(
         request,
         CreateInfraction(**ci_payload),
-        tasks,
         auth,
     )
 
@@ -227,15 +248,19 @@ async def get_infractions(
     )
 
     exclude_priv_comments = exclude_private_comments(auth.type, auth.permissions)
-    infs = []
+    dinfs = []
 
     async for dinf in DInfraction.from_query(
-        request.app.state.db[MONGO_DB], q, limit=query.limit, skip=query.skip, sort=('created', DESCENDING)
+        request.app.state.db[MONGO_DB],
+        q,
+        limit=query.limit,
+        skip=query.skip,
+        sort=('created', DESCENDING),
+        projection=INFRACTION_SUMMARY_PROJECTION if load_fast else None,
     ):
-        if load_fast:
-            dinf.comments = []
-            dinf.files = []
-        infs.append(await as_infraction(request.app, dinf, incl_ip, exclude_priv_comments))
+        dinfs.append(dinf)
+
+    infs = await as_infractions(request.app, dinfs, incl_ip, exclude_priv_comments)
 
     return GetInfractionsReply(results=infs, total_matched=await DInfraction.count(request.app.state.db[MONGO_DB], q))
 
@@ -282,102 +307,105 @@ async def search_infractions(
     except SearchError as e:
         raise HTTPException(detail=f'SearchError: {e.args[0]}', status_code=400)
 
-    infs = []
+    dinfs = []
 
     async for dinf in DInfraction.from_query(
-        request.app.state.db[MONGO_DB], cq, limit=query.limit, skip=query.skip, sort=('created', DESCENDING)
+        request.app.state.db[MONGO_DB],
+        cq,
+        limit=query.limit,
+        skip=query.skip,
+        sort=('created', DESCENDING),
+        projection=INFRACTION_SUMMARY_PROJECTION if load_fast else None,
     ):
-        if load_fast:
-            dinf.comments = []
-            dinf.files = []
-
         # If time left is > 100 years, just say it is perma
         if dinf.expires is not None and dinf.expires > MAX_UNIX_TIMESTAMP:
             dinf.expires = None
 
-        infs.append(
-            await as_infraction(request.app, dinf, incl_ip, exclude_private_comments(auth.type, auth.permissions))
-        )
+        dinfs.append(dinf)
+
+    infs = await as_infractions(request.app, dinfs, incl_ip, exclude_private_comments(auth.type, auth.permissions))
 
     return GetInfractionsReply(results=infs, total_matched=await DInfraction.count(request.app.state.db[MONGO_DB], cq))
 
 
-async def recursive_infraction_search(
-    app,
-    ips: List[str],
-    steam_ids: List[str],
-    depth: int,
-    visited_ids: Set[str],
-    found_infractions: Set[str],
-    limit: int,
-    skip: int,
-    load_fast: bool,
-) -> List[DInfraction]:
-    if depth <= 0 or (not ips and not steam_ids):
-        return []
+# Infractions on any player or IP linked to the given ones within depth hops, newest first
+async def recursive_infraction_search(app, ips: List[str], steam_ids: List[str], depth: int) -> Tuple[dict, int]:
+    found_ids, found_ips = await linked_identities(app.state.db[MONGO_DB], steam_ids, ips, depth)
 
-    # Remove already visited IPs and Steam IDs to prevent redundant searches
-    ips = [ip for ip in ips if ip not in visited_ids]
-    steam_ids = [sid for sid in steam_ids if sid not in visited_ids]
+    conds = []
 
-    if not ips and not steam_ids:
-        return []
+    if found_ips:
+        conds.append({'ip': {'$in': list(found_ips)}})
 
-    visited_ids.update(ips)
-    visited_ids.update(steam_ids)
+    if found_ids:
+        conds.append({'user.gs_id': {'$in': list(found_ids)}})
 
-    search_queries = []
+    search_query = {'$or': conds}
 
-    for ip in ips:
-        search_queries.append(
-            do_infraction_search(app, RecursiveSearch(ip=ip, gs_id=None, limit=limit, skip=skip), include_ip=True)
-        )
+    return search_query, await DInfraction.count(app.state.db[MONGO_DB], search_query)
 
-    for steam_id in steam_ids:
-        search_queries.append(
-            do_infraction_search(app, RecursiveSearch(ip=None, gs_id=steam_id, limit=limit, skip=skip), include_ip=True)
-        )
 
-    # Generate all MongoDB search queries concurrently
-    query_results = await asyncio.gather(*search_queries)
+# Streams every infraction matching a search as NDJSON, newest first. Each line carries a cursor that can be passed
+# back to resume after it
+@infraction_router.get('/search/export')
+async def export_infractions(
+    request: Request,
+    query: Search = Depends(Search),
+    cursor: Optional[str] = None,
+    auth: AuthInfo = Depends(check_access),
+):
+    if auth.type == NOT_AUTHED_USER:
+        raise HTTPException(detail='This route requires authentication', status_code=401)
 
-    # Flatten the results into a single MongoDB `$or` query
-    search_query = {'$or': query_results} if len(query_results) > 1 else query_results[0]
+    incl_ip = should_include_ip(auth.type, auth.permissions)
+    exclude_priv_comments = exclude_private_comments(auth.type, auth.permissions)
 
-    infractions = []
-    new_ips = set()
-    new_steam_ids = set()
+    try:
+        cq = await do_infraction_search(request.app, query, include_ip=incl_ip)
+    except SearchError as e:
+        raise HTTPException(detail=f'SearchError: {e.args[0]}', status_code=400)
 
-    async for dinf in DInfraction.from_query(app.state.db[MONGO_DB], search_query, sort=('created', DESCENDING)):
-        if str(dinf.id) in found_infractions:
-            continue  # Skip already found infractions
+    if cursor is not None:
+        try:
+            cq = resume_after(cq, cursor, DESCENDING)
+        except ValueError:
+            raise HTTPException(detail='Invalid cursor', status_code=400)
 
-        if load_fast:
-            dinf.comments = []
-            dinf.files = []
+    db_cursor = (
+        request.app.state.db[MONGO_DB].infractions.find(cq).sort(export_sort(DESCENDING)).batch_size(EXPORT_BATCH_SIZE)
+    )
 
-        found_infractions.add(str(dinf.id))
+    async def serialize(dinfs: List[DInfraction]):
+        infs = await as_infractions(request.app, dinfs, incl_ip, exclude_priv_comments)
 
-        # Normalize excessive expiration times
-        if dinf.expires is not None and dinf.expires > MAX_UNIX_TIMESTAMP:
-            dinf.expires = None
+        for dinf, inf in zip(dinfs, infs):
+            row = inf.dict(exclude_none=True)
+            row['cursor'] = encode_cursor(dinf.created, dinf.id)
+            yield row
 
-        infractions.append(dinf)
+    # Serialized a batch at a time so admin lookups are shared without holding the whole result
+    async def rows():
+        dinfs = []
 
-        # Collect new identifiers for the next recursion batch
-        if dinf.user and dinf.user.gs_id and dinf.user.gs_id not in visited_ids:
-            new_steam_ids.add(dinf.user.gs_id)
+        async for doc in db_cursor:
+            dinf = DInfraction.load_document(doc)
 
-        if dinf.ip and dinf.ip not in visited_ids:
-            new_ips.add(dinf.ip)
+            # If time left is > 100 years, just say it is perma
+            if dinf.expires is not None and dinf.expires > MAX_UNIX_TIMESTAMP:
+                dinf.expires = None
 
-    # Recursively search with all newly found identifiers in a **single batch**
-    new_results = await recursive_infraction_search(
-        app, list(new_ips), list(new_steam_ids), depth - 1, visited_ids, found_infractions, limit, skip, load_fast
-    )
+            dinfs.append(dinf)
 
-    infractions.extend(new_results)
-    return infractions
+            if len(dinfs) >= EXPORT_BATCH_SIZE:
+                async for row in serialize(dinfs):
+                    yield row
+
+                dinfs = []
+
+        async for row in serialize(dinfs):
+            yield row
+
+    return StreamingResponse(ndjson_lines(rows()), media_type=NDJSON_MEDIA_TYPE)
 
 
 @infraction_router.get(
@@ -399,37 +427,39 @@ async def search_recursive_infractions(
     if not ip and not query.gs_id:
         raise HTTPException(status_code=400, detail="At least one of 'ip' or 'gs_id' must be provided.")
 
-    visited_ids = set()
-    found_infractions = set()
+    try:
+        gs_id = id64_or_none_no_web(query.gs_id) if query.gs_id else None
+    except SearchError as e:
+        raise HTTPException(detail=f'SearchError: {e.args[0]}', status_code=400)
 
-    infractions = await recursive_infraction_search(
-        request.app,
-        [ip] if ip else [],
-        [query.gs_id] if query.gs_id else [],
-        query.depth,
-        visited_ids,
-        found_infractions,
-        query.limit,
-        query.skip,
-        load_fast,
+    search_query, total = await recursive_infraction_search(
+        request.app, [ip] if ip else [], [gs_id] if gs_id else [], query.depth
     )
 
     if query.limit == 0:
-        return GetInfractionsReply(results=[], total_matched=len(infractions))
+        return GetInfractionsReply(results=[], total_matched=total)
 
-    # Sort by `created` timestamp (descending order: newest first)
-    sorted_infractions = sorted(infractions, key=lambda inf: inf.created, reverse=True)
+    infractions = []
+
+    async for dinf in DInfraction.from_query(
+        request.app.state.db[MONGO_DB],
+        search_query,
+        limit=query.limit,
+        skip=query.skip,
+        sort=('created', DESCENDING),
+        projection=INFRACTION_SUMMARY_PROJECTION if load_fast else None,
+    ):
+        # Normalize excessive expiration times
+        if dinf.expires is not None and dinf.expires > MAX_UNIX_TIMESTAMP:
+            dinf.expires = None
 
-    # Apply skip and limit
-    paginated_infractions = sorted_infractions[query.skip : query.skip + query.limit]
+        infractions.append(dinf)
 
     exclude_priv_comments = exclude_private_comments(auth.type, auth.permissions)
 
     return GetInfractionsReply(
-        results=[
-            await as_infraction(request.app, inf, incl_ip, exclude_priv_comments) for inf in paginated_infractions
-        ],
-        total_matched=len(infractions),  # Total before pagination
+        results=await as_infractions(request.app, infractions, incl_ip, exclude_priv_comments),
+        total_matched=total,
     )
 
 
@@ -473,7 +503,9 @@ async def check_infractions(
 
 async def find_longest_infraction_duration(app, query) -> Optional[int]:
     longest = None
-    async for dinf in DInfraction.from_query(app.state.db[MONGO_DB], query, sort=('created', DESCENDING)):
+    async for dinf in DInfraction.from_query(
+        app.state.db[MONGO_DB], query, sort=('created', DESCENDING), projection=INFRACTION_SUMMARY_PROJECTION
+    ):
         if (
             longest == 0
             or dinf.flags & INFRACTION_PERMANENT == INFRACTION_PERMANENT
@@ -613,7 +645,6 @@ async def infraction_stats(
 async def create_infraction(
     request: Request,
     query: CreateInfraction,
-    tasks: BackgroundTasks,
     auth: AuthInfo = Depends(check_access),
 ):
     if auth.type == NOT_AUTHED_USER:
@@ -722,6 +753,11 @@ async def create_infraction(
     # Write the dinfraction
     await dinf.commit(request.app.state.db[MONGO_DB])
 
+    if dinf.user is not None and dinf.ip is not None:
+        await record_identity_links(
+            request.app.state.db[MONGO_DB], [(dinf.user.gs_service, dinf.user.gs_id, dinf.ip)], int(dinf.created)
+        )
+
     if aa is not None:
         logger.info(
             f'{aa.name} ({aa.ips_id}) created an infraction {dinf.id} with flags {dinf.flags}'
@@ -744,27 +780,22 @@ async def create_infraction(
     ).commit(request.app.state.db[MONGO_DB])
 
     # Notify all servers that new state is available (uwu)
-    tasks.add_task(push_state_to_nodes, request.app, dinf)
+    await queue_push_state(request.app, dinf)
 
     # For the front end, we want to make sure we have all the information before returning
     if query.do_full_infraction:
         if dinf.user is not None:
             await get_user_data(request.app, dinf.id, True, auth.type == SERVER_KEY)
         else:
-            await discord_notify_create_infraction(request.app, dinf, auth.type == SERVER_KEY)
+            await queue_notify_create_infraction(request.app, dinf.id, auth.type == SERVER_KEY)
         if dinf.ip is not None:
             await get_vpn_data(request.app, dinf.id, True)
 
         # Refetch this!
         dinf = await DInfraction.from_id(request.app.state.db[MONGO_DB], dinf.id)
     else:
-        # Schedule a background task to add in missing details (like VPN check + profile / name)
-        if dinf.user is not None:
-            tasks.add_task(get_user_data, request.app, dinf.id, True, auth.type == SERVER_KEY)
-        else:
-            tasks.add_task(discord_notify_create_infraction, request.app, dinf, auth.type == SERVER_KEY)
-        if dinf.ip is not None:
-            tasks.add_task(get_vpn_data, request.app, dinf.id, True)
+        # Queue tasks to add in missing details (like VPN check + profile / name)
+        await queue_infraction_enrichment(request.app, dinf, auth.type == SERVER_KEY)
 
     return await as_infraction(
         request.app,
@@ -784,6 +815,155 @@ def _i2p(dinf: DInfraction):
     return puns
 
 
+# Many existing infractions at once, for migrating from other systems. Unlike create_infraction there is one audit log
+# entry for the whole batch, no game server pushes or Discord notifications, and no immunity checks. Names, avatars and
+# VPN checks are queued once per player and IP
+@infraction_router.post(
+    '/import',
+    response_model=ImportInfractionsReply,
+    response_model_exclude_unset=True,
+    response_model_exclude_none=True,
+)
+async def import_infractions(request: Request, query: ImportInfractions, auth: AuthInfo = Depends(check_access)):
+    if auth.type != API_KEY:
+        raise HTTPException(detail='Only API keys can import infractions', status_code=403)
+
+    server = None
+
+    if query.server is not None:
+        if auth.permissions & PERMISSION_ASSIGN_TO_SERVER != PERMISSION_ASSIGN_TO_SERVER:
+            raise HTTPException(detail='Insufficient permissions to override the server', status_code=403)
+
+        try:
+            server = ObjectId(query.server)
+        except bson.errors.InvalidId:
+            raise HTTPException(detail='Invalid server id', status_code=400)
+
+    db = request.app.state.db[MONGO_DB]
+
+    admins = {}
+    dinfs = []
+    ids = [None] * len(query.infractions)
+    existing = []
+    errors = []
+
+    # Infractions imported by an earlier, possibly interrupted, run are skipped and reported with their current id
+    refs = [item.import_ref for item in query.infractions if item.import_ref is not None]
+    imported_refs = {}
+    seen_refs = set()
+
+    if refs:
+        async for doc in db[DInfraction.__collection__].find({'import_ref': {'$in': refs}}, {'import_ref': 1}):
+            imported_refs[doc['import_ref']] = doc['_id']
+
+    for index, item in enumerate(query.infractions):
+        if item.import_ref is not None:
+            if item.import_ref in imported_refs:
+                ids[index] = str(imported_refs[item.import_ref])
+                existing.append(index)
+                continue
+
+            if item.import_ref in seen_refs:
+                errors.append(ImportInfractionError(index=index, detail='Duplicate import_ref in this request'))
+                continue
+
+            seen_refs.add(item.import_ref)
+
+        admin = None
+
+        if item.admin is not None:
+            key = item.admin.json()
+
+            # Failures are kept as the error to report, so an unreachable forum or Steam is only asked once per batch
+            if key not in admins:
+                try:
+                    admins[key] = await load_admin_from_initiator(request.app, item.admin)
+                except NoSuchAdminError:
+                    admins[key] = 'Could not find the admin'
+                except Exception as e:
+                    logger.warning('Failed to load the admin of an imported infraction.', exc_info=e)
+                    admins[key] = f'Failed to load the admin: {e}'
+
+            if isinstance(admins[key], str):
+                errors.append(ImportInfractionError(index=index, detail=admins[key]))
+                continue
+
+            admin = admins[key].mongo_admin_id
+
+        try:
+            # Same cap as create_infraction
+            duration = item.duration if item.duration and item.duration <= 60 * 60 * 24 * 365 * 10 else None
+
+            dinf = create_dinfraction(
+                player=item.player,
+                reason=item.reason,
+                scope=item.scope,
+                punishments=item.punishments,
+                session=item.session,
+                created=item.created,
+                duration=duration,
+                admin=admin,
+                playtime_based=item.playtime_based,
+                server=server,
+            )
+            dinf.import_ref = item.import_ref
+        except ValueError as e:
+            errors.append(ImportInfractionError(index=index, detail=str(e)))
+            continue
+
+        rp = get_permissions(dinf)
+
+        if auth.permissions & rp != rp:
+            errors.append(ImportInfractionError(index=index, detail='Insufficient privileges'))
+            continue
+
+        dinfs.append((index, dinf))
+
+    # The ids are chosen here so the ones that did get written are known even if the insert fails partway
+    for _, dinf in dinfs:
+        dinf.id = ObjectId()
+
+    try:
+        await DInfraction.insert_many(db, [dinf for _, dinf in dinfs])
+    except BulkWriteError as e:
+        # Only an import_ref written by a concurrent import is expected here
+        if any(err['code'] != 11000 for err in e.details['writeErrors']):
+            raise
+
+        failed = {err['index'] for err in e.details['writeErrors']}
+
+        for n in failed:
+            errors.append(ImportInfractionError(index=dinfs[n][0], detail='Already imported'))
+
+        dinfs = [d for n, d in enumerate(dinfs) if n not in failed]
+
+    for index, dinf in dinfs:
+        ids[index] = str(dinf.id)
+
+    imported = [dinf for _, dinf in dinfs]
+
+    await record_identity_links_at(
+        db,
+        [(d.user.gs_service, d.user.gs_id, d.ip, int(d.created)) for d in imported if d.user is not None and d.ip],
+    )
+
+    if imported:
+        logger.info(f'{auth.type}/{auth.authenticator_id} imported {len(imported)} infractions')
+
+        await DAuditLog(
+            time=datetime.now(tz=UTC).timestamp(),
+            event_type=EVENT_INFRACTION_IMPORT,
+            authentication_type=auth.type,
+            authenticator=auth.authenticator_id,
+            admin=auth.admin.mongo_admin_id,
+            new_item={'count': len(imported), 'infractions': [dinf.id for dinf in imported]},
+        ).commit(db)
+
+        await queue_import_enrichment(request.app, imported)
+
+    return ImportInfractionsReply(ids=ids, existing=existing, errors=errors)
+
+
 @infraction_router.post(
     '/remove',
     response_model=RemoveInfractionsOfPlayerReply,
@@ -853,7 +1033,12 @@ async def remove_infraction(
                     punishments.remove(t)
 
                 await modify_infraction(
-                    request.app, dinf.id, reuse_dinf=dinf, punishments=punishments, actor=auth.admin.mongo_admin_id
+                    request.app,
+                    dinf.id,
+                    reuse_dinf=dinf,
+                    punishments=punishments,
+                    actor=auth.admin.mongo_admin_id,
+                    tasks=tasks,
                 )
             else:
                 await modify_infraction(
@@ -864,10 +1049,8 @@ async def remove_infraction(
                     removed_by=auth.admin.mongo_admin_id,
                     reuse_dinf=dinf,
                     actor=auth.admin.mongo_admin_id,
+                    tasks=tasks,
                 )
-
-            # Notify all servers that new state is available (uwu)
-            tasks.add_task(push_state_to_nodes, request.app, dinf)
         except ValueError:
             logger.error(f'Generated modify of {dinf.id} was invalid', exc_info=True)
             n_removed -= 1
@@ -912,7 +1095,6 @@ async def purge_infraction(
     request: Request,
     infraction_id: str,
     auth: AuthInfo = Depends(check_access),
-    tasks: BackgroundTasks = None,
 ):
     if auth.type == NOT_AUTHED_USER:
         raise HTTPException(detail='This route requires authorization', status_code=401)
@@ -939,23 +1121,15 @@ async def purge_infraction(
     # Delete any GridFS files linked to the infraction
     try:
         if dinf.files:
-            gfs = AsyncIOMotorGridFSBucket(database=request.app.state.db[MONGO_DB])
             for df in dinf.files:
                 try:
-                    await gfs.delete(ObjectId(df.gridfs_file))
+                    await delete_gridfs_file(request.app, ObjectId(df.gridfs_file))
                 except Exception:
                     # Continue even if a file is already missing
                     pass
     except Exception:
         pass
 
-    # Notify servers first so they can evict cached state
-    if tasks is not None:
-        try:
-            tasks.add_task(push_state_to_nodes, request.app, dinf)
-        except Exception:
-            pass
-
     # Audit log
     await DAuditLog(
         time=datetime.now(tz=UTC).timestamp(),
@@ -973,6 +1147,9 @@ async def purge_infraction(
 
     await request.app.state.db[MONGO_DB].infractions.delete_one({'_id': dinf.id})
 
+    # Notify servers so they can evict cached state, only once the infraction is gone or they'd be sent it again
+    await queue_push_state(request.app, dinf)
+
     return ORJSONResponse({'status': 'ok'}, status_code=200)
 
 
@@ -1088,6 +1265,7 @@ async def edit_infraction(
             vpn=query.vpn,
             reuse_dinf=dinf,
             actor=auth.admin.mongo_admin_id,
+            tasks=tasks,
         )
     except ValueError as e:
         raise HTTPException(status_code=401, detail=str(e)) from e
@@ -1107,9 +1285,6 @@ async def edit_infraction(
         old_item=original_dinf_info,
     ).commit(request.app.state.db[MONGO_DB])
 
-    # Notify all servers that new state is available (uwu)
-    tasks.add_task(push_state_to_nodes, request.app, dinf)
-
     return await as_infraction(
         request.app,
         dinf,
@@ -1403,9 +1578,7 @@ async def delete_attachment(
         raise HTTPException(detail='You do not have permission to do that!', status_code=403)
 
     # Delete backend file object
-    await AsyncIOMotorGridFSBucket(database=request.app.state.db[MONGO_DB]).delete(
-        ObjectId(dinf.files[query.file_idx].gridfs_file)
-    )
+    await delete_gridfs_file(request.app, ObjectId(dinf.files[query.file_idx].gridfs_file))
 
     # Unlink from dinf
     dfiles = dinf.files
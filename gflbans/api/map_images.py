@@ -1,54 +1,56 @@
 import asyncio
 
-from aiohttp import ClientResponseError
+from bson import ObjectId
 from fastapi import APIRouter, Depends, File, Header, HTTPException, UploadFile
 from fastapi.responses import ORJSONResponse
 from gridfs import NoFile
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from starlette.background import BackgroundTasks
 from starlette.requests import Request
-from starlette.responses import RedirectResponse, StreamingResponse
+from starlette.responses import RedirectResponse, Response
 
 from gflbans.api.auth import AuthInfo, check_access
-from gflbans.internal.config import MONGO_DB
+from gflbans.internal.config import MAP_IMAGE_MIRROR, MONGO_DB
 from gflbans.internal.flags import PERMISSION_MANAGE_MAP_ICONS
-from gflbans.internal.log import logger
-from gflbans.internal.map_images import conv_map_image, find_map_image
+from gflbans.internal.fs import gridfs_etag, gridfs_last_modified, is_not_modified, serve_gridfs, validator_headers
+from gflbans.internal.map_images import (
+    conv_map_image,
+    delete_mirrored_map_images,
+    forget_map_image,
+    mirror_map_image,
+    resolve_map_image,
+)
 
 map_image_router = APIRouter()
 
 
 @map_image_router.get('/{mod_name}/{map_name}')
-async def get_map_image(request: Request, mod_name: str, map_name: str):
-    mf = await find_map_image(request.app.state.db[MONGO_DB], mod_name, map_name)
-
-    if mf is None:
-        gt_url = f'https://image.gametracker.com/images/maps/160x120/{mod_name}/{map_name}.jpg'
-        try:
-            async with request.app.state.aio_session.head(gt_url) as resp:
-                if resp.status < 400:
-                    return RedirectResponse(status_code=307, url=gt_url)
-                else:
-                    return RedirectResponse(status_code=307, url='/static/images/map_icon.png')
-        except ClientResponseError:
-            logger.debug('Failed to check if GameTracker has the map image we wanted', exc_info=True)
-            return RedirectResponse(status_code=307, url='/static/images/map_icon.png')
+async def get_map_image(request: Request, mod_name: str, map_name: str, tasks: BackgroundTasks):
+    resolved = await resolve_map_image(request.app, mod_name, map_name)
+
+    if 'url' in resolved:
+        if resolved.get('external') and MAP_IMAGE_MIRROR:
+            tasks.add_task(mirror_map_image, request.app, mod_name, map_name, resolved['url'])
+
+        return RedirectResponse(status_code=307, url=resolved['url'])
 
     client = AsyncIOMotorGridFSBucket(database=request.app.state.db[MONGO_DB])
 
     try:
-        fos = await client.open_download_stream(mf)
+        fos = await client.open_download_stream(ObjectId(resolved['file_id']))
     except NoFile:
+        # Removed since it was cached
+        await forget_map_image(request.app, mod_name, map_name)
         raise HTTPException(detail='No such file', status_code=404)
 
-    async def gridfs_read():
-        while fos.tell() < fos.length:
-            yield await fos.readchunk()
+    etag = gridfs_etag(fos)
+    last_modified = gridfs_last_modified(fos)
+    headers = {**validator_headers(etag, last_modified), 'Cache-Control': 'public, max-age=604800, immutable'}
 
-    return StreamingResponse(
-        gridfs_read(),
-        media_type='image/webp',
-        headers={'Content-Length': str(fos.length), 'Cache-Control': 'public, max-age=604800,' ' immutable'},
-    )
+    if is_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    return await serve_gridfs(request, fos, 'image/webp', headers)
 
 
 async def max_map_img_size(content_length: int = Header(..., lt=(5 * 1024 * 1024))):
@@ -83,4 +85,7 @@ async def write_map_image(
         metadata={'map_image': True, 'mod_name': mod_name, 'map_name': map_name, 'content-type': 'image/webp'},
     )
 
+    await delete_mirrored_map_images(request.app.state.db[MONGO_DB], mod_name, map_name)
+    await forget_map_image(request.app, mod_name, map_name)
+
     return ORJSONResponse({'file_id': str(file_id)}, status_code=201)
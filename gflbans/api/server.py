@@ -1,15 +1,17 @@
+import re
 from datetime import datetime
-from typing import List
+from typing import List, Optional
 
-import bbcode
 from bson import ObjectId
 from dateutil.tz import UTC
 from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import ORJSONResponse
 from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
 from gflbans.api.auth import AuthInfo, check_access, csrf_protect
-from gflbans.internal.config import MONGO_DB
+from gflbans.deprecation import chat_command_backfill_done
+from gflbans.internal.config import EXPORT_BATCH_SIZE, MONGO_DB
 from gflbans.internal.constants import NOT_AUTHED_USER
 from gflbans.internal.database.audit_log import (
     EVENT_SERVER_EDIT,
@@ -17,7 +19,8 @@ from gflbans.internal.database.audit_log import (
     EVENT_SERVER_REGENERATE_TOKEN,
     DAuditLog,
 )
-from gflbans.internal.database.server import DServer, DUserIP
+from gflbans.internal.database.server import CHAT_COMMAND_PREFIXES, DServer, DUserIP
+from gflbans.internal.export import NDJSON_MEDIA_TYPE, encode_cursor, export_sort, ndjson_lines, resume_after
 from gflbans.internal.flags import PERMISSION_MANAGE_SERVERS, PERMISSION_VIEW_CHAT_LOGS, PERMISSION_VIEW_IP_ADDR
 from gflbans.internal.log import logger
 from gflbans.internal.models.api import FileInfo, MessageLog, PlayerObj, Server, ServerInternal
@@ -28,11 +31,17 @@ from gflbans.internal.models.protocol import (
     RegenerateServerTokenReply,
     RequestChatLogs,
 )
+from gflbans.internal.rendering import render_chat_message
 from gflbans.internal.search import contains_str, id64_or_none
 from gflbans.internal.utils import generate_api_key
 
 server_router = APIRouter(default_response_class=ORJSONResponse)
 
+_WORD = re.compile(r'\w')
+
+# Same test as is_chat_command, for logs stored before is_command existed
+_COMMAND_PREFIX = re.compile('^[%s]' % re.escape(''.join(CHAT_COMMAND_PREFIXES)))
+
 
 def dserver_to_server(dsrv: DServer, indicate_webhooks: bool) -> Server:
     mf = Server(
@@ -366,19 +375,8 @@ async def regenerate_server_token(request: Request, server_id: str, auth: AuthIn
     return RegenerateServerTokenReply(server_secret_key=key)
 
 
-@server_router.get(
-    '/{server_id}/logs',
-    response_model_exclude_none=True,
-    response_model_exclude_unset=True,
-    response_model=List[MessageLog],
-    dependencies=[Depends(csrf_protect)],
-)
-async def get_chat_logs(
-    request: Request,
-    server_id: str,
-    auth: AuthInfo = Depends(check_access),
-    query: RequestChatLogs = Depends(RequestChatLogs),
-):
+# Checks access and builds the query shared by the chat log list and export routes
+async def _chat_log_query(request: Request, server_id: str, auth: AuthInfo, query: RequestChatLogs):
     if auth.type == NOT_AUTHED_USER:
         raise HTTPException(detail='This route requires authentication', status_code=401)
 
@@ -444,15 +442,32 @@ async def get_chat_logs(
     # Build content filter
     content_filter = None
     if getattr(query, 'content', None):
-        content_filter = {'content': contains_str(query.content)}
+        if query.whole_word and _WORD.search(query.content):
+            # Phrase search on the text index. Case insensitive like contains_str, but only matches whole words
+            content_filter = {'$text': {'$search': '"%s"' % query.content.replace('"', '\\"')}}
+        else:
+            # Substring match, checked while walking the (server, created) index
+            content_filter = {'content': contains_str(query.content)}
 
     # Build command mode filter
     command_filter = None
     if getattr(query, 'command_mode', None) and query.command_mode != 'all':
-        if query.command_mode == 'only':
-            command_filter = {'content': {'$regex': r'^[!/]', '$options': ''}}
-        elif query.command_mode == 'exclude':
-            command_filter = {'content': {'$not': {'$regex': r'^[!/]'}}}
+        only = query.command_mode == 'only'
+
+        if query.command_mode in ('only', 'exclude'):
+            command_filter = {'is_command': only}
+
+            # Older logs only get is_command once chat_command_backfill is done, until then look at their content
+            if not await chat_command_backfill_done(request.app):
+                command_filter = {
+                    '$or': [
+                        command_filter,
+                        {
+                            'is_command': {'$exists': False},
+                            'content': _COMMAND_PREFIX if only else {'$not': _COMMAND_PREFIX},
+                        },
+                    ]
+                }
 
     # Combine all filters using $and
     all_filters = []
@@ -476,6 +491,40 @@ async def get_chat_logs(
     if auth.permissions & PERMISSION_VIEW_IP_ADDR != PERMISSION_VIEW_IP_ADDR:
         ip_projection['user.ip'] = 0
 
+    return filter_query, sort_dir, ip_projection
+
+
+def _as_message_log(message: dict) -> dict:
+    if message.get('user') and message['user'].get('gs_avatar'):
+        message['user']['gs_avatar'] = FileInfo(
+            file_id=message['user']['gs_avatar']['gridfs_file'],
+            name=message['user']['gs_avatar']['file_name'],
+        ).dict()
+
+    message['rendered'] = render_chat_message(str(message.get('content', '')))
+
+    # Expose chat log id for frontend (string)
+    message['id'] = str(message['_id'])
+    del message['_id']
+
+    return message
+
+
+@server_router.get(
+    '/{server_id}/logs',
+    response_model_exclude_none=True,
+    response_model_exclude_unset=True,
+    response_model=List[MessageLog],
+    dependencies=[Depends(csrf_protect)],
+)
+async def get_chat_logs(
+    request: Request,
+    server_id: str,
+    auth: AuthInfo = Depends(check_access),
+    query: RequestChatLogs = Depends(RequestChatLogs),
+):
+    filter_query, sort_dir, ip_projection = await _chat_log_query(request, server_id, auth, query)
+
     cursor = (
         request.app.state.db[MONGO_DB]
         .chat_logs.find(
@@ -488,22 +537,38 @@ async def get_chat_logs(
 
     messages = await cursor.to_list(length=query.limit)
 
-    for message in messages:
-        if message.get('user') and message['user'].get('gs_avatar'):
-            message['user']['gs_avatar'] = FileInfo(
-                file_id=message['user']['gs_avatar']['gridfs_file'],
-                name=message['user']['gs_avatar']['file_name'],
-            ).dict()
-
-        # Display any html tags in message as plain text
-        bbparser = bbcode.Parser()
-        bbparser.recognized_tags = {}
-        bbparser.replace_links = False
-        # bbparser.format returns str with tags stripped; ensure no HTML is injected
-        message['rendered'] = bbparser.format(str(message.get('content', '')))
-
-        # Expose chat log id for frontend (string)
-        message['id'] = str(message['_id'])
-        del message['_id']
-
-    return messages
+    return [_as_message_log(message) for message in messages]
+
+
+# Streams every matching message as NDJSON, each line carries a cursor that can be passed back to resume after it
+@server_router.get('/{server_id}/logs/export', dependencies=[Depends(csrf_protect)])
+async def export_chat_logs(
+    request: Request,
+    server_id: str,
+    cursor: Optional[str] = None,
+    auth: AuthInfo = Depends(check_access),
+    query: RequestChatLogs = Depends(RequestChatLogs),
+):
+    filter_query, sort_dir, ip_projection = await _chat_log_query(request, server_id, auth, query)
+
+    if cursor is not None:
+        try:
+            filter_query = resume_after(filter_query, cursor, sort_dir)
+        except ValueError:
+            raise HTTPException(detail='Invalid cursor', status_code=400)
+
+    db_cursor = (
+        request.app.state.db[MONGO_DB]
+        .chat_logs.find(filter_query, projection=ip_projection)
+        .sort(export_sort(sort_dir))
+        .batch_size(EXPORT_BATCH_SIZE)
+    )
+
+    async def rows():
+        async for message in db_cursor:
+            token = encode_cursor(message['created'], message['_id'])
+            row = MessageLog(**_as_message_log(message)).dict(exclude_none=True)
+            row['cursor'] = token
+            yield row
+
+    return StreamingResponse(ndjson_lines(rows()), media_type=NDJSON_MEDIA_TYPE)
@@ -9,7 +9,7 @@ from redis.exceptions import RedisError
 from starlette.requests import Request
 
 from gflbans.internal.config import MONGO_DB
-from gflbans.internal.database.infraction import DInfraction
+from gflbans.internal.database.infraction import INFRACTION_SUMMARY_PROJECTION, DInfraction
 from gflbans.internal.flags import (
     INFRACTION_ADMIN_CHAT_BLOCK,
     INFRACTION_BAN,
@@ -69,7 +69,9 @@ async def generate_statistics(request: Request):
         dx = (datetime.combine(datetime.today(), time.min) - timedelta(days=dr + 1)).strftime('%Y/%m/%d')
         hist[dx] = InfractionDay()
 
-    async for doc in DInfraction.from_query(request.app.state.db[MONGO_DB], {'created': {'$gte': dt}}):
+    async for doc in DInfraction.from_query(
+        request.app.state.db[MONGO_DB], {'created': {'$gte': dt}}, projection=INFRACTION_SUMMARY_PROJECTION
+    ):
         dt = datetime.fromtimestamp(doc.created, tz=UTC)
         dk = dt.strftime('%Y/%m/%d')
 
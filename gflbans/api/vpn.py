@@ -19,6 +19,7 @@ from gflbans.internal.flags import PERMISSION_MANAGE_VPNS
 from gflbans.internal.log import logger
 from gflbans.internal.models.api import VPNInfo
 from gflbans.internal.models.protocol import AddVPN, FetchBlocklistReply, PatchVPN, RemoveVPN
+from gflbans.internal.vpn_index import invalidate_vpn_index
 
 vpn_router = APIRouter(default_response_class=ORJSONResponse)
 
@@ -61,6 +62,8 @@ async def add_vpn(request: Request, vpn: AddVPN, auth: AuthInfo = Depends(check_
     except DuplicateKeyError:
         raise HTTPException(detail='VPN is already on the blocklist', status_code=409)
 
+    await invalidate_vpn_index(request.app)
+
     logger.info(f'{auth.type}/{auth.authenticator_id} created a VPN {dv.id}')
 
     await DAuditLog(
@@ -125,6 +128,7 @@ async def patch_vpn(request: Request, vpn_patch: PatchVPN, auth: AuthInfo = Depe
         raise HTTPException(status_code=400, detail='Request changes nothing')
 
     await vpn.commit(request.app.state.db[MONGO_DB])
+    await invalidate_vpn_index(request.app)
 
     logger.info(f'{auth.type}/{auth.authenticator_id} edited a VPN {vpn.id}')
 
@@ -165,6 +169,8 @@ async def remove_vpn(request: Request, vpn: RemoveVPN, auth: AuthInfo = Depends(
     if delete_type.deleted_count is None or delete_type.deleted_count == 0:
         raise HTTPException(detail='No VPN exists with identifier: {vpn.as_number_or_cidr}', status_code=404)
 
+    await invalidate_vpn_index(request.app)
+
     logger.info(f'{auth.type}/{auth.authenticator_id} deleted VPN {vpn.as_number_or_cidr}')
 
     await DAuditLog(
@@ -1,9 +1,8 @@
 import html
 from contextlib import suppress
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, List, Optional
 
-import bbcode
 from bson import ObjectId
 from dateutil.tz import UTC
 from fastapi import HTTPException
@@ -14,7 +13,7 @@ from gflbans.internal.config import MONGO_DB, ROOT_USER
 from gflbans.internal.constants import NOT_AUTHED_USER
 from gflbans.internal.database.common import DFile
 from gflbans.internal.database.dadmin import DAdmin
-from gflbans.internal.database.infraction import DComment, DInfraction, DUser
+from gflbans.internal.database.infraction import INFRACTION_SUMMARY_PROJECTION, DComment, DInfraction, DUser
 from gflbans.internal.flags import (
     ALL_PERMISSIONS,
     INFRACTION_PERMANENT,
@@ -36,6 +35,7 @@ from gflbans.internal.models.api import (
     PositiveIntIncl0,
 )
 from gflbans.internal.models.protocol import CheckInfractionsReply
+from gflbans.internal.rendering import render_comment
 from gflbans.internal.utils import validate
 
 
@@ -60,6 +60,53 @@ async def admin_as_int(app, a: Optional[ObjectId]):
     return None
 
 
+# Bulk version of admin_as_int, one MGET for everything cached and one query for the rest
+async def admins_as_int(app, ids) -> Dict[ObjectId, int]:
+    ids = list({a for a in ids if a is not None})
+    admins = {}
+
+    if not ids:
+        return admins
+
+    with suppress(RedisError):
+        for a, admin in zip(ids, await app.state.cache.get_many([str(a) for a in ids], 'admin_id_cache')):
+            if admin:
+                admins[a] = admin['ips_user']
+
+    missing = [a for a in ids if a not in admins]
+
+    if missing:
+        found = {}
+
+        async for admin in app.state.db[MONGO_DB].admin_cache.find({'_id': {'$in': missing}}, {'ips_user': 1}):
+            found[admin['_id']] = admin['ips_user']
+
+        with suppress(RedisError):
+            await app.state.cache.set_many(
+                {str(a): {'ips_user': ips_user} for a, ips_user in found.items()}, 'admin_id_cache', expire_time=3600
+            )
+
+        admins.update(found)
+
+    return admins
+
+
+# Every admin an infraction refers to, so they can be looked up together
+def infraction_admin_ids(infraction: DInfraction) -> List[Optional[ObjectId]]:
+    ids = [infraction.admin, infraction.remover]
+
+    for c in infraction.comments:
+        ids.append(c.author)
+
+        if c.edit_data:
+            ids.append(c.edit_data.get('admin'))
+
+    for df in infraction.files:
+        ids.append(df.uploaded_by)
+
+    return ids
+
+
 async def find_admin_name(db_ref: AsyncIOMotorDatabase, a: Optional[ObjectId]):
     if a is None:
         return 'SYSTEM'
@@ -73,36 +120,18 @@ async def find_admin_name(db_ref: AsyncIOMotorDatabase, a: Optional[ObjectId]):
     return an
 
 
-async def as_edict(app, ed):
+def as_edict(ed, admins: Dict[ObjectId, int]):
     a = {}
 
     if 'time' in ed:
         a = {'time': to_unix(ed['time'])}
 
     if 'admin' in ed:
-        a['admin'] = await admin_as_int(app, ed['admin'])
+        a['admin'] = admins.get(ed['admin'])
 
     return a
 
 
-def render_comment(comment: str):
-    bbparser = bbcode.Parser()
-
-    # I only really want urls atm until i can unfuck the formatting
-
-    with suppress(KeyError):
-        ttk = set()
-
-        for tag in bbparser.recognized_tags:
-            if tag != 'url':
-                ttk.add(tag)
-
-        for tag in ttk:
-            del bbparser.recognized_tags[tag]
-
-    return bbparser.format(comment)
-
-
 def to_unix(dt: datetime):
     if dt is not None:
         return int(dt.replace(tzinfo=UTC).timestamp())
@@ -110,10 +139,10 @@ def to_unix(dt: datetime):
         return 0
 
 
-async def as_comment(app, c: DComment) -> Comment:
+def as_comment(c: DComment, admins: Dict[ObjectId, int]) -> Comment:
     return Comment(
-        edit_data=await as_edict(app, c.edit_data),
-        author=await admin_as_int(app, c.author),
+        edit_data=as_edict(c.edit_data, admins),
+        author=admins.get(c.author),
         content=c.content,
         private=c.private,
         rendered=render_comment(c.content),
@@ -121,19 +150,19 @@ async def as_comment(app, c: DComment) -> Comment:
     )
 
 
-async def as_comments(app, c: List[DComment], exclude_priv=True) -> List[Comment]:
+def as_comments(c: List[DComment], admins: Dict[ObjectId, int], exclude_priv=True) -> List[Comment]:
     c2 = []
 
     for com in c:
         if exclude_priv and com.private:
             continue
 
-        c2.append(await as_comment(app, com))
+        c2.append(as_comment(com, admins))
 
     return c2
 
 
-async def as_files(app, f: List[DFile], exclude_priv=True) -> List[FileInfo]:
+def as_files(f: List[DFile], admins: Dict[ObjectId, int], exclude_priv=True) -> List[FileInfo]:
     e = []
 
     for df in f:
@@ -143,7 +172,7 @@ async def as_files(app, f: List[DFile], exclude_priv=True) -> List[FileInfo]:
         fi = FileInfo(
             file_id=df.gridfs_file,
             name=df.file_name,
-            uploaded_by=await admin_as_int(app, df.uploaded_by),
+            uploaded_by=admins.get(df.uploaded_by),
             private=df.private,
         )
 
@@ -200,20 +229,22 @@ def as_player(user: Optional[DUser], ip: Optional[str], include_ip: bool = True)
     return PlayerObj(**pos.dict(), **pf)
 
 
-async def as_infraction(app, infraction: DInfraction, include_ip=True, exclude_private=False) -> Infraction:
+def _as_infraction(
+    infraction: DInfraction, admins: Dict[ObjectId, int], include_ip=True, exclude_private=False
+) -> Infraction:
     return Infraction(
         id=str_id(infraction.id),
         flags=infraction.flags,
-        comments=await as_comments(app, infraction.comments, exclude_priv=exclude_private),
-        files=await as_files(app, infraction.files, exclude_priv=exclude_private),
+        comments=as_comments(infraction.comments, admins, exclude_priv=exclude_private),
+        files=as_files(infraction.files, admins, exclude_priv=exclude_private),
         server=str_id(infraction.server),
         created=infraction.created,
         expires=infraction.expires,
         player=as_player(infraction.user, infraction.ip, include_ip),
-        admin=await admin_as_int(app, infraction.admin),
+        admin=admins.get(infraction.admin),
         reason=infraction.reason,
         removed_on=infraction.removed,
-        removed_by=await admin_as_int(app, infraction.remover),
+        removed_by=admins.get(infraction.remover),
         removal_reason=infraction.ureason,
         time_left=infraction.time_left,
         orig_length=infraction.original_time,
@@ -221,6 +252,21 @@ async def as_infraction(app, infraction: DInfraction, include_ip=True, exclude_p
     )
 
 
+async def as_infraction(app, infraction: DInfraction, include_ip=True, exclude_private=False) -> Infraction:
+    admins = await admins_as_int(app, infraction_admin_ids(infraction))
+
+    return _as_infraction(infraction, admins, include_ip, exclude_private)
+
+
+# For lists of infractions, every admin referenced anywhere on the page is resolved in one go
+async def as_infractions(
+    app, infractions: List[DInfraction], include_ip=True, exclude_private=False
+) -> List[Infraction]:
+    admins = await admins_as_int(app, [a for infraction in infractions for a in infraction_admin_ids(infraction)])
+
+    return [_as_infraction(infraction, admins, include_ip, exclude_private) for infraction in infractions]
+
+
 async def as_groups(app, groups: List[int]) -> List[Group]:
     group_list = []
     for ips_group in groups:
@@ -323,7 +369,7 @@ def user_str(dinf: DInfraction) -> str:
 async def construct_ci_resp(db_ref, mongo_query: dict) -> CheckInfractionsReply:
     ci_resp = CheckInfractionsReply()
 
-    async for infraction in DInfraction.from_query(db_ref, mongo_query):
+    async for infraction in DInfraction.from_query(db_ref, mongo_query, projection=INFRACTION_SUMMARY_PROJECTION):
         for fn, fi in str2pflag.items():
             if infraction.flags & fi == fi:
                 a = getattr(ci_resp, fn)
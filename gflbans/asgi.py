@@ -12,7 +12,7 @@ from starlette.staticfiles import StaticFiles
 from starlette.templating import Jinja2Templates
 
 from gflbans.api import api
-from gflbans.deprecation import deprecation_cleanup, full_vpn_check
+from gflbans.deprecation import chat_command_backfill, deprecation_cleanup, full_vpn_check, identity_link_backfill
 from gflbans.file import file_router
 from gflbans.internal.config import PRODUCTION, SECRET_KEY
 from gflbans.internal.constants import GB_VERSION
@@ -74,6 +74,8 @@ def new_app():
 
         await deprecation_cleanup(app)
         await full_vpn_check(app)
+        asyncio.get_event_loop().create_task(chat_command_backfill(app))
+        asyncio.get_event_loop().create_task(identity_link_backfill(app))
 
     return app
 
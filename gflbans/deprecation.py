@@ -1,17 +1,19 @@
 import asyncio
-from datetime import datetime, timedelta
+from datetime import datetime
 from math import ceil
 
 from dateutil.tz import UTC
 from packaging.version import Version
-from pymongo import ReturnDocument
+from pymongo import ASCENDING, ReturnDocument
 
 from gflbans.internal import shard
-from gflbans.internal.config import IPHUB_API_KEY, MONGO_DB
+from gflbans.internal.config import IPHUB_API_KEY, IPHUB_BACKFILL_DAILY_LIMIT, MONGO_DB
 from gflbans.internal.constants import GB_VERSION
 from gflbans.internal.database.group import DGroup
+from gflbans.internal.database.identity import DIdentityLink
 from gflbans.internal.database.infraction import DInfraction
-from gflbans.internal.database.task import DTask
+from gflbans.internal.database.server import DChatLog
+from gflbans.internal.database.task import DTask, notify_task_queue
 from gflbans.internal.flags import INFRACTION_VPN
 from gflbans.internal.log import logger
 
@@ -138,12 +140,14 @@ async def full_vpn_check(app):
 
     version_info = await info_collection.find_one({'_id': DATABASE_INFO_KEY})
 
-    # Only do a full re-check on infraction IPs being a VPN if it was never done
+    # Only do a full re-check on infraction IPs being a VPN if it was never done. A daily limit of 0 turns it off
+    # until a limit is set
     if (
         version_info is None
         or version_info.get('vpn_backfill_done', False)
         or not IPHUB_API_KEY
         or IPHUB_API_KEY == 'APIKEYHERE'
+        or IPHUB_BACKFILL_DAILY_LIMIT <= 0
     ):
         return
 
@@ -164,33 +168,33 @@ async def full_vpn_check(app):
     if version_info.get('vpn_check_shard') != shard:
         return
 
-    DAILY_LIMIT = 500  # 1k is daily limit for free key on IPHub
-    now = datetime.now(tz=UTC)
-
-    cursor = db['infractions'].find(
-        {'ip': {'$exists': True, '$ne': None}, 'flags': {'$bitsAllClear': INFRACTION_VPN}},
-        {'_id': 1},
-        sort=[('_id', 1)],
+    # Tasks are spread out over the daily budget, the token bucket in the task itself is the hard limit
+    spacing = (3600 * 24) / IPHUB_BACKFILL_DAILY_LIMIT
+    now = datetime.now(tz=UTC).timestamp()
+
+    # One task per unique IP, its result is applied to every infraction sharing that IP
+    cursor = db['infractions'].aggregate(
+        [
+            {'$match': {'ip': {'$exists': True, '$ne': None}, 'flags': {'$bitsAllClear': INFRACTION_VPN}}},
+            {'$group': {'_id': '$ip'}},
+        ],
+        allowDiskUse=True,
     )
 
     i = 0
+    batch = []
     async for doc in cursor:
-        inf_id = doc['_id']
-
-        day_offset = i // DAILY_LIMIT
-        slot_in_day = i % DAILY_LIMIT
-        run_time = now + timedelta(days=day_offset, seconds=slot_in_day * 60)  # 1-min spacing
+        batch.append(DTask(run_at=now + i * spacing, task_data={'ip': doc['_id']}, ev_handler='vpn_backfill'))
+        i += 1
 
-        task = DTask(
-            run_at=run_time.timestamp(),
-            task_data={'i_id': inf_id},
-            ev_handler='get_vpn_data',
-        )
-        await task.commit(db)
+        if len(batch) >= 1000:
+            await DTask.insert_many(db, batch)
+            batch = []
 
-        i += 1
+    await DTask.insert_many(db, batch)
+    await notify_task_queue(app)
 
-    logger.info(f'Scheduled {i} VPN check tasks over {ceil(i / DAILY_LIMIT)} days.')
+    logger.info(f'Scheduled {i} VPN backfill tasks over {ceil(i / IPHUB_BACKFILL_DAILY_LIMIT)} days.')
 
     # Mark backfill as done
     await info_collection.update_one(
@@ -200,3 +204,210 @@ async def full_vpn_check(app):
             '$unset': {'vpn_check_shard': None},
         },
     )
+
+
+# One-off migrations that are too slow for startup run in the background, on the shard holding the lease. The lease
+# is renewed after every batch, so if that shard dies another one takes over when it is restarted
+MIGRATION_BATCH_SIZE = 10000
+MIGRATION_LEASE_TIME = 300
+
+
+async def _hold_migration_lease(app, name: str) -> bool:
+    redis_client = app.state.redis_client
+    key = f'gflbans::migration:{name}'
+
+    if await redis_client.set(key, shard, nx=True, ex=MIGRATION_LEASE_TIME):
+        return True
+
+    holder = await redis_client.get(key)
+
+    if holder is not None and holder.decode() == shard:
+        await redis_client.expire(key, MIGRATION_LEASE_TIME)
+        return True
+
+    return False
+
+
+async def chat_command_backfill(app):
+    DATABASE_INFO_KEY = 'gflbans_info'
+    db = app.state.db[MONGO_DB]
+    info_collection = db['version_info']
+
+    version_info = await info_collection.find_one({'_id': DATABASE_INFO_KEY})
+
+    # Chat logs from before is_command was stored at ingestion. Until they're done, the command filter also checks
+    # the content of logs without is_command
+    if version_info is not None and version_info.get('chat_command_backfill_done', False):
+        app.state.chat_command_backfill_done = True
+        return
+
+    collection = db[DChatLog.__collection__]
+    last_id = None
+    modified = 0
+
+    try:
+        while True:
+            if not await _hold_migration_lease(app, 'chat_command_backfill'):
+                return
+
+            # Walks the _id index so every batch starts where the last one ended
+            query = {'is_command': {'$exists': False}}
+
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+
+            ids = [
+                doc['_id']
+                for doc in await collection.find(query, {'_id': 1})
+                .sort('_id', ASCENDING)
+                .limit(MIGRATION_BATCH_SIZE)
+                .to_list(MIGRATION_BATCH_SIZE)
+            ]
+
+            if not ids:
+                break
+
+            result = await collection.update_many(
+                {'_id': {'$in': ids}, 'is_command': {'$exists': False}},
+                [{'$set': {'is_command': {'$regexMatch': {'input': '$content', 'regex': '^[!/]'}}}}],
+            )
+
+            modified += result.modified_count
+            last_id = ids[-1]
+    except Exception:
+        logger.error('Backfilling is_command on chat logs failed, it will continue on the next start', exc_info=True)
+        return
+
+    logger.info(f'Backfilled is_command on {modified} chat logs.')
+
+    await info_collection.update_one(
+        {'_id': DATABASE_INFO_KEY},
+        {'$set': {'chat_command_backfill_done': True}},
+        upsert=True,
+    )
+
+    app.state.chat_command_backfill_done = True
+
+
+# How long a worker goes by its last look at version_info before checking again whether a migration has finished
+MIGRATION_CHECK_INTERVAL = 60
+
+
+# chat_command_backfill only runs on the worker holding the lease, the others learn that it finished from version_info
+async def chat_command_backfill_done(app) -> bool:
+    if getattr(app.state, 'chat_command_backfill_done', False):
+        return True
+
+    now = datetime.now(tz=UTC).timestamp()
+
+    if now - getattr(app.state, 'chat_command_backfill_checked', 0) < MIGRATION_CHECK_INTERVAL:
+        return False
+
+    app.state.chat_command_backfill_checked = now
+
+    DATABASE_INFO_KEY = 'gflbans_info'
+    version_info = await app.state.db[MONGO_DB]['version_info'].find_one(
+        {'_id': DATABASE_INFO_KEY}, {'chat_command_backfill_done': 1}
+    )
+
+    app.state.chat_command_backfill_done = version_info is not None and version_info.get(
+        'chat_command_backfill_done', False
+    )
+
+    return app.state.chat_command_backfill_done
+
+
+async def identity_link_backfill(app):
+    DATABASE_INFO_KEY = 'gflbans_info'
+    db = app.state.db[MONGO_DB]
+    info_collection = db['version_info']
+
+    version_info = await info_collection.find_one({'_id': DATABASE_INFO_KEY})
+
+    # Infractions from before identity links were recorded at creation
+    if version_info is not None and version_info.get('identity_link_backfill_done', False):
+        return
+
+    collection = db[DInfraction.__collection__]
+    last_id = None
+
+    try:
+        while True:
+            if not await _hold_migration_lease(app, 'identity_link_backfill'):
+                return
+
+            query = {}
+
+            if last_id is not None:
+                query['_id'] = {'$gt': last_id}
+
+            ids = [
+                doc['_id']
+                for doc in await collection.find(query, {'_id': 1})
+                .sort('_id', ASCENDING)
+                .limit(MIGRATION_BATCH_SIZE)
+                .to_list(MIGRATION_BATCH_SIZE)
+            ]
+
+            if not ids:
+                break
+
+            # Merges with the existing links by min/max, so a batch that is repeated after a restart changes nothing
+            await collection.aggregate(
+                [
+                    {
+                        '$match': {
+                            '_id': {'$gte': ids[0], '$lte': ids[-1]},
+                            'ip': {'$type': 'string'},
+                            'user.gs_service': {'$type': 'string'},
+                            'user.gs_id': {'$type': 'string'},
+                        }
+                    },
+                    {
+                        '$group': {
+                            '_id': {'gs_service': '$user.gs_service', 'gs_id': '$user.gs_id', 'ip': '$ip'},
+                            'first_seen': {'$min': {'$toLong': '$created'}},
+                            'last_seen': {'$max': {'$toLong': '$created'}},
+                        }
+                    },
+                    {
+                        '$project': {
+                            '_id': 0,
+                            'gs_service': '$_id.gs_service',
+                            'gs_id': '$_id.gs_id',
+                            'ip': '$_id.ip',
+                            'first_seen': 1,
+                            'last_seen': 1,
+                        }
+                    },
+                    {
+                        '$merge': {
+                            'into': DIdentityLink.__collection__,
+                            'on': ['gs_id', 'ip', 'gs_service'],
+                            'whenMatched': [
+                                {
+                                    '$set': {
+                                        'first_seen': {'$min': ['$first_seen', '$$new.first_seen']},
+                                        'last_seen': {'$max': ['$last_seen', '$$new.last_seen']},
+                                    }
+                                }
+                            ],
+                            'whenNotMatched': 'insert',
+                        }
+                    },
+                ],
+                allowDiskUse=True,
+            ).to_list(None)
+
+            last_id = ids[-1]
+    except Exception:
+        logger.error('Backfilling identity links failed, it will continue on the next start', exc_info=True)
+        return
+
+    logger.info(f'Backfilled identity links, {await db[DIdentityLink.__collection__].count_documents({})} in total.')
+
+    await info_collection.update_one(
+        {'_id': DATABASE_INFO_KEY},
+        {'$set': {'identity_link_backfill_done': True}},
+        upsert=True,
+    )
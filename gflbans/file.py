@@ -1,7 +1,7 @@
 import asyncio
 import io
 from functools import partial
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
 import bson
 from bson import ObjectId
@@ -11,14 +11,21 @@ from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from PIL import Image
 from pydantic import constr
 from starlette.requests import Request
-from starlette.responses import Response, StreamingResponse
+from starlette.responses import Response
 
 from gflbans.api.auth import AuthInfo, check_access
 from gflbans.internal.config import MONGO_DB
 from gflbans.internal.constants import API_KEY, SERVER_KEY
+from gflbans.internal.fs import gridfs_etag, gridfs_last_modified, is_not_modified, serve_gridfs, validator_headers
+from gflbans.internal.utils import single_flight
 
 file_router = APIRouter()
 
+RENDITION_TYPES = {'png': 'image/png', 'jpg': 'image/jpeg'}
+
+# Conversions currently running on this worker, so a burst of requests for one image only encodes it once
+_renditions_inflight: Dict[Tuple[ObjectId, str], asyncio.Task] = {}
+
 
 def sync_convert_image(image_bytes, target_format):
     image_bytes = io.BytesIO(image_bytes)
@@ -31,6 +38,32 @@ def sync_convert_image(image_bytes, target_format):
     return tgt.getvalue()
 
 
+# Converted copies are stored in GridFS next to the original so they are only ever encoded once
+async def get_rendition(app, fos, target_format) -> ObjectId:
+    files = app.state.db[MONGO_DB].fs.files
+
+    existing = await files.find_one({'metadata.derived_from': fos._id, 'metadata.format': target_format}, {'_id': 1})
+
+    if existing is not None:
+        return existing['_id']
+
+    file_contents = await fos.read()
+
+    image_data = await asyncio.get_running_loop().run_in_executor(
+        app.state.sync_processes, partial(sync_convert_image, file_contents, target_format)
+    )
+
+    metadata = {'derived_from': fos._id, 'format': target_format, 'content-type': RENDITION_TYPES[target_format]}
+
+    # Call admin images expire, their renditions should go with them
+    if 'dispose_created' in fos.metadata:
+        metadata['dispose_created'] = fos.metadata['dispose_created']
+
+    return await AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB]).upload_from_stream(
+        f'{fos._id}.{target_format}', image_data, metadata=metadata
+    )
+
+
 @file_router.get('/uploads/{gridfs_id}/{file_name}')
 async def download_file(
     request: Request,
@@ -56,6 +89,8 @@ async def download_file(
     if hasattr(fos, 'metadata') and fos.metadata is not None and 'content-type' in fos.metadata:
         t = fos.metadata['content-type']
 
+    last_modified = gridfs_last_modified(fos)
+
     if convert_webp is not None:
         if t != 'image/webp':
             raise HTTPException(detail='Requested file is not a WEBP image', status_code=400)
@@ -64,28 +99,30 @@ async def download_file(
         if auth.type != SERVER_KEY and auth.type != API_KEY:
             raise HTTPException(detail='Must be either a server or an api key to make this request', status_code=403)
 
-        file_contents = await fos.read()
+        etag = gridfs_etag(fos, convert_webp)
+        headers = {**validator_headers(etag, last_modified), 'Cache-Control': 'no-cache'}
 
-        image_data = await asyncio.get_running_loop().run_in_executor(
-            request.app.state.sync_processes, partial(sync_convert_image, file_contents, convert_webp)
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
+
+        rendition_id = await single_flight(
+            _renditions_inflight, (fid, convert_webp), lambda: get_rendition(request.app, fos, convert_webp)
         )
 
-        mt = 'image/png' if convert_webp == 'png' else 'image/jpeg'
+        try:
+            rfos = await client.open_download_stream(rendition_id)
+        except NoFile:
+            raise HTTPException(detail='No such file', status_code=404)
 
-        return Response(
-            content=image_data,
-            status_code=200,
-            headers={'Content-Length': str(len(image_data)), 'Cache-Control': 'no-cache'},
-            media_type=mt,
-        )
+        return await serve_gridfs(request, rfos, RENDITION_TYPES[convert_webp], headers)
     else:
+        etag = gridfs_etag(fos)
+        headers = {
+            **validator_headers(etag, last_modified),
+            'Cache-Control': 'public, max-age=604800, immutable',
+        }
 
-        async def gridfs_read():
-            while fos.tell() < fos.length:
-                yield await fos.readchunk()
+        if is_not_modified(request, etag, last_modified):
+            return Response(status_code=304, headers=headers)
 
-        return StreamingResponse(
-            gridfs_read(),
-            media_type=t,
-            headers={'Content-Length': str(fos.length), 'Cache-Control': 'public, max-age=604800, immutable'},
-        )
+        return await serve_gridfs(request, fos, t, headers)
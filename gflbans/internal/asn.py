@@ -1,59 +1,155 @@
+import asyncio
 from contextlib import suppress
+from datetime import datetime
+from typing import Dict, Optional, Tuple
 
+from aiohttp import ClientResponseError
+from dateutil.tz import UTC
 from netaddr import IPAddress
 from redis.exceptions import RedisError
 
-from gflbans.internal.config import IPHUB_API_KEY, IPHUB_CACHE_TIME, MONGO_DB
-from gflbans.internal.database.vpn import DVPN
+from gflbans.internal.config import (
+    IPHUB_API_KEY,
+    IPHUB_CACHE_TIME,
+    IPHUB_ERROR_CACHE_TIME,
+    IPHUB_RATE_LIMIT_CACHE_TIME,
+    IPHUB_WITH_IP_DATABASE,
+    MONGO_DB,
+)
+from gflbans.internal.errors import IPLookupError
 from gflbans.internal.log import logger
+from gflbans.internal.utils import single_flight
 
 VPN_NO = 0
 VPN_YES = 1
 VPN_DUBIOUS = 2
 
+# Lookups currently in progress on this worker, so concurrent requests for one IP share a single IPHub call
+_iphub_inflight: Dict[str, asyncio.Task] = {}
+
+# Set when IPHub rate limits us, no requests are made until it passes
+_iphub_backoff_until = 0.0
+
+
+def _iphub_enabled() -> bool:
+    return IPHUB_API_KEY is not None and IPHUB_API_KEY != 'APIKEYHERE'
+
+
+async def _cache_iphub_result(app, ip_addr: str, value: dict, expire_time: int):
+    with suppress(RedisError):
+        await app.state.ip_info_cache.set(ip_addr, value, 'iphubinfo', expire_time=expire_time)
+
+
+async def _lookup_iphub(app, ip_addr: str) -> Optional[dict]:
+    global _iphub_backoff_until
 
-async def check_vpn(app, ip_addr: str) -> int:
     iphub_data = None
-    iphub_call_exception = None
     with suppress(RedisError):
         iphub_data = await app.state.ip_info_cache.get(ip_addr, 'iphubinfo')
 
-    if iphub_data is None and IPHUB_API_KEY is not None and IPHUB_API_KEY != 'APIKEYHERE':
+    if iphub_data is not None:
+        # Negative cache entry, IPHub failed for this IP recently
+        if 'error' in iphub_data:
+            raise IPLookupError(f'IPHub lookup for {ip_addr} failed recently: {iphub_data["error"]}')
+
+        return iphub_data
+
+    if not _iphub_enabled():
+        return None
+
+    if datetime.now(tz=UTC).timestamp() < _iphub_backoff_until:
+        raise IPLookupError('IPHub API is rate limiting us')
+
+    try:
         headers = {'X-Key': IPHUB_API_KEY}
         async with app.state.aio_session.get(f'https://v2.api.iphub.info/ip/{ip_addr}', headers=headers) as resp:
-            try:
-                resp.raise_for_status()
-
-                if resp.status == 429:
-                    logger.warning('Rate limit exceeded for IPHub API')
-                else:
-                    iphub_data = await resp.json()
-                    with suppress(RedisError):
-                        await app.state.ip_info_cache.set(
-                            ip_addr,
-                            iphub_data,
-                            'iphubinfo',
-                            expire_time=IPHUB_CACHE_TIME,
-                        )
-
-            except Exception as e:
-                logger.error('Call to IPHub API failed.', exc_info=e)
-                iphub_call_exception = e
-                # Dont return False yet, as we still can check cidr rule for manually defined ASNs
-
-    if iphub_data and iphub_data.get('block', 0) == 1:
+            resp.raise_for_status()
+            iphub_data = await resp.json()
+    except Exception as e:
+        if isinstance(e, ClientResponseError) and e.status == 429:
+            logger.warning('Rate limit exceeded for IPHub API')
+            _iphub_backoff_until = datetime.now(tz=UTC).timestamp() + IPHUB_RATE_LIMIT_CACHE_TIME
+            await _cache_iphub_result(app, ip_addr, {'error': 'rate limited'}, IPHUB_RATE_LIMIT_CACHE_TIME)
+        else:
+            logger.error('Call to IPHub API failed.', exc_info=e)
+            await _cache_iphub_result(app, ip_addr, {'error': str(e) or type(e).__name__}, IPHUB_ERROR_CACHE_TIME)
+
+        raise IPLookupError(f'IPHub lookup for {ip_addr} failed') from e
+
+    await _cache_iphub_result(app, ip_addr, iphub_data, IPHUB_CACHE_TIME)
+
+    return iphub_data
+
+
+# Seconds until IPHub should be asked about this IP again, 0 if it can be asked now. For background work that can wait
+# out a rate limit pause or a remembered failure instead of failing on it
+async def iphub_retry_after(app, ip_addr: str, cached: Optional[dict]) -> float:
+    wait = max(_iphub_backoff_until - datetime.now(tz=UTC).timestamp(), 0)
+
+    if cached is not None and 'error' in cached:
+        ttl = None
+        with suppress(RedisError):
+            ttl = await app.state.ip_info_cache.ttl(ip_addr, 'iphubinfo')
+
+        wait = max(wait, ttl or IPHUB_ERROR_CACHE_TIME)
+
+    return wait
+
+
+async def get_iphub_data(app, ip_addr: str) -> Optional[dict]:
+    return await single_flight(_iphub_inflight, ip_addr, lambda: _lookup_iphub(app, ip_addr))
+
+
+def local_ip_data(app, ip_addr: str) -> Optional[dict]:
+    if app.state.ip_database is None:
+        return None
+
+    record = app.state.ip_database.lookup(IPAddress(ip_addr))
+
+    if record is None:
+        return None
+
+    # Same shape as an IPHub response so the checks below don't care where it came from
+    local_data = {'asn': record.asn}
+
+    if record.country is not None:
+        local_data['countryName'] = record.country
+
+    return local_data
+
+
+async def get_ip_data(app, ip_addr: str) -> Tuple[Optional[dict], Optional[Exception]]:
+    local_data = local_ip_data(app, ip_addr)
+
+    if local_data is not None and not IPHUB_WITH_IP_DATABASE:
+        return local_data, None
+
+    try:
+        iphub_data = await get_iphub_data(app, ip_addr)
+    except IPLookupError as e:
+        # Only a problem if we have nothing else to go on
+        return local_data, e if local_data is None else None
+
+    if local_data is None or iphub_data is None:
+        return local_data or iphub_data, None
+
+    return {**local_data, **iphub_data}, None
+
+
+async def _vpn_verdict(app, ip_addr: str, ip_data: Optional[dict], lookup_exception: Optional[Exception]):
+    if ip_data and ip_data.get('block', 0) == 1:
         logger.info(f'{ip_addr} is marked as VPN/proxy by IPHub')
         return VPN_YES
 
     is_dubious = False
-    if iphub_data and iphub_data.get('block', 0) == 2:
+    if ip_data and ip_data.get('block', 0) == 2:
         logger.info(f'{ip_addr} is marked as a suspicious IP by IPHub')
         is_dubious = True
 
     # If IPHub says it's not a VPN (block=0), check our DVPN database for if we block that ASN
-    if iphub_data and iphub_data.get('asn'):
-        asn = iphub_data['asn']
-        asn_vpn = await DVPN.find_one_from_query(app.state.db[MONGO_DB], {'payload': str(asn), 'is_asn': True})
+    if ip_data and ip_data.get('asn'):
+        asn = ip_data['asn']
+        asn_vpn = await app.state.vpn_index.find_asn_rule(app.state.db[MONGO_DB], asn)
 
         if asn_vpn is not None:
             if not asn_vpn.is_dubious:
@@ -64,7 +160,7 @@ async def check_vpn(app, ip_addr: str) -> int:
                 is_dubious = True
 
     # Check for CIDR rules in our database for if we block that IP block
-    cidr_vpn = await DVPN.find_cidr_rule(app.state.db[MONGO_DB], IPAddress(ip_addr))
+    cidr_vpn = await app.state.vpn_index.find_cidr_rule(app.state.db[MONGO_DB], IPAddress(ip_addr))
 
     if cidr_vpn is not None:
         if not cidr_vpn.is_dubious:
@@ -74,42 +170,38 @@ async def check_vpn(app, ip_addr: str) -> int:
             logger.info(f'{ip_addr} is a suspicious ip address per CIDR rule {cidr_vpn.payload} ({cidr_vpn.id})')
             is_dubious = True
 
-    if iphub_call_exception is not None and not is_dubious:
-        raise iphub_call_exception
+    if lookup_exception is not None and not is_dubious:
+        raise lookup_exception
 
     return VPN_DUBIOUS if is_dubious else VPN_NO
 
 
-async def check_location(app, ip_addr: str) -> str:
-    iphub_data = None
-    with suppress(RedisError):
-        iphub_data = await app.state.ip_info_cache.get(ip_addr, 'iphubinfo')
-
-    if iphub_data is None and IPHUB_API_KEY is not None and IPHUB_API_KEY != 'APIKEYHERE':
-        headers = {'X-Key': IPHUB_API_KEY}
-        async with app.state.aio_session.get(f'https://v2.api.iphub.info/ip/{ip_addr}', headers=headers) as resp:
-            try:
-                resp.raise_for_status()
-
-                if resp.status == 429:
-                    logger.warning('Rate limit exceeded for IPHub API')
-                else:
-                    iphub_data = await resp.json()
-                    with suppress(RedisError):
-                        await app.state.ip_info_cache.set(
-                            ip_addr,
-                            iphub_data,
-                            'iphubinfo',
-                            expire_time=IPHUB_CACHE_TIME,
-                        )
-
-            except Exception as e:
-                logger.error('Failed to check IP location.', exc_info=e)
-
-    if iphub_data and iphub_data.get('countryName'):
-        if iphub_data['countryName'] == 'ZZ':
+def _location(ip_data: Optional[dict]) -> Optional[str]:
+    if ip_data and ip_data.get('countryName'):
+        if ip_data['countryName'] == 'ZZ':
             return 'Local IP Address'
         else:
-            return iphub_data['countryName']
+            return ip_data['countryName']
     else:
         return None
+
+
+async def check_ip(app, ip_addr: str) -> Tuple[int, Optional[str]]:
+    # A failed lookup doesn't return False yet, as we still can check cidr rule for manually defined ASNs
+    ip_data, lookup_exception = await get_ip_data(app, ip_addr)
+
+    return await _vpn_verdict(app, ip_addr, ip_data, lookup_exception), _location(ip_data)
+
+
+async def check_vpn(app, ip_addr: str) -> int:
+    vpn_state, _ = await check_ip(app, ip_addr)
+    return vpn_state
+
+
+async def check_location(app, ip_addr: str) -> Optional[str]:
+    ip_data, lookup_exception = await get_ip_data(app, ip_addr)
+
+    if lookup_exception is not None:
+        logger.error('Failed to check IP location.', exc_info=lookup_exception)
+
+    return _location(ip_data)
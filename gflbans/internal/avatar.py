@@ -1,16 +1,16 @@
 import asyncio
 import io
 from concurrent.futures.process import ProcessPoolExecutor
-from functools import partial
+from hashlib import sha256
+from typing import Dict, List, Tuple
 
 import PIL
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from PIL import Image
 
-from gflbans.internal.config import MONGO_DB
+from gflbans.internal.config import AVATAR_BATCH_DELAY, AVATAR_BATCH_SIZE, AVATAR_PROCESS_WORKERS, MONGO_DB
 from gflbans.internal.log import logger
-
-avatar_thread_pool = ProcessPoolExecutor(max_workers=1)
+from gflbans.internal.utils import single_flight
 
 
 async def ensure_avatar_index():
@@ -38,37 +38,115 @@ def sync_process_avatar(image_bytes):
         raise
 
 
-async def process_avatar(app, avatar_url) -> dict:
-    result = await app.state.db[MONGO_DB].fs.files.find_one({'metadata.retrieved_from': avatar_url})
+# Runs in the process pool, one submission handles a whole batch of avatars
+def sync_process_avatars(images: List[bytes]) -> List[bytes]:
+    results = []
+
+    for image_bytes in images:
+        try:
+            results.append(sync_process_avatar(image_bytes))
+        except Exception as e:
+            # Send back something we know can be pickled
+            results.append(ValueError(f'Failed to process avatar image: {e}'))
+
+    return results
+
 
-    if result is not None:
-        # Create a new file from the result
-        fi = {'gridfs_file': str(result['_id']), 'file_name': 'avatar.webp'}
-        return fi
+class AvatarEngine:
+    def __init__(self, pool_size: int = AVATAR_PROCESS_WORKERS, batch_size: int = AVATAR_BATCH_SIZE):
+        self.pool = ProcessPoolExecutor(max_workers=pool_size)
+        self.batch_size = batch_size
+        self.pending: List[Tuple[bytes, asyncio.Future]] = []
+        self.flush_handle = None
+        self.inflight: Dict[str, asyncio.Task] = {}
 
-    # There wasn't an existing copy, so we'll download it to gridfs
-    async with app.state.aio_session.get(avatar_url) as r:
+    def resize(self, image_bytes: bytes) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        self.pending.append((image_bytes, fut))
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.flush_handle is None:
+            # Wait a moment so avatars requested around the same time (e.g. one heartbeat) share a submission
+            self.flush_handle = loop.call_later(AVATAR_BATCH_DELAY, self.flush)
+
+        return fut
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        while self.pending:
+            batch, self.pending = self.pending[: self.batch_size], self.pending[self.batch_size :]
+            asyncio.get_event_loop().create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch: List[Tuple[bytes, asyncio.Future]]):
         try:
-            r.raise_for_status()
-        except Exception:
-            logger.error('Failed to download avatar image.', exc_info=True)
-            raise
-        image_bytes = await r.read()
+            results = await asyncio.get_event_loop().run_in_executor(
+                self.pool, sync_process_avatars, [image_bytes for image_bytes, _ in batch]
+            )
+        except Exception as e:
+            logger.error('Avatar process pool failed.', exc_info=e)
+            results = [e] * len(batch)
 
-    if image_bytes is None:
-        raise ValueError('Got no image')
+        for (_, fut), result in zip(batch, results):
+            if fut.done():
+                continue
 
-    try:
-        current_loop = asyncio.get_running_loop()
-    except AttributeError:
-        current_loop = asyncio.get_event_loop()
+            if isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
 
-    new_image = await current_loop.run_in_executor(avatar_thread_pool, partial(sync_process_avatar, image_bytes))
+    async def process(self, app, avatar_url: str) -> dict:
+        return await single_flight(self.inflight, avatar_url, lambda: self._process(app, avatar_url))
 
-    file_id = await AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB]).upload_from_stream(
-        'avatar.webp', new_image, metadata={'retrieved_from': avatar_url, 'content-type': 'image/webp'}
-    )
+    async def _process(self, app, avatar_url: str) -> dict:
+        files = app.state.db[MONGO_DB].fs.files
 
-    f = {'gridfs_file': str(file_id), 'file_name': 'avatar.webp'}
+        result = await files.find_one(
+            {'$or': [{'metadata.retrieved_from': avatar_url}, {'metadata.aliases': avatar_url}]}, {'_id': 1}
+        )
 
-    return f
+        if result is not None:
+            # Create a new file from the result
+            return {'gridfs_file': str(result['_id']), 'file_name': 'avatar.webp'}
+
+        # There wasn't an existing copy, so we'll download it to gridfs
+        async with app.state.aio_session.get(avatar_url) as r:
+            try:
+                r.raise_for_status()
+            except Exception:
+                logger.error('Failed to download avatar image.', exc_info=True)
+                raise
+            image_bytes = await r.read()
+
+        if not image_bytes:
+            raise ValueError('Got no image')
+
+        # The same image may have been stored from another url, reuse it and remember this url too
+        source_hash = sha256(image_bytes).hexdigest()
+        result = await files.find_one({'metadata.source_hash': source_hash}, {'_id': 1})
+
+        if result is not None:
+            await files.update_one({'_id': result['_id']}, {'$addToSet': {'metadata.aliases': avatar_url}})
+            return {'gridfs_file': str(result['_id']), 'file_name': 'avatar.webp'}
+
+        new_image = await self.resize(image_bytes)
+
+        file_id = await AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB]).upload_from_stream(
+            'avatar.webp',
+            new_image,
+            metadata={'retrieved_from': avatar_url, 'source_hash': source_hash, 'content-type': 'image/webp'},
+        )
+
+        return {'gridfs_file': str(file_id), 'file_name': 'avatar.webp'}
+
+    def shutdown(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+async def process_avatar(app, avatar_url) -> dict:
+    return await app.state.avatar_engine.process(app, avatar_url)
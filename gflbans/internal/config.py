@@ -46,6 +46,92 @@ STEAM_API_KEY = config('STEAM_API_KEY', default=None)
 STEAM_OPENID_ACCESS_TOKEN_LIFETIME = config('STEAM_OPENID_ACCESS_TOKEN_LIFETIME', cast=int, default=604800)
 IPHUB_API_KEY = config('IPHUB_API_KEY', default=None)
 IPHUB_CACHE_TIME = config('IPHUB_CACHE_TIME', cast=int, default=(60 * 60 * 24 * 7))  # Seconds to cache IPHub results
+IPHUB_ERROR_CACHE_TIME = config('IPHUB_ERROR_CACHE_TIME', cast=int, default=60)  # Seconds to remember a failed lookup
+IPHUB_RATE_LIMIT_CACHE_TIME = config(
+    'IPHUB_RATE_LIMIT_CACHE_TIME', cast=int, default=(60 * 15)
+)  # Seconds to stop calling IPHub for after it rate limits us
+IPHUB_BACKFILL_DAILY_LIMIT = config(
+    'IPHUB_BACKFILL_DAILY_LIMIT', cast=int, default=500
+)  # IPHub lookups per day the VPN backfill may use, 0 turns it off. 1k is the daily limit for a free key
+IP_DATABASE_PATH = config('IP_DATABASE_PATH', default=None)  # Local ASN/country database from tools/import_ip_db.py
+IPHUB_WITH_IP_DATABASE = config(
+    'IPHUB_WITH_IP_DATABASE', cast=bool, default=False
+)  # Still ask IPHub for its VPN verdict on IPs the local database knows about
+VPN_INDEX_MAX_AGE = config('VPN_INDEX_MAX_AGE', cast=int, default=600)  # Seconds before the VPN index is rebuilt anyway
+
+# Avatars
+AVATAR_PROCESS_WORKERS = config('AVATAR_PROCESS_WORKERS', cast=int, default=2)  # Processes resizing avatars per worker
+AVATAR_BATCH_SIZE = config('AVATAR_BATCH_SIZE', cast=int, default=8)  # Max avatars resized per process pool submission
+AVATAR_BATCH_DELAY = config('AVATAR_BATCH_DELAY', cast=float, default=0.01)  # Seconds to wait for more avatars to batch
+
+# Alt search
+ALT_SEARCH_MAX_IDENTITIES = config(
+    'ALT_SEARCH_MAX_IDENTITIES', cast=int, default=5000
+)  # Stop following identity links once this many players and IPs were found
+IDENTITY_LINK_REFRESH = config(
+    'IDENTITY_LINK_REFRESH', cast=int, default=900
+)  # Seconds before a heartbeat updates last_seen again for a player still on the same IP
+
+# Database reads
+TRUSTED_READS = config('TRUSTED_READS', cast=bool, default=True)  # Skip validating documents loaded from MongoDB
+TRUSTED_READ_SAMPLE_RATE = config(
+    'TRUSTED_READ_SAMPLE_RATE', cast=float, default=0.01
+)  # Fraction of trusted reads that are fully validated anyway
+
+# Discord webhooks
+WEBHOOK_MAX_ATTEMPTS = config('WEBHOOK_MAX_ATTEMPTS', cast=int, default=5)  # Tries before a webhook message is dropped
+WEBHOOK_QUEUE_LIMIT = config(
+    'WEBHOOK_QUEUE_LIMIT', cast=int, default=1000
+)  # Messages queued per webhook before the oldest are dropped
+
+# Call admin
+CALLADMIN_POLL_INTERVAL = config(
+    'CALLADMIN_POLL_INTERVAL', cast=int, default=10
+)  # Seconds between checks of open calls for a claim reaction
+CALLADMIN_CLAIM_WINDOW = config(
+    'CALLADMIN_CLAIM_WINDOW', cast=int, default=86400
+)  # Seconds a call can be claimed by reacting to it
+CALLADMIN_POLL_CONCURRENCY = config(
+    'CALLADMIN_POLL_CONCURRENCY', cast=int, default=5
+)  # Open calls checked against Discord at the same time
+CALLADMIN_IMAGE_MAX_PIXELS = config(
+    'CALLADMIN_IMAGE_MAX_PIXELS', cast=int, default=4096 * 4096
+)  # Call admin images with more pixels than this are discarded without being decoded
+
+# Infraction imports
+INFRACTION_IMPORT_MAX_BATCH = config(
+    'INFRACTION_IMPORT_MAX_BATCH', cast=int, default=1000
+)  # Max infractions per bulk import request
+
+# Exports
+EXPORT_BATCH_SIZE = config(
+    'EXPORT_BATCH_SIZE', cast=int, default=100
+)  # Documents fetched per round trip when exporting
+
+# Rendering
+RENDER_CACHE_SIZE = config('RENDER_CACHE_SIZE', cast=int, default=4096)  # Rendered comments/chat lines kept per worker
+
+# File downloads
+FILE_CACHE_DIR = config('FILE_CACHE_DIR', default=None)  # Directory for local copies of served GridFS files
+FILE_CACHE_MAX_SIZE = config(
+    'FILE_CACHE_MAX_SIZE', cast=int, default=(1024 * 1024 * 1024)
+)  # Bytes the file cache may use before the least recently served files are removed
+
+# Map images
+MAP_IMAGE_CACHE_TIME = config('MAP_IMAGE_CACHE_TIME', cast=int, default=600)  # Seconds to remember an uploaded image
+MAP_IMAGE_HIT_CACHE_TIME = config(
+    'MAP_IMAGE_HIT_CACHE_TIME', cast=int, default=(60 * 60 * 24)
+)  # Seconds to remember that GameTracker has an image for a map
+MAP_IMAGE_MISS_CACHE_TIME = config(
+    'MAP_IMAGE_MISS_CACHE_TIME', cast=int, default=(60 * 60)
+)  # Seconds to remember that nobody has an image for a map
+MAP_IMAGE_MIRROR = config(
+    'MAP_IMAGE_MIRROR', cast=bool, default=False
+)  # Copy images found on GameTracker into GridFS so they are served locally afterwards
+
+# Task scheduler
+TASK_BATCH_SIZE = config('TASK_BATCH_SIZE', cast=int, default=50)  # Max tasks claimed from the queue per round trip
+TASK_IDLE_WAIT = config('TASK_IDLE_WAIT', cast=int, default=30)  # Max seconds to sleep without a queue notification
 
 # Web Server Configuration
 WEB_USE_UNIX = config('WEB_USE_UNIX', default=True, cast=bool)  # True = use unix socket, False = use HTTP/TCP
@@ -9,6 +9,7 @@ EVENT_INFRACTION_NEW = 0
 EVENT_INFRACTION_REMOVE = 1
 EVENT_INFRACTION_EDIT = 2
 EVENT_INFRACTION_PURGE = 19
+EVENT_INFRACTION_IMPORT = 20
 EVENT_COMMENT_NEW = 3
 EVENT_COMMENT_EDIT = 4
 EVENT_COMMENT_DELETE = 5
@@ -1,12 +1,17 @@
 import json
-from typing import Any, Optional, Tuple, Union
+from functools import lru_cache
+from random import random
+from typing import Any, List, Optional, Tuple, Type, Union
 from warnings import warn
 
 from bson import ObjectId
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel, ValidationError
+from pydantic.fields import SHAPE_LIST, SHAPE_SINGLETON, ModelField
+from pymongo import ReturnDocument
 from pymongo.results import InsertOneResult, UpdateResult
 
+from gflbans.internal.config import TRUSTED_READ_SAMPLE_RATE, TRUSTED_READS
 from gflbans.internal.log import logger
 from gflbans.internal.utils import validate
 
@@ -18,6 +23,83 @@ def _clean(d):
     return a
 
 
+def _is_model(t) -> bool:
+    return isinstance(t, type) and issubclass(t, BaseModel)
+
+
+def _mentions_model(field: ModelField) -> bool:
+    return _is_model(field.type_) or any(_mentions_model(f) for f in field.sub_fields or ())
+
+
+def _is_int(field: ModelField) -> bool:
+    return (
+        field.shape == SHAPE_SINGLETON
+        and isinstance(field.type_, type)
+        and issubclass(field.type_, int)
+        and not issubclass(field.type_, bool)
+    )
+
+
+# (field name, key in the document, nested model, is a list of the nested model, is an int, field) for every field, or
+# None if the model has nested models in a shape construct_trusted doesn't handle (those are always fully validated)
+@lru_cache(maxsize=None)
+def _decoder(
+    model: Type[BaseModel],
+) -> Optional[Tuple[Tuple[str, str, Optional[Type[BaseModel]], bool, bool, ModelField]]]:
+    plan = []
+
+    for name, field in model.__fields__.items():
+        nested = None
+
+        if _is_model(field.type_):
+            if field.shape not in (SHAPE_SINGLETON, SHAPE_LIST) or _decoder(field.type_) is None:
+                return None
+
+            nested = field.type_
+        elif _mentions_model(field):
+            return None
+
+        plan.append((name, field.alias, nested, field.shape == SHAPE_LIST, _is_int(field), field))
+
+    return tuple(plan)
+
+
+# Builds a model from a document we wrote ourselves without running any validators, including nested models.
+# Fields missing from the document get their defaults and are left out of __fields_set__, same as cls(**doc)
+def construct_trusted(model: Type[BaseModel], doc: dict):
+    plan = _decoder(model)
+
+    if plan is None:
+        return model(**doc)
+
+    values = {}
+    fields_set = set()
+
+    for name, key, nested, is_list, is_int, field in plan:
+        if key not in doc:
+            values[name] = field.get_default()
+            continue
+
+        value = doc[key]
+
+        if nested is not None and value is not None:
+            value = [construct_trusted(nested, v) for v in value] if is_list else construct_trusted(nested, value)
+        elif is_int and isinstance(value, float):
+            # Timestamps are written as floats in places, validation would have turned them into ints
+            value = int(value)
+
+        values[name] = value
+        fields_set.add(name)
+
+    # Same as BaseModel.construct, minus the per call alias and default handling
+    m = model.__new__(model)
+    object.__setattr__(m, '__dict__', values)
+    object.__setattr__(m, '__fields_set__', fields_set)
+    m._init_private_attributes()
+
+    return m
+
+
 # NOTE: On caching: Sometimes, we can load things from a cache to avoid a DB query
 # for any function that is a getty function, you can pass a cache reference into the cache param
 # Only use this for areas where it doesn't really matter if the data is a little bit out of a date.
@@ -33,14 +115,28 @@ class DBase(BaseModel):
         orm_mode = True
         fields = {'id': '_id'}
 
+    # Everything is validated before it is written (see commit, update_field and unset_field), so reads normally
+    # trust the document. A sample of reads still goes through full validation to log documents edited by hand, but
+    # those still load like every other trusted read. Only TRUSTED_READS=False turns a failed validation into an error
     @classmethod
     def load_document(cls, doc):
-        try:
-            return cls(**doc)
-        except ValidationError:
-            if '_id' in doc:
-                logger.error(f'Validation of document {str(doc["_id"])} has failed.', exc_info=True)
-            raise
+        if not TRUSTED_READS:
+            try:
+                return cls(**doc)
+            except ValidationError:
+                if '_id' in doc:
+                    logger.error(f'Validation of document {str(doc["_id"])} has failed.', exc_info=True)
+                raise
+
+        if random() < TRUSTED_READ_SAMPLE_RATE:
+            try:
+                return cls(**doc)
+            except ValidationError:
+                logger.error(
+                    f'Sampled validation of {cls.__name__} document {str(doc.get("_id"))} has failed.', exc_info=True
+                )
+
+        return construct_trusted(cls, doc)
 
     @classmethod
     async def from_id(cls, db_ref: AsyncIOMotorDatabase, obj_id: Union[str, ObjectId]):
@@ -71,12 +167,20 @@ class DBase(BaseModel):
         return cls.load_document(p)
 
     @classmethod
-    def _from_query(cls, db_ref: AsyncIOMotorDatabase, query: dict, limit=None, skip=0, sort: Tuple[str, Any] = None):
+    def _from_query(
+        cls,
+        db_ref: AsyncIOMotorDatabase,
+        query: dict,
+        limit=None,
+        skip=0,
+        sort: Tuple[str, Any] = None,
+        projection: Optional[dict] = None,
+    ):
         qk = json.dumps(query, default=lambda o: str(o))
 
         logger.debug(f'DB: running query {qk} with limit {limit}' f', skip {skip}, and sort {sort}')
 
-        dcur = db_ref[cls.__collection__].find(query)
+        dcur = db_ref[cls.__collection__].find(query, projection)
 
         if sort is not None:
             dcur.sort(sort[0], direction=sort[1])
@@ -89,19 +193,35 @@ class DBase(BaseModel):
 
         return dcur
 
+    # A projection leaves fields at their defaults, so documents loaded with one are partial and must not be committed
     @classmethod
     async def from_query(
-        cls, db_ref: AsyncIOMotorDatabase, query: dict, limit=None, skip=0, sort: Tuple[str, Any] = None
+        cls,
+        db_ref: AsyncIOMotorDatabase,
+        query: dict,
+        limit=None,
+        skip=0,
+        sort: Tuple[str, Any] = None,
+        projection: Optional[dict] = None,
     ):
-        async for document in cls._from_query(db_ref, query, limit, skip, sort):
+        async for document in cls._from_query(db_ref, query, limit, skip, sort, projection):
             logger.debug(f'DB: load {str(document["_id"])} of {cls.__collection__}')
             yield cls.load_document(document)
 
     @classmethod
     async def list_from_query(
-        cls, db_ref: AsyncIOMotorDatabase, query: dict, limit=30, skip=0, sort: Tuple[str, Any] = None
+        cls,
+        db_ref: AsyncIOMotorDatabase,
+        query: dict,
+        limit=30,
+        skip=0,
+        sort: Tuple[str, Any] = None,
+        projection: Optional[dict] = None,
     ):
-        return [cls.load_document(x) for x in await cls._from_query(db_ref, query, limit, skip, sort).to_list(limit)]
+        return [
+            cls.load_document(x)
+            for x in await cls._from_query(db_ref, query, limit, skip, sort, projection).to_list(limit)
+        ]
 
     @classmethod
     async def count(cls, db_ref: AsyncIOMotorDatabase, query: dict):
@@ -152,20 +272,34 @@ class DBase(BaseModel):
 
             return ior
 
-    async def unset_field(self, db_ref: AsyncIOMotorDatabase, field: str, session=None):
-        if self.id is None:
-            raise ValueError("Tried to unset a field when this object doesn't exist in the DB")
+    # New documents only, written in one round trip. Like commit, everything is validated first and the ids are set on
+    # the objects afterwards
+    @classmethod
+    async def insert_many(cls, db_ref: AsyncIOMotorDatabase, objs: List['DBase'], ordered: bool = False):
+        if not objs:
+            return
 
-        if field not in self.__fields__:
-            raise KeyError(f'{field} is not a valid field for this type.')
+        for obj in objs:
+            validate(obj)
 
-        setattr(self, field, None)
+        result = await db_ref[cls.__collection__].insert_many(
+            [_clean(obj.dict(by_alias=True, exclude_unset=True, exclude_none=True)) for obj in objs], ordered=ordered
+        )
 
-        validate(self)
+        for obj, inserted_id in zip(objs, result.inserted_ids):
+            obj.id = inserted_id
 
-        return await db_ref[self.__collection__].update_one(
-            {'_id': self.id}, {'$unset': {self.__fields__[field].alias: ''}}, session=session
-        )
+        logger.debug(f'DB: saved {len(objs)} documents of {cls.__collection__}')
+
+    # Collects several field changes so they are validated and written together, see ChangeSet
+    def changes(self) -> 'ChangeSet':
+        return ChangeSet(self)
+
+    async def unset_field(self, db_ref: AsyncIOMotorDatabase, field: str, session=None):
+        if self.id is None:
+            raise ValueError("Tried to unset a field when this object doesn't exist in the DB")
+
+        return await self.changes().unset(field).commit(db_ref, session=session)
 
     async def update_field(self, db_ref: AsyncIOMotorDatabase, field: str, value: Any, session=None):
         if self.id is None:
@@ -173,81 +307,203 @@ class DBase(BaseModel):
                 'Tried to prepare a field update for this object when it has not yet been ' 'written to the database'
             )
 
-        if field not in self.__fields__:
-            raise KeyError(f'{field} is not a field of this object')
-
         if value is None:
             warn(f'Attempting to null set field {field} of {self.__collection__}. Did you want to unset it instead?')
 
-        setattr(self, field, value)
+        return await self.changes().set(field, value).commit(db_ref, session=session)
 
-        validate(self)
-
-        if hasattr(value, 'dict'):
-            value = value.dict(by_alias=True, exclude_unset=True, exclude_none=True)
+    async def add_bit_flag(self, db_ref: AsyncIOMotorDatabase, field: str, value: int, session=None):
+        if self.id is None:
+            raise ValueError('Cannot add bit flag to this object that has not been committed yet')
 
-        if isinstance(value, list):
-            nl = []
+        return await self.changes().add_bit_flag(field, value).commit(db_ref, session=session)
 
-            for v in value:
-                if hasattr(v, 'dict'):
-                    nl.append(v.dict(by_alias=True, exclude_unset=True, exclude_none=True))
-                else:
-                    nl.append(v)
-            value = nl
+    async def remove_bit_flag(self, db_ref: AsyncIOMotorDatabase, field: str, value: int, session=None):
+        if self.id is None:
+            raise ValueError('Cannot add bit flag to this object that has not been committed yet')
 
-        return await db_ref[self.__collection__].update_one(
-            {'_id': self.id}, {'$set': {self.__fields__[field].alias: value}}, session=session
-        )
+        return await self.changes().remove_bit_flag(field, value).commit(db_ref, session=session)
 
-    async def add_bit_flag(self, db_ref: AsyncIOMotorDatabase, field: str, value: int, session=None):
+    async def append_to_array_field(self, db_ref: AsyncIOMotorDatabase, field: str, value: Any, session=None):
         if self.id is None:
-            raise ValueError('Cannot add bit flag to this object that has not been committed yet')
+            raise ValueError('Cannot modify a document that has not yet been committed.')
 
-        if field not in self.__fields__:
-            raise KeyError(f'No such field {field}')
+        return await self.changes().push(field, value).commit(db_ref, session=session)
 
-        setattr(self, field, getattr(self, field) | value)
 
-        validate(self)
+def _as_document_value(value):
+    if hasattr(value, 'dict'):
+        return value.dict(by_alias=True, exclude_unset=True, exclude_none=True)
 
-        return await db_ref[self.__collection__].update_one(
-            {'_id': self.id}, {'$bit': {self.__fields__[field].alias: {'or': value}}}, session=session
-        )
+    if isinstance(value, list):
+        return [_as_document_value(v) for v in value]
 
-    async def remove_bit_flag(self, db_ref: AsyncIOMotorDatabase, field: str, value: int, session=None):
-        if self.id is None:
-            raise ValueError('Cannot add bit flag to this object that has not been committed yet')
+    return value
 
-        if field not in self.__fields__:
-            raise KeyError(f'No such field {field}')
 
-        setattr(self, field, getattr(self, field) & ~value)
+# Pending changes to one stored document. Nothing happens until commit, which applies the changes to the model,
+# validates only the fields that changed and writes everything with a single update_one. Changes to the same field
+# are folded together (the last set/unset wins, bit flag changes are combined into one and/or pair)
+class ChangeSet:
+    def __init__(self, obj: DBase):
+        self.obj = obj
+        self.sets = {}
+        self.unsets = set()
+        self.bits = {}
+        self.pushes = {}
 
-        validate(self)
+    def _field(self, field: str) -> ModelField:
+        if field not in self.obj.__fields__:
+            raise KeyError(f'{field} is not a field of {self.obj.__class__.__name__}')
 
-        return await db_ref[self.__collection__].update_one(
-            {'_id': self.id}, {'$bit': {self.__fields__[field].alias: {'and': ~value}}}, session=session
-        )
+        return self.obj.__fields__[field]
 
-    async def append_to_array_field(self, db_ref: AsyncIOMotorDatabase, field: str, value: Any, session=None):
-        if self.id is None:
+    def set(self, field: str, value: Any) -> 'ChangeSet':
+        self._field(field)
+        self.unsets.discard(field)
+        self.sets[field] = value
+        return self
+
+    def unset(self, field: str) -> 'ChangeSet':
+        self._field(field)
+        self.sets.pop(field, None)
+        self.unsets.add(field)
+        return self
+
+    def add_bit_flag(self, field: str, value: int) -> 'ChangeSet':
+        self._field(field)
+        and_mask, or_mask = self.bits.get(field, (-1, 0))
+        self.bits[field] = (and_mask, or_mask | value)
+        return self
+
+    def remove_bit_flag(self, field: str, value: int) -> 'ChangeSet':
+        self._field(field)
+        and_mask, or_mask = self.bits.get(field, (-1, 0))
+        self.bits[field] = (and_mask & ~value, or_mask & ~value)
+        return self
+
+    def push(self, field: str, value: Any) -> 'ChangeSet':
+        self._field(field)
+        self.pushes.setdefault(field, []).append(value)
+        return self
+
+    def _new_values(self) -> dict:
+        touched = [*self.sets, *self.unsets, *self.bits, *self.pushes]
+
+        if len(touched) != len(set(touched)):
+            raise ValueError('A field can only be changed by one kind of update at a time')
+
+        new_values = {field: value for field, value in self.sets.items()}
+        new_values.update({field: None for field in self.unsets})
+
+        for field, (and_mask, or_mask) in self.bits.items():
+            new_values[field] = (getattr(self.obj, field) & and_mask) | or_mask
+
+        for field, values in self.pushes.items():
+            new_values[field] = [*getattr(self.obj, field), *values]
+
+        return new_values
+
+    def _validate(self, new_values: dict):
+        model = self.obj.__class__
+
+        # Root validators look at the whole model, so only skip the full pass when there are none
+        if model.__pre_root_validators__ or model.__post_root_validators__:
+            validate(self.obj)
+            return
+
+        errors = []
+
+        for field, value in new_values.items():
+            _, error = model.__fields__[field].validate(value, self.obj.__dict__, loc=field, cls=model)
+
+            if error:
+                errors.append(error)
+
+        if errors:
+            raise ValidationError(errors, model)
+
+    def update_document(self) -> dict:
+        fields = self.obj.__fields__
+        update = {}
+
+        if self.sets:
+            update['$set'] = {fields[f].alias: _as_document_value(v) for f, v in self.sets.items()}
+
+        if self.unsets:
+            update['$unset'] = {fields[f].alias: '' for f in self.unsets}
+
+        bits = {}
+
+        for field, (and_mask, or_mask) in self.bits.items():
+            ops = {}
+
+            # $bit runs these in order, which is what the masks were folded for
+            if and_mask != -1:
+                ops['and'] = and_mask
+
+            if or_mask != 0:
+                ops['or'] = or_mask
+
+            if ops:
+                bits[fields[field].alias] = ops
+
+        if bits:
+            update['$bit'] = bits
+
+        if self.pushes:
+            update['$push'] = {fields[f].alias: {'$each': _as_document_value(v)} for f, v in self.pushes.items()}
+
+        return update
+
+    # Validates and applies the changes to the model, returns the update for the database
+    def apply(self) -> dict:
+        new_values = self._new_values()
+        old_values = {field: getattr(self.obj, field) for field in new_values}
+
+        for field, value in new_values.items():
+            setattr(self.obj, field, value)
+
+        try:
+            self._validate(new_values)
+        except ValidationError:
+            for field, value in old_values.items():
+                setattr(self.obj, field, value)
+            raise
+
+        return self.update_document()
+
+    async def commit(self, db_ref: AsyncIOMotorDatabase, session=None) -> Optional[UpdateResult]:
+        if self.obj.id is None:
             raise ValueError('Cannot modify a document that has not yet been committed.')
 
-        if field not in self.__fields__:
-            raise KeyError(f'No such field {field}')
+        update = self.apply()
 
-        arr = getattr(self, field)
+        if not update:
+            return None
 
-        arr.append(value)
+        return await db_ref[self.obj.__collection__].update_one({'_id': self.obj.id}, update, session=session)
 
-        setattr(self, field, arr)
+    # Like commit, but writes with find_one_and_update and reloads the model from the stored result, so it also reflects
+    # changes made by anyone else in the meantime. Returns False if the document no longer exists
+    async def commit_and_reload(self, db_ref: AsyncIOMotorDatabase, session=None) -> bool:
+        if self.obj.id is None:
+            raise ValueError('Cannot modify a document that has not yet been committed.')
 
-        validate(self)
+        update = self.apply()
 
-        if hasattr(value, 'dict'):
-            value = value.dict(by_alias=True, exclude_unset=True, exclude_none=True)
+        if not update:
+            return True
 
-        return await db_ref[self.__collection__].update_one(
-            {'_id': self.id}, {'$push': {self.__fields__[field].alias: value}}
+        doc = await db_ref[self.obj.__collection__].find_one_and_update(
+            {'_id': self.obj.id}, update, return_document=ReturnDocument.AFTER, session=session
         )
+
+        if doc is None:
+            return False
+
+        fresh = self.obj.load_document(doc)
+        object.__setattr__(self.obj, '__dict__', fresh.__dict__)
+        object.__setattr__(self.obj, '__fields_set__', fresh.__fields_set__)
+
+        return True
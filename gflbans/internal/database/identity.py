@@ -0,0 +1,81 @@
+from typing import Iterable, List, Optional, Set, Tuple
+
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from pymongo import UpdateOne
+
+from gflbans.internal.config import ALT_SEARCH_MAX_IDENTITIES
+from gflbans.internal.database.base import DBase
+
+
+# One edge between a player and an IP they were seen on, either from an infraction or a heartbeat. The alt search
+# walks these instead of re-deriving the graph from the infractions on every request
+class DIdentityLink(DBase):
+    __collection__ = 'identity_links'
+
+    gs_service: str
+    gs_id: str
+    ip: str
+    first_seen: int
+    last_seen: int
+
+
+async def record_identity_links(db_ref: AsyncIOMotorDatabase, links: Iterable[Tuple[str, str, str]], seen: int):
+    await record_identity_links_at(db_ref, [(gs_service, gs_id, ip, seen) for gs_service, gs_id, ip in links])
+
+
+# Same, but every link has its own time, links are (gs_service, gs_id, ip, seen)
+async def record_identity_links_at(db_ref: AsyncIOMotorDatabase, links: Iterable[Tuple[str, str, str, int]]):
+    ops = [
+        UpdateOne(
+            {'gs_id': gs_id, 'ip': ip, 'gs_service': gs_service},
+            {'$min': {'first_seen': seen}, '$max': {'last_seen': seen}},
+            upsert=True,
+        )
+        for gs_service, gs_id, ip, seen in set(links)
+        if gs_service and gs_id and ip
+    ]
+
+    if ops:
+        await db_ref[DIdentityLink.__collection__].bulk_write(ops, ordered=False)
+
+
+# Breadth first walk over the links. depth counts the starting identifiers as the first level, like the old recursive
+# search did. Stops growing once ALT_SEARCH_MAX_IDENTITIES is reached so a shared IP can't pull in the whole database
+async def linked_identities(
+    db_ref: AsyncIOMotorDatabase,
+    gs_ids: List[str],
+    ips: List[str],
+    depth: int,
+    max_identities: Optional[int] = ALT_SEARCH_MAX_IDENTITIES,
+) -> Tuple[Set[str], Set[str]]:
+    found_ids, found_ips = set(gs_ids), set(ips)
+    frontier_ids, frontier_ips = set(found_ids), set(found_ips)
+
+    for _ in range(depth - 1):
+        if not frontier_ids and not frontier_ips:
+            break
+
+        if max_identities is not None and len(found_ids) + len(found_ips) >= max_identities:
+            break
+
+        conds = []
+
+        if frontier_ids:
+            conds.append({'gs_id': {'$in': list(frontier_ids)}})
+
+        if frontier_ips:
+            conds.append({'ip': {'$in': list(frontier_ips)}})
+
+        frontier_ids, frontier_ips = set(), set()
+
+        async for link in db_ref[DIdentityLink.__collection__].find({'$or': conds}, {'_id': 0, 'gs_id': 1, 'ip': 1}):
+            if link['gs_id'] not in found_ids:
+                frontier_ids.add(link['gs_id'])
+
+            if link['ip'] not in found_ips:
+                frontier_ips.add(link['ip'])
+
+        found_ids |= frontier_ids
+        found_ips |= frontier_ips
+
+    return found_ids, found_ips
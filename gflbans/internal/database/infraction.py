@@ -3,6 +3,7 @@ from typing import Dict, Optional, Union
 
 from bson import ObjectId
 from dateutil.tz import UTC
+from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import BaseModel, PositiveInt, conint, conlist, constr
 
 from gflbans.internal.constants import SERVER_KEY
@@ -123,6 +124,10 @@ def build_query_dict(
     return f
 
 
+# For views that only summarise infractions. Skips the comment and file threads, which can be hundreds of entries each
+INFRACTION_SUMMARY_PROJECTION = {'comments': 0, 'files': 0}
+
+
 class DInfraction(DBase):
     __collection__ = 'infractions'
 
@@ -151,3 +156,14 @@ class DInfraction(DBase):
     # Web attributes
     comments: conlist(DComment, max_items=255) = []
     files: conlist(DFile, max_items=255) = []
+
+    # Present if imported, the id in the system it came from
+    import_ref: Optional[str]
+
+    @classmethod
+    async def flag_vpn_ip(cls, db_ref: AsyncIOMotorDatabase, ip: str) -> int:
+        ur = await db_ref[cls.__collection__].update_many(
+            {'ip': ip, 'flags': {'$bitsAllClear': INFRACTION_VPN}}, {'$bit': {'flags': {'or': INFRACTION_VPN}}}
+        )
+
+        return ur.modified_count
@@ -18,6 +18,14 @@ class DUserIP(DUser):
     ip: Optional[str]
 
 
+# Messages starting with one of these are chat commands (e.g. !rtv or /calladmin)
+CHAT_COMMAND_PREFIXES = ('!', '/')
+
+
+def is_chat_command(content: str) -> bool:
+    return content.startswith(CHAT_COMMAND_PREFIXES)
+
+
 class DChatLog(DBase):
     __collection__ = 'chat_logs'
 
@@ -25,6 +33,7 @@ class DChatLog(DBase):
     server: ObjectId
     user: Optional[DUserIP]
     content: str
+    is_command: bool = False  # Set at ingestion so command filtering can use an index
 
 
 class DServerInfo(BaseModel):
@@ -41,6 +50,7 @@ class DServerInfo(BaseModel):
 class DCallData(BaseModel):
     claim_token: str
     call_info: ExecuteCallAdmin
+    channel_id: Optional[str]  # Channel the webhook posted to, looked up once by the claim watcher
 
 
 class DServer(DBase):
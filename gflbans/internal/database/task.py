@@ -1,11 +1,43 @@
+import os
 from datetime import datetime
+from typing import List, Optional, Tuple
 
 from dateutil.tz import UTC
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pydantic import PositiveInt, conint
+from pymongo import ASCENDING, DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from gflbans.internal import shard
+from gflbans.internal.config import MONGO_DB
 from gflbans.internal.database.base import DBase
 from gflbans.internal.log import logger
+from gflbans.internal.pubsub import publish
+
+# Redis channel that task schedulers on every shard listen on to wake up when new work is queued
+TASK_NOTIFY_CHANNEL = 'gflbans::task_queue'
+
+# Due tasks of the same type are claimed highest priority first
+PRIORITY_HIGH = 10
+PRIORITY_NORMAL = 0
+PRIORITY_LOW = -10
+
+
+def _claimable(ev_handler: str, now: float) -> dict:
+    # A task can be claimed once it is due and nobody holds a live lease on it
+    return {
+        'ev_handler': ev_handler,
+        'run_at': {'$lte': now},
+        '$or': [{'lease_expires': None}, {'lease_expires': {'$lte': now}}],
+    }
+
+
+def _dedup_update(ev_handler: str, task_data: dict, run_at: float, priority: int) -> dict:
+    return {
+        '$setOnInsert': {'ev_handler': ev_handler, 'task_data': task_data, 'failure_count': 0},
+        '$min': {'run_at': int(run_at)},
+        '$max': {'priority': priority},
+    }
 
 
 class DTask(DBase):
@@ -15,20 +47,183 @@ class DTask(DBase):
     failure_count: conint(ge=0) = 0
     task_data: dict
     ev_handler: str
+    priority: int = PRIORITY_NORMAL
+
+    # Only one pending task can have a given key. It's moved to claimed_key when the task is claimed, so the same work
+    # can be queued again while it runs, and put back if the task is rescheduled
+    dedup_key: Optional[str]
+    claimed_key: Optional[str]
+
+    # Set while a scheduler is working on the task. If the worker dies, the lease expires and the task is retried
+    lease_owner: Optional[str]
+    lease_expires: Optional[float]
+
+    @classmethod
+    async def claim_tasks(
+        cls, db_ref: AsyncIOMotorDatabase, ev_handler: str, limit: int, lease_time: int
+    ) -> List['DTask']:
+        now = datetime.now(tz=UTC).timestamp()
+        query = _claimable(ev_handler, now)
+
+        candidates = (
+            await db_ref[cls.__collection__]
+            .find(query, {'_id': 1})
+            .sort([('priority', DESCENDING), ('run_at', ASCENDING)])
+            .limit(limit)
+            .to_list(limit)
+        )
+
+        if not candidates:
+            return []
+
+        # The filter is re-evaluated per document, so tasks another shard grabbed in the meantime are skipped
+        token = f'{shard[:16]}:{os.urandom(8).hex()}'
+        await db_ref[cls.__collection__].update_many(
+            {**query, '_id': {'$in': [c['_id'] for c in candidates]}},
+            {
+                '$set': {'lease_owner': token, 'lease_expires': now + lease_time},
+                '$rename': {'dedup_key': 'claimed_key'},
+            },
+        )
+
+        tasks = [cls.load_document(doc) async for doc in db_ref[cls.__collection__].find({'lease_owner': token})]
+
+        logger.debug(f'Claimed {len(tasks)} {ev_handler} task(s) from the task queue')
+
+        return tasks
+
+    # Returns False if a pending task with the same dedup key absorbed this one. It then runs at the earlier of the two
+    # times with the higher of the two priorities, but keeps its own task_data
+    @classmethod
+    async def enqueue(
+        cls,
+        db_ref: AsyncIOMotorDatabase,
+        ev_handler: str,
+        task_data: dict,
+        run_at: float,
+        priority: int = PRIORITY_NORMAL,
+        dedup_key: Optional[str] = None,
+    ) -> bool:
+        if dedup_key is None:
+            await cls(run_at=run_at, task_data=task_data, ev_handler=ev_handler, priority=priority).commit(db_ref)
+            return True
+
+        try:
+            ur = await db_ref[cls.__collection__].update_one(
+                {'dedup_key': dedup_key}, _dedup_update(ev_handler, task_data, run_at, priority), upsert=True
+            )
+        except DuplicateKeyError:
+            # Another shard inserted the same task between our lookup and insert
+            return False
+
+        return ur.upserted_id is not None
 
+    # Like enqueue for many deduplicated tasks at once, tasks are (ev_handler, task_data, dedup_key). Returns how many
+    # were new
     @classmethod
-    async def pop_next_task(cls, db_ref: AsyncIOMotorDatabase):
-        task = await db_ref[cls.__collection__].find_one_and_delete(
-            {'run_at': {'$lte': datetime.now(tz=UTC).timestamp()}}
+    async def enqueue_many(
+        cls,
+        db_ref: AsyncIOMotorDatabase,
+        tasks: List[Tuple[str, dict, str]],
+        run_at: float,
+        priority: int = PRIORITY_NORMAL,
+    ) -> int:
+        if not tasks:
+            return 0
+
+        ops = [
+            UpdateOne({'dedup_key': key}, _dedup_update(ev_handler, data, run_at, priority), upsert=True)
+            for ev_handler, data, key in tasks
+        ]
+
+        try:
+            result = await db_ref[cls.__collection__].bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            if any(err['code'] != 11000 for err in e.details['writeErrors']):
+                raise
+
+            return e.details['nUpserted']
+
+        return result.upserted_count
+
+    @classmethod
+    async def next_run_at(cls, db_ref: AsyncIOMotorDatabase, ev_handlers: List[str]) -> Optional[float]:
+        doc = await db_ref[cls.__collection__].find_one(
+            {
+                'ev_handler': {'$in': ev_handlers},
+                '$or': [{'lease_expires': None}, {'lease_expires': {'$lte': datetime.now(tz=UTC).timestamp()}}],
+            },
+            {'run_at': 1},
+            sort=[('run_at', ASCENDING)],
         )
 
-        if task is None:
-            return None  # no task
+        return None if doc is None else doc['run_at']
+
+    async def renew_lease(self, db_ref: AsyncIOMotorDatabase, lease_time: int) -> bool:
+        self.lease_expires = datetime.now(tz=UTC).timestamp() + lease_time
+
+        ur = await db_ref[self.__collection__].update_one(
+            {'_id': self.id, 'lease_owner': self.lease_owner}, {'$set': {'lease_expires': self.lease_expires}}
+        )
+
+        return ur.modified_count > 0
+
+    async def complete(self, db_ref: AsyncIOMotorDatabase):
+        # Only delete if we still own the lease, otherwise someone else is (re)running it
+        await db_ref[self.__collection__].delete_one({'_id': self.id, 'lease_owner': self.lease_owner})
+
+    async def reschedule(self, db_ref: AsyncIOMotorDatabase, run_at: float, count_failure: bool = True):
+        self.run_at = run_at
+
+        if count_failure:
+            self.failure_count += 1
+
+        update = {
+            '$set': {'run_at': self.run_at, 'failure_count': self.failure_count},
+            '$unset': {'lease_owner': '', 'lease_expires': ''},
+        }
+
+        if self.claimed_key is not None:
+            update['$set']['dedup_key'] = self.claimed_key
+            update['$unset']['claimed_key'] = ''
+
+        try:
+            await db_ref[self.__collection__].update_one({'_id': self.id, 'lease_owner': self.lease_owner}, update)
+        except DuplicateKeyError:
+            # The same work was queued again while this ran, that task takes over
+            await db_ref[self.__collection__].delete_one({'_id': self.id, 'lease_owner': self.lease_owner})
+            logger.debug(f'Dropped rescheduled task {str(self.id)}, {self.claimed_key} was queued again meanwhile')
+        else:
+            self.dedup_key, self.claimed_key = self.claimed_key, None
+
+        self.lease_owner = None
+        self.lease_expires = None
+
+
+async def notify_task_queue(app):
+    # Schedulers fall back to periodically checking the queue if this is missed
+    await publish(app.state.redis_client, TASK_NOTIFY_CHANNEL)
+
+
+# Durable replacement for BackgroundTasks, the task survives the worker that queued it and runs on whichever shard has
+# a free slot for its type
+async def queue_task(
+    app,
+    ev_handler: str,
+    task_data: dict,
+    delay: float = 0,
+    priority: int = PRIORITY_NORMAL,
+    dedup_key: Optional[str] = None,
+):
+    run_at = datetime.now(tz=UTC).timestamp() + delay
+
+    if await DTask.enqueue(app.state.db[MONGO_DB], ev_handler, task_data, run_at, priority, dedup_key):
+        await notify_task_queue(app)
 
-        logger.debug(f'Popped task {str(task["_id"])} from the task queue')
 
-        # kill the task id since it was deleted
-        dtask = cls.load_document(task)
-        dtask.id = None
+# Many deduplicated tasks in one round trip, tasks are (ev_handler, task_data, dedup_key)
+async def queue_tasks(app, tasks: List[Tuple[str, dict, str]], delay: float = 0, priority: int = PRIORITY_NORMAL):
+    run_at = datetime.now(tz=UTC).timestamp() + delay
 
-        return dtask
+    if await DTask.enqueue_many(app.state.db[MONGO_DB], tasks, run_at, priority):
+        await notify_task_queue(app)
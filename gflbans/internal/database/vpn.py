@@ -1,6 +1,3 @@
-from motor.motor_asyncio import AsyncIOMotorDatabase
-from netaddr import IPAddress, IPNetwork
-
 from gflbans.internal.database.base import DBase
 
 
@@ -12,13 +9,3 @@ class DVPN(DBase):
     payload: str  # ASN if is_asn is true, CIDR otherwise
     comment: str = 'NO COMMENT'
     added_on: int
-
-    @classmethod
-    async def find_cidr_rule(cls, db_ref: AsyncIOMotorDatabase, ip: IPAddress):
-        async for doc in db_ref[cls.__collection__].find({'is_asn': False}):
-            a = cls.load_document(doc)
-
-            if ip in IPNetwork(a.payload):
-                return a
-
-        return None
@@ -7,13 +7,24 @@ from datetime import datetime
 from typing import Optional
 
 import PIL
-from bson.objectid import ObjectId
 from dateutil.tz import UTC
 from fastapi import HTTPException
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from PIL import Image
 
-from gflbans.internal.config import BRANDING, COMMUNITY_ICON, DISCORD_BOT_TOKEN, GFLBANS_ICON, HOST, MONGO_DB
+from gflbans.internal import shard
+from gflbans.internal.config import (
+    BRANDING,
+    CALLADMIN_CLAIM_WINDOW,
+    CALLADMIN_IMAGE_MAX_PIXELS,
+    CALLADMIN_POLL_CONCURRENCY,
+    CALLADMIN_POLL_INTERVAL,
+    COMMUNITY_ICON,
+    DISCORD_BOT_TOKEN,
+    GFLBANS_ICON,
+    HOST,
+    MONGO_DB,
+)
 from gflbans.internal.constants import COLOR_SUCCESS, COLOR_WARNING, GB_VERSION
 from gflbans.internal.database.common import DFile
 from gflbans.internal.database.server import DCallData, DServer
@@ -59,7 +70,7 @@ def fn(srv):
         return srv.ip
 
 
-async def execute_webhook(app, srv: DServer, call: ExecuteCallAdmin, image: Optional[DFile] = None):
+def calladmin_embed(srv: DServer, call: ExecuteCallAdmin, image: Optional[DFile] = None) -> dict:
     embed_info = {
         'color': COLOR_WARNING,
         'timestamp': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
@@ -114,6 +125,12 @@ async def execute_webhook(app, srv: DServer, call: ExecuteCallAdmin, image: Opti
             }
         )
 
+    return embed_info
+
+
+async def execute_webhook(app, srv: DServer, call: ExecuteCallAdmin, image: Optional[DFile] = None):
+    embed_info = calladmin_embed(srv, call, image)
+
     bot_name = f'{BRANDING}'
     bot_avatar = COMMUNITY_ICON
 
@@ -151,6 +168,11 @@ calladmin_thread_pool = ProcessPoolExecutor(max_workers=1)
 
 def sync_process_calladmin_image(image: bytes):
     image = Image.open(io.BytesIO(image))
+
+    # Opening only reads the header, so oversized images are refused before they are decoded
+    if image.width * image.height > CALLADMIN_IMAGE_MAX_PIXELS:
+        raise ValueError(f'Call admin image is too large ({image.width}x{image.height})')
+
     # This functionality is almost exclusively for unturned
     # so we're gonna kneecap the res here to what unturned gives us
     image = image.resize((640, 480), resample=PIL.Image.LANCZOS)
@@ -164,22 +186,41 @@ def sync_process_calladmin_image(image: bytes):
     return new_bytes
 
 
-# request context only
 async def prepare_calladmin_image(db_ref, image: str) -> DFile:
+    decoded = base64.b64decode(image)
+
+    converted = await asyncio.get_running_loop().run_in_executor(
+        calladmin_thread_pool, sync_process_calladmin_image, decoded
+    )
+
+    file_id = await AsyncIOMotorGridFSBucket(database=db_ref).upload_from_stream(
+        'callimg.webp', converted, metadata={'dispose_created': datetime.now(tz=UTC), 'content-type': 'image/webp'}
+    )
+
+    return DFile(gridfs_file=str(file_id), file_name='callimg.webp')
+
+
+# Runs after the call was posted, so the game server doesn't wait on the image. The message is edited to show it
+# once it's ready, unless the call was claimed meanwhile and the claim embed replaced it
+async def attach_calladmin_image(app, server_id, claim_token: str, image: str):
     try:
-        decoded = base64.b64decode(image)
+        file = await prepare_calladmin_image(app.state.db[MONGO_DB], image)
+    except (binascii.Error, PIL.UnidentifiedImageError, Image.DecompressionBombError, ValueError, OSError):
+        logger.warning(f'Discarding the image of call {claim_token}, it could not be processed', exc_info=True)
+        return
 
-        converted = await asyncio.get_running_loop().run_in_executor(
-            calladmin_thread_pool, sync_process_calladmin_image, decoded
-        )
+    srv: DServer = await DServer.from_id(app.state.db[MONGO_DB], server_id)
 
-        file_id = await AsyncIOMotorGridFSBucket(database=db_ref).upload_from_stream(
-            'callimg.webp', converted, metadata={'dispose_created': datetime.now(tz=UTC), 'content-type': 'image/webp'}
-        )
+    if not srv or not srv.discord_webhook or not srv.call_data or srv.call_data.claim_token != claim_token:
+        return
 
-        return DFile(gridfs_file=str(file_id), file_name='callimg.webp')
-    except binascii.Error as e:
-        raise HTTPException(detail='Bad base64 encoded image file', status_code=401) from e
+    async with app.state.aio_session.patch(
+        srv.discord_webhook + f'/messages/{claim_token}',
+        headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
+        json={'embeds': [calladmin_embed(srv, srv.call_data.call_info, file)]},
+    ) as resp:
+        if resp.status >= 400:
+            logger.error(f'Failed to attach the image to call {claim_token}: {resp.status} {await resp.text()}')
 
 
 async def execute_claim(app, srv: DServer, claim: ClaimCallAdmin, call: DCallData):
@@ -236,70 +277,114 @@ async def execute_claim(app, srv: DServer, claim: ClaimCallAdmin, call: DCallDat
             raise HTTPException(detail='Failed to communicate with Discord', status_code=500) from e
 
 
-async def claim_monitor_task(app, server_id: ObjectId, msg_id: str):
-    if not DISCORD_BOT_TOKEN:
-        logger.warning('No discord bot token. Claim monitor is therefore unsupported!')
+# Claims are made by reacting to the call with this emoji (🐭)
+CLAIM_REACTION = '%F0%9F%90%AD'
 
-    logger.debug(f'starting discord msg monitor {msg_id}')
+CLAIM_WATCHER_LEASE = 'gflbans::calladmin_claim_watcher'
 
-    logger.debug('fetching channel id from webhook')
 
-    srv: DServer = await DServer.from_id(app.state.db[MONGO_DB], server_id)
+# One loop for every open call admin request in the network instead of a poller per call. Open calls are read from the
+# servers collection on every tick, so nothing is lost on a restart, and a redis lease makes sure only one shard polls
+# Discord at a time
+class ClaimWatcher:
+    def __init__(self, app):
+        self.app = app
 
-    if not srv or not srv.discord_webhook:
-        logger.error(
-            f'monitor for {msg_id} is dying because there is no server {str(server_id)} exists or no call admin'
-        )
-        return
+    @property
+    def db(self):
+        return self.app.state.db[MONGO_DB]
 
-    async with app.state.aio_session.get(
-        srv.discord_webhook, headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}
-    ) as resp:
-        resp.raise_for_status()
+    async def run(self):
+        if not DISCORD_BOT_TOKEN:
+            logger.warning('No discord bot token. Claiming calls by reaction is therefore unsupported!')
+            return
 
-        j = await resp.json()
+        while True:
+            await asyncio.sleep(CALLADMIN_POLL_INTERVAL)
 
-        channel_id = j['channel_id']
+            try:
+                if await self.hold_lease():
+                    await self.tick()
+            except Exception:
+                logger.error('Call admin claim watcher failed', exc_info=True)
 
-    try:
-        while True:
-            await asyncio.sleep(10)
-            logger.debug(f'tick monitor for {msg_id}')
-
-            srv: DServer = await DServer.from_id(app.state.db[MONGO_DB], server_id)
-
-            if not srv or not srv.discord_webhook:
-                logger.error(
-                    f'monitor for {msg_id} is dying because there is no server {str(server_id)} exists or no call admin'
-                )
-                return
-
-            if not srv.call_data or srv.call_data.claim_token != msg_id:
-                logger.error(f'monitor for {msg_id} is dying because call_data is unset or has a different token')
-                return
-
-            async with app.state.aio_session.get(
-                f'https://discord.com/api/v9/channels/{channel_id}/messages/{msg_id}/reactions/%F0%9F%90%AD?limit=1',
-                headers={
-                    'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})',
-                    'Authorization': f'Bot {DISCORD_BOT_TOKEN}',
-                },
-            ) as resp:
+    # The lease outlives a few ticks so a shard that stops ticking hands over to another one
+    async def hold_lease(self) -> bool:
+        redis_client = self.app.state.redis_client
+        ttl = CALLADMIN_POLL_INTERVAL * 3
+
+        if await redis_client.set(CLAIM_WATCHER_LEASE, shard, nx=True, ex=ttl):
+            return True
+
+        holder = await redis_client.get(CLAIM_WATCHER_LEASE)
+
+        if holder is not None and holder.decode() == shard:
+            await redis_client.expire(CLAIM_WATCHER_LEASE, ttl)
+            return True
+
+        return False
+
+    async def tick(self):
+        since = datetime.now(tz=UTC).timestamp() - CALLADMIN_CLAIM_WINDOW
+        query = {'call_data': {'$ne': None}, 'discord_webhook': {'$ne': None}, 'last_calladmin': {'$gte': since}}
+
+        servers = [srv async for srv in DServer.from_query(self.db, query)]
+
+        if not servers:
+            return
+
+        logger.debug(f'checking {len(servers)} open calls for a claim')
+
+        sem = asyncio.Semaphore(CALLADMIN_POLL_CONCURRENCY)
+
+        async def check(srv: DServer):
+            async with sem:
                 try:
-                    resp.raise_for_status()
+                    await self.check(srv)
                 except Exception:
-                    logger.error(f'monitor for {msg_id} dying because discord communication failure', exc_info=True)
-                    raise
-
-                j = await resp.json()
-
-                for user in j:
-                    await execute_claim(
-                        app,
-                        srv,
-                        ClaimCallAdmin(admin_name=f'{user["username"]}#{user["discriminator"]}'),
-                        srv.call_data,
-                    )
-                    raise StopIteration
-    except StopIteration:
-        pass
+                    logger.error(f'Failed to check call {srv.call_data.claim_token} for a claim', exc_info=True)
+
+        await asyncio.gather(*[check(srv) for srv in servers])
+
+    async def check(self, srv: DServer):
+        call = srv.call_data
+
+        if call.channel_id is None:
+            async with self.app.state.aio_session.get(
+                srv.discord_webhook, headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}
+            ) as resp:
+                resp.raise_for_status()
+                call.channel_id = (await resp.json())['channel_id']
+
+            await self.db[DServer.__collection__].update_one(
+                {'_id': srv.id, 'call_data.claim_token': call.claim_token},
+                {'$set': {'call_data.channel_id': call.channel_id}},
+            )
+
+        async with self.app.state.aio_session.get(
+            f'https://discord.com/api/v9/channels/{call.channel_id}/messages/{call.claim_token}'
+            f'/reactions/{CLAIM_REACTION}?limit=1',
+            headers={
+                'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})',
+                'Authorization': f'Bot {DISCORD_BOT_TOKEN}',
+            },
+        ) as resp:
+            resp.raise_for_status()
+            users = await resp.json()
+
+        if not users:
+            return
+
+        # Only clear the call if it's still the one we saw, the server may have claimed it or sent a new one meanwhile
+        result = await self.db[DServer.__collection__].update_one(
+            {'_id': srv.id, 'call_data.claim_token': call.claim_token}, {'$set': {'call_data': None}}
+        )
+
+        if result.modified_count == 0:
+            return
+
+        user = users[0]
+
+        await execute_claim(
+            self.app, srv, ClaimCallAdmin(admin_name=f'{user["username"]}#{user["discriminator"]}'), call
+        )
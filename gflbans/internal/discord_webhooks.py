@@ -0,0 +1,213 @@
+import asyncio
+from collections import deque
+from contextlib import suppress
+from datetime import datetime
+from typing import Deque, Dict, List
+
+from aiohttp import ClientError
+from dateutil.tz import UTC
+
+from gflbans.internal.config import BRANDING, HOST, WEBHOOK_MAX_ATTEMPTS, WEBHOOK_QUEUE_LIMIT
+from gflbans.internal.constants import GB_VERSION
+from gflbans.internal.errors import WebhookError, WebhookRateLimited, WebhookRejected
+from gflbans.internal.log import logger
+
+# Discord limits for a single webhook message
+MAX_EMBEDS = 10
+MAX_EMBED_CHARS = 6000
+
+
+def _now() -> float:
+    return datetime.now(tz=UTC).timestamp()
+
+
+# Characters Discord counts towards the 6000 character limit of a message
+def _embed_chars(embed: dict) -> int:
+    n = len(embed.get('title', '')) + len(embed.get('description', ''))
+    n += len(embed.get('author', {}).get('name', '')) + len(embed.get('footer', {}).get('text', ''))
+
+    for field in embed.get('fields', []):
+        n += len(field.get('name', '')) + len(str(field.get('value', '')))
+
+    return n
+
+
+class _Pending:
+    def __init__(self, message: dict):
+        self.message = message
+        self.attempts = 0
+        self.split = False  # Failed as part of a merged message, send it on its own
+        self.result = asyncio.get_running_loop().create_future()
+
+    def finish(self, handled: bool):
+        if not self.result.done():
+            self.result.set_result(handled)
+
+
+# Posts webhook messages in the background, one worker per webhook url. Queued messages from the same sender are
+# merged into one message of up to 10 embeds, Discord's rate limit headers are respected per webhook and globally, and
+# failed posts are retried with backoff. Nothing is persisted, messages still queued when the worker exits are lost.
+# send returns a future for callers that need to know, it resolves to True once Discord accepted or rejected the
+# message and to False if it was dropped before that (full queue, out of attempts or shutdown)
+class WebhookDispatcher:
+    def __init__(self, app):
+        self.app = app
+        self.queues: Dict[str, Deque[_Pending]] = {}
+        self.workers: Dict[str, asyncio.Task] = {}
+        self.global_until = 0.0
+
+    def send(self, url: str, message: dict) -> asyncio.Future:
+        queue = self.queues.setdefault(url, deque())
+
+        if len(queue) >= WEBHOOK_QUEUE_LIMIT:
+            queue.popleft().finish(False)
+            logger.warning(f'Webhook queue is full, dropped the oldest message for {url}')
+
+        pending = _Pending(message)
+        queue.append(pending)
+
+        if url not in self.workers or self.workers[url].done():
+            self.workers[url] = asyncio.get_running_loop().create_task(self.run(url))
+
+        return pending.result
+
+    def _next_batch(self, queue: Deque[_Pending]) -> List[_Pending]:
+        batch = [queue.popleft()]
+
+        if batch[0].split:
+            return batch
+
+        first = batch[0].message
+        chars = sum(_embed_chars(e) for e in first.get('embeds', []))
+        count = len(first.get('embeds', []))
+
+        while queue and not queue[0].split:
+            msg = queue[0].message
+
+            # Only embeds can be merged, and only between messages that look the same otherwise
+            if (
+                'content' in msg
+                or 'content' in first
+                or msg.get('username') != first.get('username')
+                or msg.get('avatar_url') != first.get('avatar_url')
+            ):
+                break
+
+            embeds = msg.get('embeds', [])
+            more_chars = sum(_embed_chars(e) for e in embeds)
+
+            if count + len(embeds) > MAX_EMBEDS or chars + more_chars > MAX_EMBED_CHARS:
+                break
+
+            batch.append(queue.popleft())
+            count += len(embeds)
+            chars += more_chars
+
+        return batch
+
+    async def run(self, url: str):
+        queue = self.queues[url]
+
+        while queue:
+            batch = self._next_batch(queue)
+
+            message = dict(batch[0].message)
+            message['embeds'] = [e for p in batch for e in p.message.get('embeds', [])]
+
+            wait = max(self.global_until - _now(), 0)
+
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+            try:
+                wait = await self.post(url, message)
+            except WebhookRateLimited as e:
+                queue.extendleft(reversed(batch))
+                wait = e.retry_after
+            except Exception as e:
+                wait = self.requeue_failed(queue, batch, e)
+            else:
+                for p in batch:
+                    p.finish(True)
+
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+        # Nothing was awaited since the queue was last checked, so no message can be stuck in it
+        self.queues.pop(url, None)
+        self.workers.pop(url, None)
+
+    # Puts a failed batch back in front of the queue, returns how long to back off for
+    def requeue_failed(self, queue: Deque[_Pending], batch: List[_Pending], e: Exception) -> float:
+        # One of the merged embeds is probably bad, retry them one by one so only that one is lost
+        if isinstance(e, WebhookRejected) and len(batch) > 1:
+            for p in reversed(batch):
+                p.split = True
+                queue.appendleft(p)
+
+            return 0
+
+        requeued = False
+
+        for p in reversed(batch):
+            p.attempts += 1
+
+            if isinstance(e, WebhookRejected):
+                logger.error(f'Discord rejected a webhook message: {e}')
+                p.finish(True)
+            elif p.attempts >= WEBHOOK_MAX_ATTEMPTS:
+                logger.error(f'Giving up on a webhook message after {p.attempts} attempts', exc_info=e)
+                p.finish(False)
+            else:
+                queue.appendleft(p)
+                requeued = True
+
+        # Nothing to back off for when the batch was dropped
+        if not requeued:
+            return 0
+
+        return 2 ** min(batch[0].attempts, 6)
+
+    # Returns how long to wait before the next request to this webhook
+    async def post(self, url: str, message: dict) -> float:
+        try:
+            async with self.app.state.aio_session.post(
+                url + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=message
+            ) as resp:
+                if resp.status == 429:
+                    data = {}
+
+                    with suppress(Exception):
+                        data = await resp.json()
+
+                    retry_after = float(data.get('retry_after', resp.headers.get('Retry-After', 1)))
+
+                    if data.get('global') or resp.headers.get('X-RateLimit-Global'):
+                        self.global_until = _now() + retry_after
+
+                    raise WebhookRateLimited(retry_after)
+
+                if resp.status >= 500:
+                    raise WebhookError(f'Discord returned {resp.status}')
+
+                if resp.status >= 400:
+                    raise WebhookRejected(f'{resp.status}: {await resp.text()}')
+
+                if resp.headers.get('X-RateLimit-Remaining') == '0':
+                    return float(resp.headers.get('X-RateLimit-Reset-After', 0))
+
+                return 0
+        except ClientError as e:
+            raise WebhookError(str(e)) from e
+
+    # Gives queued messages a moment to go out when the app is shutting down
+    async def close(self, timeout: float = 5):
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+
+        for task in list(self.workers.values()):
+            task.cancel()
+
+        for queue in self.queues.values():
+            for p in queue:
+                p.finish(False)
@@ -12,3 +12,22 @@ class SearchError(Exception):
 
 class DatabaseIntegrityException(Exception):
     pass
+
+
+class IPLookupError(Exception):
+    pass
+
+
+class WebhookError(Exception):
+    pass
+
+
+# Discord refused the message itself (4xx), sending it again won't help
+class WebhookRejected(WebhookError):
+    pass
+
+
+class WebhookRateLimited(WebhookError):
+    def __init__(self, retry_after: float):
+        super().__init__(f'Rate limited for {retry_after}s')
+        self.retry_after = retry_after
@@ -0,0 +1,38 @@
+import base64
+from typing import AsyncIterator, List, Tuple
+
+import orjson
+from bson import ObjectId
+from bson.errors import InvalidId
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+
+# Exports are ordered by (created, _id), so the position of the last row sent is enough to carry on from
+def encode_cursor(created: int, obj_id: ObjectId) -> str:
+    return base64.urlsafe_b64encode(orjson.dumps([created, str(obj_id)])).decode()
+
+
+def decode_cursor(token: str) -> Tuple[int, ObjectId]:
+    try:
+        created, obj_id = orjson.loads(base64.urlsafe_b64decode(token.encode()))
+        return int(created), ObjectId(obj_id)
+    except (ValueError, TypeError, InvalidId) as e:
+        raise ValueError('Invalid cursor') from e
+
+
+def export_sort(sort_dir: int) -> List[Tuple[str, int]]:
+    return [('created', sort_dir), ('_id', sort_dir)]
+
+
+# Raises ValueError if the token is bad
+def resume_after(query: dict, token: str, sort_dir: int) -> dict:
+    created, obj_id = decode_cursor(token)
+    op = '$lt' if sort_dir < 0 else '$gt'
+
+    return {'$and': [query, {'$or': [{'created': {op: created}}, {'created': created, '_id': {op: obj_id}}]}]}
+
+
+async def ndjson_lines(rows: AsyncIterator[dict]):
+    async for row in rows:
+        yield orjson.dumps(row) + b'\n'
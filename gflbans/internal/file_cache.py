@@ -0,0 +1,104 @@
+import asyncio
+import os
+from contextlib import suppress
+from typing import Dict, Optional
+
+from bson import ObjectId
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+
+from gflbans.internal.config import FILE_CACHE_MAX_SIZE, MONGO_DB
+from gflbans.internal.log import logger
+
+
+# Local copies of recently served GridFS files. GridFS files never change once written, so a copy is valid for as
+# long as the file exists. The directory can be shared between workers, least recently served files are evicted first
+class FileCache:
+    def __init__(self, directory: str, max_size: int = FILE_CACHE_MAX_SIZE):
+        os.makedirs(directory, exist_ok=True)
+
+        self.directory = directory
+        self.max_size = max_size
+        self.inflight: Dict[ObjectId, asyncio.Task] = {}
+
+    def path(self, file_id: ObjectId) -> str:
+        return os.path.join(self.directory, str(file_id))
+
+    def get(self, file_id: ObjectId) -> Optional[str]:
+        path = self.path(file_id)
+
+        try:
+            # Bump the mtime so eviction sees it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        return path
+
+    # Copies the file to disk in the background, the request that missed is served from GridFS meanwhile
+    def fill(self, app, fos):
+        # Don't let one huge file push everything else out
+        if fos.length > self.max_size // 4 or fos._id in self.inflight:
+            return
+
+        task = asyncio.get_running_loop().create_task(self._fill(app, fos._id))
+        self.inflight[fos._id] = task
+        task.add_done_callback(lambda _: self.inflight.pop(fos._id, None))
+
+    async def _fill(self, app, file_id: ObjectId):
+        loop = asyncio.get_running_loop()
+        path = self.path(file_id)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        try:
+            fos = await AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB]).open_download_stream(file_id)
+
+            f = await loop.run_in_executor(None, open, tmp_path, 'wb')
+
+            try:
+                while fos.tell() < fos.length:
+                    await loop.run_in_executor(None, f.write, await fos.readchunk())
+            finally:
+                await loop.run_in_executor(None, f.close)
+
+            os.replace(tmp_path, path)
+        except Exception:
+            logger.warning(f'Failed to copy GridFS file {file_id} to the file cache', exc_info=True)
+
+            with suppress(FileNotFoundError):
+                os.remove(tmp_path)
+
+            return
+
+        await loop.run_in_executor(None, self.evict)
+
+    def evict(self):
+        entries = []
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp') or not entry.is_file():
+                    continue
+
+                with suppress(FileNotFoundError):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+
+        if total <= self.max_size:
+            return
+
+        entries.sort()
+
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+
+            with suppress(FileNotFoundError):
+                os.remove(path)
+
+            total -= size
+
+    def discard(self, file_id: ObjectId):
+        with suppress(FileNotFoundError):
+            os.remove(self.path(file_id))
@@ -1,4 +1,12 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from bson import ObjectId
+from gridfs import NoFile
 from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response, StreamingResponse
 
 from gflbans.internal.config import HOST, MONGO_DB
 from gflbans.internal.log import logger
@@ -26,3 +34,172 @@ async def save_to_gridfs(app, name, contents):
     except Exception:
         logger.error('Error while uploading a file to gridfs!', exc_info=True)
         raise
+
+
+# GridFS files never change once written, so the id (plus the format for a converted copy) is a strong validator
+def gridfs_etag(fos, fmt: Optional[str] = None) -> str:
+    if fmt is not None:
+        return f'"{fos._id}.{fmt}"'
+
+    return f'"{fos._id}"'
+
+
+def gridfs_last_modified(fos) -> datetime:
+    upload_date = fos.upload_date
+
+    # PyMongo hands back naive UTC datetimes unless the client is tz aware
+    if upload_date.tzinfo is None:
+        upload_date = upload_date.replace(tzinfo=timezone.utc)
+    else:
+        upload_date = upload_date.astimezone(timezone.utc)
+
+    return upload_date.replace(microsecond=0)
+
+
+def validator_headers(etag: str, last_modified: datetime) -> Dict[str, str]:
+    return {'ETag': etag, 'Last-Modified': format_datetime(last_modified, usegmt=True)}
+
+
+def is_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    if_none_match = request.headers.get('if-none-match')
+
+    # If-None-Match takes precedence over If-Modified-Since when both are sent (RFC 9110 13.1.3)
+    if if_none_match is not None:
+        tags = [t.strip().removeprefix('W/') for t in if_none_match.split(',')]
+        return '*' in tags or etag in tags
+
+    if_modified_since = request.headers.get('if-modified-since')
+
+    if if_modified_since is not None:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+
+    return False
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+# Returns the single (start, end) byte range the client wants, end exclusive, or None for the whole file. Multiple
+# ranges are answered with the whole file, which RFC 9110 allows
+def requested_range(request: Request, length: int, etag: str, last_modified: str) -> Optional[Tuple[int, int]]:
+    range_header = request.headers.get('range')
+
+    if range_header is None:
+        return None
+
+    # The client's copy is outdated, send it the whole thing
+    if_range = request.headers.get('if-range')
+    if if_range is not None and if_range != etag and if_range != last_modified:
+        return None
+
+    units, _, spec = range_header.partition('=')
+
+    if units.strip() != 'bytes' or ',' in spec:
+        return None
+
+    first, _, last = spec.strip().partition('-')
+
+    try:
+        if first == '':
+            # Suffix range, the last n bytes
+            suffix = int(last)
+            if suffix == 0:
+                raise RangeNotSatisfiable()
+            return max(length - suffix, 0), length
+
+        start = int(first)
+        end = min(int(last) + 1, length) if last != '' else length
+    except ValueError:
+        return None
+
+    if start >= length:
+        raise RangeNotSatisfiable()
+
+    if end <= start:
+        return None
+
+    return start, end
+
+
+async def gridfs_read(fos, start: int = 0, end: Optional[int] = None):
+    if end is None:
+        end = fos.length
+
+    if start:
+        fos.seek(start)
+
+    remaining = end - fos.tell()
+
+    while remaining > 0:
+        chunk = await fos.readchunk()
+
+        if not chunk:
+            break
+
+        chunk = chunk[:remaining]
+        remaining -= len(chunk)
+
+        yield chunk
+
+
+# Serves a GridFS file, from the local file cache when it has a copy. Handles Range requests either way
+async def serve_gridfs(request: Request, fos, media_type: str, headers: Dict[str, str]) -> Response:
+    headers = {**headers, 'Accept-Ranges': 'bytes'}
+    file_cache = request.app.state.file_cache
+
+    if file_cache is not None:
+        path = file_cache.get(fos._id)
+
+        if path is not None:
+            # Starlette handles Range/If-Range itself and hands the path to the server when it supports pathsend
+            return FileResponse(path, media_type=media_type, headers=headers)
+
+        file_cache.fill(request.app, fos)
+
+    try:
+        byte_range = requested_range(request, fos.length, headers['ETag'], headers['Last-Modified'])
+    except RangeNotSatisfiable:
+        return Response(status_code=416, headers={**headers, 'Content-Range': f'bytes */{fos.length}'})
+
+    if byte_range is None:
+        return StreamingResponse(
+            gridfs_read(fos), media_type=media_type, headers={**headers, 'Content-Length': str(fos.length)}
+        )
+
+    start, end = byte_range
+
+    return StreamingResponse(
+        gridfs_read(fos, start, end),
+        status_code=206,
+        media_type=media_type,
+        headers={
+            **headers,
+            'Content-Length': str(end - start),
+            'Content-Range': f'bytes {start}-{end - 1}/{fos.length}',
+        },
+    )
+
+
+# Deletes a file along with any renditions of it that were generated on demand
+async def delete_gridfs_file(app, file_id: ObjectId):
+    gridfs_client = AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB])
+
+    file_ids = [file_id]
+
+    async for derived in app.state.db[MONGO_DB].fs.files.find({'metadata.derived_from': file_id}, {'_id': 1}):
+        try:
+            await gridfs_client.delete(derived['_id'])
+        except NoFile:
+            pass
+
+        file_ids.append(derived['_id'])
+
+    await gridfs_client.delete(file_id)
+
+    if app.state.file_cache is not None:
+        for fid in file_ids:
+            app.state.file_cache.discard(fid)
@@ -5,7 +5,7 @@ from typing import List, Optional, Union
 from aiohttp import ClientResponseError
 from bson import ObjectId
 from dateutil.tz import UTC
-from fastapi import HTTPException
+from fastapi import BackgroundTasks, HTTPException
 from humanize import naturaldelta
 from pydantic import PositiveInt
 
@@ -15,15 +15,15 @@ from gflbans.api_util import construct_ci_resp
 from gflbans.internal.asn import VPN_DUBIOUS, VPN_YES, check_vpn
 from gflbans.internal.avatar import process_avatar
 from gflbans.internal.config import BRANDING, COMMUNITY_ICON, GFLBANS_ICON, GLOBAL_INFRACTION_WEBHOOK, HOST, MONGO_DB
-from gflbans.internal.constants import GB_VERSION, SERVER_KEY
+from gflbans.internal.constants import SERVER_KEY
 from gflbans.internal.database.admin import Admin
 from gflbans.internal.database.common import DFile
 from gflbans.internal.database.infraction import DInfraction, DUser, build_query_dict
 from gflbans.internal.database.rpc import DRPCPlayerUpdated
 from gflbans.internal.database.server import DServer
-from gflbans.internal.database.task import DTask
+from gflbans.internal.database.task import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, queue_task, queue_tasks
 from gflbans.internal.discord_calladmin import sanitize_discord_username
-from gflbans.internal.errors import NoSuchAdminError
+from gflbans.internal.errors import NoSuchAdminError, WebhookError
 from gflbans.internal.flags import (
     INFRACTION_ADMIN_CHAT_BLOCK,
     INFRACTION_BAN,
@@ -146,20 +146,38 @@ async def get_user_data(
 
         await dinf.update_field(app.state.db[MONGO_DB], 'user', duser)
 
-        await discord_notify_create_infraction(app, dinf, print_map_in_discord_embed)
+        await queue_notify_create_infraction(app, dinf.id, print_map_in_discord_embed)
     except Exception as e:
         logger.error('get_user_data failed!', exc_info=e)
         if reschedule_on_fail:
             logger.info(f'Rescheduling get_user_data call for {str(infraction_id)})...')
-            dt = DTask(
-                run_at=datetime.now(tz=UTC).timestamp() + 5,
-                task_data={'i_id': infraction_id},
-                ev_handler='get_user_data',
+            await queue_task(
+                app,
+                'get_user_data',
+                {'i_id': infraction_id, 'print_map': print_map_in_discord_embed},
+                delay=5,
+                dedup_key=f'get_user_data:{infraction_id}',
             )
-            await dt.commit(app.state.db[MONGO_DB])
         raise
 
 
+# Names and avatars for every infraction of a player that has none yet. Imports queue one of these per player instead of
+# a get_user_data per infraction, and no Discord notification is sent
+async def backfill_user_data(app, gs_service: str, gs_id: str):
+    user_info = await get_user_info(app, gs_service, gs_id)
+
+    update = {'user.gs_name': user_info['name']}
+
+    try:
+        update['user.gs_avatar'] = DFile(**await process_avatar(app, user_info['avatar_url'])).dict(exclude_none=True)
+    except Exception as e:
+        logger.warning('backfill_user_data failed to find an avatar. Leaving as empty in the infractions.', exc_info=e)
+
+    await app.state.db[MONGO_DB].infractions.update_many(
+        {'user.gs_service': gs_service, 'user.gs_id': gs_id, 'user.gs_name': None}, {'$set': update}
+    )
+
+
 async def get_vpn_data(app, infraction_id: ObjectId, reschedule_on_fail=False):
     try:
         dinf = await DInfraction.from_id(app.state.db[MONGO_DB], infraction_id)
@@ -180,12 +198,13 @@ async def get_vpn_data(app, infraction_id: ObjectId, reschedule_on_fail=False):
         logger.error('get_vpn_data failed!', exc_info=e)
         if reschedule_on_fail:
             logger.info(f'Rescheduling get_vpn_data call for {str(infraction_id)})...')
-            dt = DTask(
-                run_at=datetime.now(tz=UTC).timestamp() + 5,
-                task_data={'i_id': infraction_id},
-                ev_handler='get_vpn_data',
+            await queue_task(
+                app,
+                'get_vpn_data',
+                {'i_id': infraction_id},
+                delay=5,
+                dedup_key=f'get_vpn_data:{infraction_id}',
             )
-            await dt.commit(app.state.db[MONGO_DB])
         raise
 
 
@@ -236,6 +255,7 @@ async def modify_infraction(
     make_web: bool = False,
     reuse_dinf: DInfraction = None,
     actor: Optional[ObjectId] = None,
+    tasks: Optional[BackgroundTasks] = None,
 ):
     if reuse_dinf is not None and reuse_dinf.id == target:
         dinf = reuse_dinf
@@ -247,7 +267,7 @@ async def modify_infraction(
 
     db = app.state.db[MONGO_DB]
 
-    commit_list = []
+    update = dinf.changes()
     changes = {}
     removed = None
 
@@ -265,8 +285,8 @@ async def modify_infraction(
             if dinf.flags & INFRACTION_SYSTEM != INFRACTION_SYSTEM and dinf.admin is not None:
                 uwu('Owner', await load_admin_from_initiator(app, Initiator(mongo_id=str(dinf.admin))).name, 'System')
 
-            commit_list.append(dinf.unset_field(db, 'admin'))
-            commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_SYSTEM))
+            update.unset('admin')
+            update.add_bit_flag('flags', INFRACTION_SYSTEM)
         elif isinstance(author, ObjectId):
             if dinf.flags & INFRACTION_SYSTEM == INFRACTION_SYSTEM:
                 uwu('Owner', 'System', await load_admin_from_initiator(app, Initiator(mongo_id=str(author))).name)
@@ -279,8 +299,8 @@ async def modify_infraction(
                     await load_admin_from_initiator(app, Initiator(mongo_id=str(author))).name,
                 )
 
-            commit_list.append(dinf.update_field(db, 'admin', author))
-            commit_list.append(dinf.remove_bit_flag(db, 'flags', INFRACTION_SYSTEM))
+            update.set('admin', author)
+            update.remove_bit_flag('flags', INFRACTION_SYSTEM)
         else:
             raise ValueError('Attempted to do an author update with an unsupported author type')
 
@@ -290,12 +310,12 @@ async def modify_infraction(
 
     def clear_expiration_stuff():
         for field in fl:
-            commit_list.append(dinf.unset_field(db, field))
+            update.unset(field)
         v = 0
         for flag in fl2:
             v |= flag
         if v != 0:
-            commit_list.append(dinf.remove_bit_flag(db, 'flags', v))
+            update.remove_bit_flag('flags', v)
 
     def exp_orig_value():
         if dinf.flags & INFRACTION_PERMANENT == INFRACTION_PERMANENT:
@@ -312,15 +332,15 @@ async def modify_infraction(
     if make_session:
         uwu('Duration', exp_orig_value(), 'Session')
         clear_expiration_stuff()
-        commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_SESSION))
+        update.add_bit_flag('flags', INFRACTION_SESSION)
     elif make_permanent:
         uwu('Duration', exp_orig_value(), 'Permanent')
         clear_expiration_stuff()
-        commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_PERMANENT))
+        update.add_bit_flag('flags', INFRACTION_PERMANENT)
     elif expiration is not None:
         uwu('Duration', exp_orig_value(), naturaldelta(timedelta(seconds=(expiration))))
         clear_expiration_stuff()
-        commit_list.append(dinf.update_field(db, 'expires', expiration + dinf.created))
+        update.set('expires', expiration + dinf.created)
     elif time_left is not None:
         if dinf.flags & INFRACTION_BAN == INFRACTION_BAN and (punishments is None or 'ban' in punishments):
             raise ValueError('Cannot make a ban based on playtime')
@@ -331,29 +351,29 @@ async def modify_infraction(
             actual_time_left = time_left - (dinf.original_time - dinf.time_left)
             if actual_time_left < 0:
                 actual_time_left = 0
-            commit_list.append(dinf.update_field(db, 'time_left', actual_time_left))
-            commit_list.append(dinf.update_field(db, 'original_time', time_left))
+            update.set('time_left', actual_time_left)
+            update.set('original_time', time_left)
         else:
-            commit_list.append(dinf.update_field(db, 'time_left', time_left))
-            commit_list.append(dinf.update_field(db, 'original_time', time_left))
-        commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_PLAYTIME_DURATION))
+            update.set('time_left', time_left)
+            update.set('original_time', time_left)
+        update.add_bit_flag('flags', INFRACTION_PLAYTIME_DURATION)
 
     if make_web:
         uwu('Server', await _embed_host(app.state.db[MONGO_DB], dinf.server), 'GFLBans Web')
-        commit_list.append(dinf.unset_field(db, 'server'))
-        commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_WEB))
+        update.unset('server')
+        update.add_bit_flag('flags', INFRACTION_WEB)
     elif server is not None:
         uwu(
             'Server',
             await _embed_host(app.state.db[MONGO_DB], dinf.server),
             await _embed_host(app.state.db[MONGO_DB], server),
         )
-        commit_list.append(dinf.remove_bit_flag(db, 'flags', INFRACTION_WEB))
-        commit_list.append(dinf.update_field(db, 'server', server))
+        update.remove_bit_flag('flags', INFRACTION_WEB)
+        update.set('server', server)
 
     if reason is not None:
         uwu('Reason', dinf.reason, reason)
-        commit_list.append(dinf.update_field(db, 'reason', filter_badchars(reason)))
+        update.set('reason', filter_badchars(reason))
 
     if set_removal_state is not None:
         if set_removal_state:
@@ -362,20 +382,20 @@ async def modify_infraction(
 
             removed = True
 
-            commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_REMOVED))
-            commit_list.append(dinf.update_field(db, 'ureason', filter_badchars(removal_reason)))
-            commit_list.append(dinf.update_field(db, 'removed', int(datetime.now(tz=UTC).timestamp())))
-            commit_list.append(dinf.update_field(db, 'remover', removed_by))
+            update.add_bit_flag('flags', INFRACTION_REMOVED)
+            update.set('ureason', filter_badchars(removal_reason))
+            update.set('removed', int(datetime.now(tz=UTC).timestamp()))
+            update.set('remover', removed_by)
         else:
             if dinf.flags & INFRACTION_REMOVED != INFRACTION_REMOVED:
                 raise ValueError('Tried to re-instate infraction that was not removed.')
 
             removed = False
 
-            commit_list.append(dinf.remove_bit_flag(db, 'flags', INFRACTION_REMOVED))
-            commit_list.append(dinf.unset_field(db, 'ureason'))
-            commit_list.append(dinf.unset_field(db, 'removed'))
-            commit_list.append(dinf.unset_field(db, 'remover'))
+            update.remove_bit_flag('flags', INFRACTION_REMOVED)
+            update.unset('ureason')
+            update.unset('removed')
+            update.unset('remover')
 
     def _lang(a):
         if a == 'voice_block':
@@ -410,14 +430,14 @@ async def modify_infraction(
             if dinf.flags & val == val:
                 old_res.append(k)
 
-        commit_list.append(dinf.remove_bit_flag(db, 'flags', t))
+        update.remove_bit_flag('flags', t)
 
         t = 0
 
         for p in punishments:
             t |= str2pflag[p]
 
-        commit_list.append(dinf.add_bit_flag(db, 'flags', t))
+        update.add_bit_flag('flags', t)
 
         uwu('Restrictions', _uwu2(old_res), _uwu2(punishments))
 
@@ -427,30 +447,111 @@ async def modify_infraction(
         else:
             uwu('Scope', 'Server Only', scope)
 
-        commit_list.append(dinf.remove_bit_flag(db, 'flags', INFRACTION_GLOBAL))
+        update.remove_bit_flag('flags', INFRACTION_GLOBAL)
 
-        commit_list.append(dinf.add_bit_flag(db, 'flags', scope_to_flag[scope]))
+        update.add_bit_flag('flags', scope_to_flag[scope])
 
     if vpn is not None:
         if vpn:
             uwu('Is VPN?', 'No', 'Yes')
-            commit_list.append(dinf.add_bit_flag(db, 'flags', INFRACTION_VPN))
+            update.add_bit_flag('flags', INFRACTION_VPN)
         else:
             uwu('Is VPN?', 'Yes', 'No')
-            commit_list.append(dinf.remove_bit_flag(db, 'flags', INFRACTION_VPN))
+            update.remove_bit_flag('flags', INFRACTION_VPN)
 
-    for coro in commit_list:
-        await coro
+    # All or nothing, and dinf ends up as whatever is stored now
+    if not await update.commit_and_reload(db):
+        raise ValueError('The infraction was deleted while it was being edited.')
 
     if removed is None:
-        await discord_notify_edit_infraction(app, dinf, actor, changes)
+        notify, *notify_args = discord_notify_edit_infraction, app, dinf, actor, changes
     elif removed:
-        await discord_notify_revoke_infraction(app, dinf, actor)
+        notify, *notify_args = discord_notify_revoke_infraction, app, dinf, actor
+    else:
+        notify, *notify_args = discord_notify_reinst_infraction, app, dinf, actor
+
+    await queue_push_state(app, dinf)
+
+    # The caller only waits for the database, Discord is told after the response is sent
+    if tasks is not None:
+        tasks.add_task(notify, *notify_args)
+    else:
+        await notify(*notify_args)
+
+
+def _push_state_key(user: Optional[PlayerObjNoIp], ip: Optional[str]) -> str:
+    if user is None:
+        return f'push_state:{ip}'
+
+    return f'push_state:{user.gs_service}/{user.gs_id}:{ip}'
+
+
+# Game servers are told about the target rather than the infraction, so this works for purged infractions too. Pushes
+# queued for the same target while one is pending are merged, the push reads whatever is current when it runs
+async def queue_push_state(app, dinf: DInfraction):
+    user = None if dinf.user is None else PlayerObjNoIp(gs_service=dinf.user.gs_service, gs_id=dinf.user.gs_id)
+
+    await queue_task(
+        app,
+        'push_state',
+        {'user': None if user is None else user.dict(), 'ip': dinf.ip},
+        priority=PRIORITY_HIGH,
+        dedup_key=_push_state_key(user, dinf.ip),
+    )
+
+
+# Every new infraction notification goes through this task, it only completes once the webhooks have the message
+async def queue_notify_create_infraction(
+    app, infraction_id: ObjectId, print_map: bool = False, priority: int = PRIORITY_NORMAL
+):
+    await queue_task(
+        app,
+        'notify_create_infraction',
+        {'i_id': infraction_id, 'print_map': print_map},
+        priority=priority,
+        dedup_key=f'notify_create_infraction:{infraction_id}',
+    )
+
+
+# Fills in the target's name, avatar and VPN status in the background. The Discord notification waits for the name
+async def queue_infraction_enrichment(app, dinf: DInfraction, print_map: bool = False, priority=PRIORITY_NORMAL):
+    if dinf.user is not None:
+        await queue_task(
+            app,
+            'get_user_data',
+            {'i_id': dinf.id, 'print_map': print_map},
+            priority=priority,
+            dedup_key=f'get_user_data:{dinf.id}',
+        )
     else:
-        await discord_notify_reinst_infraction(app, dinf, actor)
+        await queue_notify_create_infraction(app, dinf.id, print_map, priority)
+
+    if dinf.ip is not None:
+        await queue_task(app, 'get_vpn_data', {'i_id': dinf.id}, priority=priority, dedup_key=f'get_vpn_data:{dinf.id}')
+
+
+# Imports look each player and IP up once however many infractions they have, behind all other work. VPN checks go
+# through vpn_backfill so they share its IPHub budget
+async def queue_import_enrichment(app, dinfs: List[DInfraction]):
+    tasks = []
+
+    for dinf in dinfs:
+        if dinf.user is not None:
+            tasks.append(
+                (
+                    'user_backfill',
+                    {'gs_service': dinf.user.gs_service, 'gs_id': dinf.user.gs_id},
+                    f'user_backfill:{dinf.user.gs_service}/{dinf.user.gs_id}',
+                )
+            )
+
+        if dinf.ip is not None:
+            tasks.append(('vpn_backfill', {'ip': dinf.ip}, f'vpn_backfill:{dinf.ip}'))
 
+    await queue_tasks(app, tasks, priority=PRIORITY_LOW)
 
-async def push_state_to_nodes(app, dinf: DInfraction):
+
+async def push_state_to_nodes(app, user: Optional[PlayerObjNoIp], ip: Optional[str]):
     gathers = []
 
     logger.debug('enter push_state_to_nodes')
@@ -502,11 +603,11 @@ async def push_state_to_nodes(app, dinf: DInfraction):
         await r.commit(app.state.db[MONGO_DB])
 
     async for srv in DServer.from_query_ex(app.state.db[MONGO_DB], {}):
-        if dinf.user is not None:
-            gathers.append(load_user(srv, dinf.user))
+        if user is not None:
+            gathers.append(load_user(srv, user))
 
-        if dinf.ip:
-            gathers.append(load_ip(srv, dinf.ip))
+        if ip:
+            gathers.append(load_ip(srv, ip))
 
     await asyncio.gather(*gathers)
 
@@ -615,7 +716,24 @@ def embed_duration(dinf: DInfraction):
         return 'OOPS, INVALID!'
 
 
-async def discord_notify_create_infraction(app, dinf: DInfraction, print_map: bool = False):
+# Queued, see WebhookDispatcher. Returns the futures of the queued messages
+def _send_infraction_embed(app, srv: Optional[DServer], embed: dict) -> List[asyncio.Future]:
+    sent = []
+
+    if srv is not None and srv.infract_webhook is not None:
+        sent.append(app.state.webhooks.send(srv.infract_webhook, embed))
+
+    if GLOBAL_INFRACTION_WEBHOOK is not None:
+        sent.append(app.state.webhooks.send(GLOBAL_INFRACTION_WEBHOOK, embed))
+
+    return sent
+
+
+# With wait_for_delivery, only returns once every webhook has the message and raises WebhookError if one was dropped,
+# so a task calling this is retried instead of completing with the message lost
+async def discord_notify_create_infraction(
+    app, dinf: DInfraction, print_map: bool = False, wait_for_delivery: bool = False
+):
     bot_name = f'{BRANDING}'
     bot_avatar = COMMUNITY_ICON
 
@@ -653,25 +771,10 @@ async def discord_notify_create_infraction(app, dinf: DInfraction, print_map: bo
             },
         )
 
-    if srv is not None and srv.infract_webhook is not None:
-        async with app.state.aio_session.post(
-            srv.infract_webhook + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=embed
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to srv infract webhook', exc_info=True)
+    sent = _send_infraction_embed(app, srv, embed)
 
-    if GLOBAL_INFRACTION_WEBHOOK is not None:
-        async with app.state.aio_session.post(
-            GLOBAL_INFRACTION_WEBHOOK + '?wait=true',
-            headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
-            json=embed,
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to global infract webhook', exc_info=True)
+    if wait_for_delivery and not all(await asyncio.gather(*sent)):
+        raise WebhookError(f'Notification for infraction {str(dinf.id)} was dropped before it was delivered')
 
 
 async def discord_notify_edit_infraction(app, dinf: DInfraction, editor: Optional[ObjectId], changes):
@@ -703,25 +806,7 @@ async def discord_notify_edit_infraction(app, dinf: DInfraction, editor: Optiona
     else:
         srv = None
 
-    if srv is not None and srv.infract_webhook is not None:
-        async with app.state.aio_session.post(
-            srv.infract_webhook + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=embed
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to srv infract webhook', exc_info=True)
-
-    if GLOBAL_INFRACTION_WEBHOOK is not None:
-        async with app.state.aio_session.post(
-            GLOBAL_INFRACTION_WEBHOOK + '?wait=true',
-            headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
-            json=embed,
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to global infract webhook', exc_info=True)
+    _send_infraction_embed(app, srv, embed)
 
 
 async def discord_notify_revoke_infraction(app, dinf: DInfraction, actor: Optional[ObjectId]):
@@ -755,25 +840,7 @@ async def discord_notify_revoke_infraction(app, dinf: DInfraction, actor: Option
     else:
         srv = None
 
-    if srv is not None and srv.infract_webhook is not None:
-        async with app.state.aio_session.post(
-            srv.infract_webhook + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=embed
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to srv infract webhook', exc_info=True)
-
-    if GLOBAL_INFRACTION_WEBHOOK is not None:
-        async with app.state.aio_session.post(
-            GLOBAL_INFRACTION_WEBHOOK + '?wait=true',
-            headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
-            json=embed,
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to global infract webhook', exc_info=True)
+    _send_infraction_embed(app, srv, embed)
 
 
 async def discord_notify_reinst_infraction(app, dinf: DInfraction, actor: Optional[ObjectId]):
@@ -806,25 +873,7 @@ async def discord_notify_reinst_infraction(app, dinf: DInfraction, actor: Option
     else:
         srv = None
 
-    if srv is not None and srv.infract_webhook is not None:
-        async with app.state.aio_session.post(
-            srv.infract_webhook + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=embed
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to srv infract webhook', exc_info=True)
-
-    if GLOBAL_INFRACTION_WEBHOOK is not None:
-        async with app.state.aio_session.post(
-            GLOBAL_INFRACTION_WEBHOOK + '?wait=true',
-            headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
-            json=embed,
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to global infract webhook', exc_info=True)
+    _send_infraction_embed(app, srv, embed)
 
 
 async def discord_notify_purge_infraction(app, dinf: DInfraction, actor: Optional[ObjectId]):
@@ -857,25 +906,7 @@ async def discord_notify_purge_infraction(app, dinf: DInfraction, actor: Optiona
     else:
         srv = None
 
-    if srv is not None and srv.infract_webhook is not None:
-        async with app.state.aio_session.post(
-            srv.infract_webhook + '?wait=true', headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'}, json=embed
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to srv infract webhook', exc_info=True)
-
-    if GLOBAL_INFRACTION_WEBHOOK is not None:
-        async with app.state.aio_session.post(
-            GLOBAL_INFRACTION_WEBHOOK + '?wait=true',
-            headers={'User-Agent': f'{BRANDING} ({HOST}, {GB_VERSION})'},
-            json=embed,
-        ) as resp:
-            try:
-                resp.raise_for_status()
-            except Exception:
-                logger.error('Failed to post infraction to global infract webhook', exc_info=True)
+    _send_infraction_embed(app, srv, embed)
 
 
 # If true, the target is immune!
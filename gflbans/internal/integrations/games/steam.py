@@ -1,4 +1,6 @@
+import asyncio
 from contextlib import suppress
+from typing import Dict, List, Union
 
 from redis.exceptions import RedisError
 
@@ -6,85 +8,149 @@ from gflbans.internal.config import STEAM_API_KEY
 from gflbans.internal.log import logger
 from gflbans.internal.search import id64_or_none
 
+# Steam's GetPlayerSummaries takes at most 100 ids per call
+STEAM_MAX_IDS = 100
+STEAM_USER_CACHE_TIME = 3600 * 24
 
-async def _get_steam_user_info(app, steamid64: str):
-    if STEAM_API_KEY is None:
-        raise NotImplementedError('Tried to call the steam api without an api key.')
-
-    with suppress(RedisError):
-        a = await app.state.steam_cache.get(steamid64, 'user_cache')
-        if a is not None:
-            return a
-
-    async with app.state.aio_session.get(
-        'https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/',
-        params={'key': STEAM_API_KEY, 'steamids': steamid64, 'format': 'json'},
-    ) as resp:
+
+# Collects every profile requested during one pass of the event loop (e.g. all players in a heartbeat) and resolves
+# them together: one MGET against the cache, then one Steam call per 100 ids that weren't cached
+class SteamResolver:
+    def __init__(self, app):
+        self.app = app
+        self.pending: List[str] = []
+        self.futures: Dict[str, asyncio.Future] = {}
+        self.flush_handle = None
+
+    def resolve(self, steamid64: str) -> asyncio.Future:
+        # Someone is already looking this id up, wait for the same answer
+        if steamid64 in self.futures:
+            return self.futures[steamid64]
+
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.futures[steamid64] = fut
+        self.pending.append(steamid64)
+
+        if self.flush_handle is None:
+            # Runs after every task that is already scheduled got to make its request
+            self.flush_handle = loop.call_soon(self.flush)
+
+        return fut
+
+    async def get(self, steamid64: str) -> dict:
+        return await self.resolve(steamid64)
+
+    async def get_many(self, steamid64_list: List[str]) -> Dict[str, dict]:
+        steamid64_list = list(dict.fromkeys(steamid64_list))
+        results = await asyncio.gather(*[self.resolve(s) for s in steamid64_list], return_exceptions=True)
+
+        users = {}
+
+        for steamid64, result in zip(steamid64_list, results):
+            if isinstance(result, LookupError):
+                continue  # No such profile
+            elif isinstance(result, BaseException):
+                raise result
+
+            users[steamid64] = result
+
+        return users
+
+    def flush(self):
+        self.flush_handle = None
+        batch, self.pending = self.pending, []
+
+        if batch:
+            asyncio.get_running_loop().create_task(self.run_batch(batch))
+
+    async def run_batch(self, batch: List[str]):
         try:
-            resp.raise_for_status()
-        except Exception:
-            logger.error('Steam API error!', exc_info=True)
-            raise
+            results = await self.fetch(batch)
+        except Exception as e:
+            results = {steamid64: e for steamid64 in batch}
 
-        j = await resp.json()
+        for steamid64 in batch:
+            fut = self.futures.pop(steamid64)
 
-        ply = j['response']['players'][0]
+            if fut.done():
+                continue
 
-        with suppress(Exception):
-            await app.state.steam_cache.set(steamid64, ply, 'user_cache', expire_time=(3600 * 24))
+            result = results.get(steamid64)
 
-        return ply
+            if result is None:
+                fut.set_exception(LookupError(f'Steam has no profile for {steamid64}'))
+            elif isinstance(result, Exception):
+                fut.set_exception(result)
+            else:
+                fut.set_result(result)
 
+    async def fetch(self, steamid64_list: List[str]) -> Dict[str, Union[dict, Exception]]:
+        cache = self.app.state.steam_cache
+        users = {}
 
-async def get_steam_user_info(app, steamid64: str):
-    info = await _get_steam_user_info(app, steamid64)
+        with suppress(RedisError):
+            for steamid64, value in zip(steamid64_list, await cache.get_many(steamid64_list, 'user_cache')):
+                if value is not None:
+                    users[steamid64] = value
 
-    return {'avatar_url': info['avatarfull'], 'name': info['personaname']}
+        missing = [steamid64 for steamid64 in steamid64_list if steamid64 not in users]
+
+        if not missing:
+            return users
 
+        if STEAM_API_KEY is None:
+            raise NotImplementedError('Tried to call the steam api without an api key.')
 
-async def _get_steam_multiple_user_info(app, steamid64_list: list[str]):
-    if STEAM_API_KEY is None:
-        raise NotImplementedError('Tried to call the steam api without an api key.')
+        chunks = [missing[i : i + STEAM_MAX_IDS] for i in range(0, len(missing), STEAM_MAX_IDS)]
+        replies = await asyncio.gather(*[self.get_player_summaries(chunk) for chunk in chunks], return_exceptions=True)
 
-    users = dict()
+        fetched = {}
+
+        for chunk, reply in zip(chunks, replies):
+            if isinstance(reply, Exception):
+                # Only the ids in the failed request get the error
+                users.update({steamid64: reply for steamid64 in chunk})
+                continue
+
+            for ply in reply:
+                fetched[ply['steamid']] = ply
 
-    for steamid64 in steamid64_list:
         with suppress(RedisError):
-            a = await app.state.steam_cache.get(steamid64, 'user_cache')
-            if a is not None:
-                users[steamid64] = a
-                steamid64_list.remove(steamid64)
+            await cache.set_many(fetched, 'user_cache', expire_time=STEAM_USER_CACHE_TIME)
+
+        users.update(fetched)
 
-    if len(steamid64_list) == 0:
         return users
 
-    batched_steam_ids = ''
-    for steamid64 in steamid64_list:
-        batched_steam_ids += f',{steamid64}'
-    batched_steam_ids = batched_steam_ids[1:]  # Remove comma at start
+    async def get_player_summaries(self, steamid64_list: List[str]) -> List[dict]:
+        async with self.app.state.aio_session.get(
+            'https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/',
+            params={'key': STEAM_API_KEY, 'steamids': ','.join(steamid64_list), 'format': 'json'},
+        ) as resp:
+            try:
+                resp.raise_for_status()
+            except Exception:
+                logger.error('Steam API error!', exc_info=True)
+                raise
 
-    async with app.state.aio_session.get(
-        'https://api.steampowered.com/ISteamUser/GetPlayerSummaries/v0002/',
-        params={'key': STEAM_API_KEY, 'steamids': batched_steam_ids, 'format': 'json'},
-    ) as resp:
-        try:
-            resp.raise_for_status()
-        except Exception:
-            logger.error('Steam API error!', exc_info=True)
-            raise
+            j = await resp.json()
 
-        j = await resp.json()
+            return j['response']['players']
 
-        for ply in j['response']['players']:
-            users[ply['steamid']] = ply
-            with suppress(Exception):
-                await app.state.steam_cache.set(steamid64, ply, 'user_cache', expire_time=(3600 * 24))
 
-        return users
+async def _get_steam_user_info(app, steamid64: str):
+    return await app.state.steam_resolver.get(steamid64)
+
+
+async def get_steam_user_info(app, steamid64: str):
+    info = await _get_steam_user_info(app, steamid64)
+
+    return {'avatar_url': info['avatarfull'], 'name': info['personaname']}
 
 
 async def get_steam_multiple_user_info(app, steamid64_list: list[str]):
-    info_list = await _get_steam_multiple_user_info(app, steamid64_list)
+    info_list = await app.state.steam_resolver.get_many(steamid64_list)
     user_list = dict()
     for steamid, info in info_list.items():
         user_list[steamid] = {'avatar_url': info['avatarfull'], 'name': info['personaname']}
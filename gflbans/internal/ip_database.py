@@ -0,0 +1,79 @@
+import mmap
+import struct
+from typing import List, NamedTuple, Optional
+
+import orjson
+from netaddr import IPAddress
+
+# Layout of files written by tools/import_ip_db.py. Everything is big endian.
+#   header:  magic, v4 range count, v6 range count, length of the country table
+#   country table: JSON list of country names, records refer to them by index
+#   v4 ranges: start (u32), end (u32), asn (u32), country index (u16), sorted by start
+#   v6 ranges: start (16 bytes), end (16 bytes), asn (u32), country index (u16), sorted by start
+IP_DB_MAGIC = b'GBIPDB01'
+IP_DB_HEADER = struct.Struct('>8sIII')
+IP_DB_V4_RECORD = struct.Struct('>IIIH')
+IP_DB_V6_RECORD = struct.Struct('>16s16sIH')
+
+
+class IPRecord(NamedTuple):
+    asn: int
+    country: Optional[str]
+
+
+class IPDatabase:
+    def __init__(self, path: str):
+        with open(path, 'rb') as f:
+            # Read only and shared between every worker process through the page cache
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.v4_count, self.v6_count, table_len = IP_DB_HEADER.unpack_from(self.mm, 0)
+
+        if magic != IP_DB_MAGIC:
+            raise ValueError(f'{path} is not an IP database created by tools/import_ip_db.py')
+
+        table_start = IP_DB_HEADER.size
+        self.countries: List[str] = orjson.loads(self.mm[table_start : table_start + table_len])
+
+        self.v4_offset = table_start + table_len
+        self.v6_offset = self.v4_offset + self.v4_count * IP_DB_V4_RECORD.size
+
+    def __len__(self):
+        return self.v4_count + self.v6_count
+
+    def _read(self, version: int, idx: int):
+        if version == 4:
+            start, end, asn, country = IP_DB_V4_RECORD.unpack_from(self.mm, self.v4_offset + idx * IP_DB_V4_RECORD.size)
+            return start, end, asn, country
+
+        start, end, asn, country = IP_DB_V6_RECORD.unpack_from(self.mm, self.v6_offset + idx * IP_DB_V6_RECORD.size)
+        return int.from_bytes(start, 'big'), int.from_bytes(end, 'big'), asn, country
+
+    def lookup(self, ip: IPAddress) -> Optional[IPRecord]:
+        if ip.is_ipv4_mapped():
+            ip = ip.ipv4()
+
+        ip_int = int(ip)
+        lo, hi = 0, self.v4_count if ip.version == 4 else self.v6_count
+
+        # Find the last range starting at or before the ip
+        while lo < hi:
+            mid = (lo + hi) // 2
+
+            if self._read(ip.version, mid)[0] <= ip_int:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo == 0:
+            return None
+
+        _, end, asn, country = self._read(ip.version, lo - 1)
+
+        if ip_int > end:
+            return None
+
+        return IPRecord(asn=asn, country=self.countries[country] if country < len(self.countries) else None)
+
+    def close(self):
+        self.mm.close()
@@ -1,14 +1,19 @@
 import asyncio
 from concurrent.futures.process import ProcessPoolExecutor
+from contextlib import asynccontextmanager
 from hashlib import md5
 
 import aiohttp
 from motor.motor_asyncio import AsyncIOMotorClient
-from pymongo import ASCENDING, DESCENDING
+from pymongo import ASCENDING, DESCENDING, TEXT
 from redis.asyncio import Redis
+from redis.exceptions import RedisError
 
 from gflbans.internal import shard
+from gflbans.internal.avatar import AvatarEngine
 from gflbans.internal.config import (
+    FILE_CACHE_DIR,
+    IP_DATABASE_PATH,
     MONGO_DB,
     MONGO_URI,
     REDIS_URI,
@@ -17,9 +22,16 @@ from gflbans.internal.config import (
     STEAM_OPENID_ACCESS_TOKEN_LIFETIME,
 )
 from gflbans.internal.constants import GB_VERSION
+from gflbans.internal.discord_calladmin import ClaimWatcher
+from gflbans.internal.discord_webhooks import WebhookDispatcher
+from gflbans.internal.file_cache import FileCache
+from gflbans.internal.integrations.games.steam import SteamResolver
+from gflbans.internal.ip_database import IPDatabase
 from gflbans.internal.log import logger
+from gflbans.internal.pubsub import listen_forever
 from gflbans.internal.task import task_loop
 from gflbans.internal.utils import ORJSONSerializer
+from gflbans.internal.vpn_index import VPN_INDEX_CHANNEL, VPNIndex
 
 
 class RedisCache:
@@ -45,6 +57,62 @@ class RedisCache:
         value = await self.redis_client.get(cache_key)
         return self.serializer.deserialize(value) if value else None
 
+    async def delete(self, key, typ):
+        await self.redis_client.delete(self._generate_key(key, typ))
+
+    # Seconds until the key expires, None if it doesn't exist or never expires
+    async def ttl(self, key, typ):
+        ttl = await self.redis_client.ttl(self._generate_key(key, typ))
+        return ttl if ttl >= 0 else None
+
+    # One MGET for all keys, values that are missing or can't be decoded come back as None
+    async def get_many(self, keys, typ):
+        if not keys:
+            return []
+
+        values = await self.redis_client.mget([self._generate_key(key, typ) for key in keys])
+        results = []
+
+        for value in values:
+            try:
+                results.append(self.serializer.deserialize(value) if value else None)
+            except RedisError:
+                results.append(None)
+
+        return results
+
+    async def set_many(self, items: dict, typ, expire_time=None):
+        if not items:
+            return
+
+        async with self.pipeline() as pipe:
+            for key, value in items.items():
+                pipe.set(key, value, typ, expire_time=expire_time)
+
+    # Queues writes and sends them in a single round trip when the block exits
+    @asynccontextmanager
+    async def pipeline(self):
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            yield RedisCachePipeline(self, pipe)
+            await pipe.execute()
+
+
+class RedisCachePipeline:
+    def __init__(self, cache, pipe):
+        self.cache = cache
+        self.pipe = pipe
+
+    def set(self, key, value, typ, expire_time=None):
+        cache_key = self.cache._generate_key(key, typ)
+        serialized_value = self.cache.serializer.serialize(value)
+        if expire_time:
+            self.pipe.setex(cache_key, expire_time, serialized_value)
+        else:
+            self.pipe.set(cache_key, serialized_value)
+
+    def delete(self, key, typ):
+        self.pipe.delete(self.cache._generate_key(key, typ))
+
 
 def configure_app(app):
     app.state.db = AsyncIOMotorClient(MONGO_URI)
@@ -52,12 +120,20 @@ def configure_app(app):
 
     app.state.cache = RedisCache(app.state.redis_client, 'GlobalCache', ORJSONSerializer())
     app.state.steam_cache = RedisCache(app.state.redis_client, 'SteamCache', ORJSONSerializer())
+    app.state.steam_resolver = SteamResolver(app)
     app.state.ips_cache = RedisCache(app.state.redis_client, 'IPSCache', ORJSONSerializer())
     app.state.ip_info_cache = RedisCache(app.state.redis_client, 'IPInfoCache', ORJSONSerializer())
 
+    app.state.vpn_index = VPNIndex()
+    app.state.ip_database = IPDatabase(IP_DATABASE_PATH) if IP_DATABASE_PATH else None
+    app.state.file_cache = FileCache(FILE_CACHE_DIR) if FILE_CACHE_DIR else None
+
     app.state.aio_session = aiohttp.ClientSession()
+    app.state.webhooks = WebhookDispatcher(app)
+    app.state.claim_watcher = ClaimWatcher(app)
 
     app.state.sync_processes = ProcessPoolExecutor(max_workers=4)
+    app.state.avatar_engine = AvatarEngine()
 
 
 async def gflbans_init(app):
@@ -75,10 +151,17 @@ async def gflbans_init(app):
         await app.state.db[MONGO_DB].infractions.create_index([('created', DESCENDING)])
         await app.state.db[MONGO_DB].infractions.create_index([('expires', ASCENDING)])
         await app.state.db[MONGO_DB].infractions.create_index([('ip', ASCENDING)])
+        await app.state.db[MONGO_DB].infractions.create_index([('import_ref', ASCENDING)], unique=True, sparse=True)
         await app.state.db[MONGO_DB].infractions.create_index(
             [('user.gs_service', ASCENDING), ('user.gs_id', ASCENDING)]
         )
 
+        # Identity links (alt search)
+        await app.state.db[MONGO_DB].identity_links.create_index(
+            [('gs_id', ASCENDING), ('ip', ASCENDING), ('gs_service', ASCENDING)], unique=True
+        )
+        await app.state.db[MONGO_DB].identity_links.create_index([('ip', ASCENDING), ('gs_id', ASCENDING)])
+
         # Message logs
         await app.state.db[MONGO_DB].chat_logs.create_index(
             [('created', ASCENDING)], background=True, expireAfterSeconds=RETAIN_CHAT_LOG_FOR
@@ -86,6 +169,16 @@ async def gflbans_init(app):
         await app.state.db[MONGO_DB].chat_logs.create_index([('created', DESCENDING)], background=True)
         await app.state.db[MONGO_DB].chat_logs.create_index('server')
         await app.state.db[MONGO_DB].chat_logs.create_index([('user.gs_service', ASCENDING), ('user.gs_id', ASCENDING)])
+        await app.state.db[MONGO_DB].chat_logs.create_index(
+            [('server', ASCENDING), ('created', DESCENDING)], background=True
+        )
+        await app.state.db[MONGO_DB].chat_logs.create_index(
+            [('server', ASCENDING), ('is_command', ASCENDING), ('created', DESCENDING)], background=True
+        )
+        # No language, chat is in every language and stemming would make phrase searches miss
+        await app.state.db[MONGO_DB].chat_logs.create_index(
+            [('content', TEXT)], name='chat_content_text', default_language='none', background=True
+        )
 
         # Admins
         await app.state.db[MONGO_DB].admin_cache.create_index([('ips_user', ASCENDING)], unique=True)
@@ -94,11 +187,27 @@ async def gflbans_init(app):
         await app.state.db[MONGO_DB].fs.files.create_index(
             [('metadata.retrieved_from', ASCENDING)], name='gridfs_av_src_idx'
         )
+        await app.state.db[MONGO_DB].fs.files.create_index(
+            [('metadata.aliases', ASCENDING)], name='gridfs_av_alias_idx', sparse=True
+        )
+        await app.state.db[MONGO_DB].fs.files.create_index(
+            [('metadata.source_hash', ASCENDING)], name='gridfs_av_hash_idx', sparse=True
+        )
 
         # Map images
         await app.state.db[MONGO_DB].fs.files.create_index(
             [('metadata.mod_name', ASCENDING), ('metadata.map_name', ASCENDING)], name='gridfs_mn_idx'
         )
+        await app.state.db[MONGO_DB].fs.files.create_index(
+            [('metadata.map_name', ASCENDING)], name='gridfs_map_name_idx', sparse=True
+        )
+
+        # Converted copies of uploads
+        await app.state.db[MONGO_DB].fs.files.create_index(
+            [('metadata.derived_from', ASCENDING), ('metadata.format', ASCENDING)],
+            name='gridfs_derived_idx',
+            sparse=True,
+        )
 
         # Call Admin images
         await app.state.db[MONGO_DB].fs.files.create_index(
@@ -111,6 +220,19 @@ async def gflbans_init(app):
 
         # Tasks
         await app.state.db[MONGO_DB].tasks.create_index([('run_at', ASCENDING)], background=True)
+        await app.state.db[MONGO_DB].tasks.create_index(
+            [('ev_handler', ASCENDING), ('run_at', ASCENDING)], background=True
+        )
+        await app.state.db[MONGO_DB].tasks.create_index([('lease_owner', ASCENDING)], background=True)
+        await app.state.db[MONGO_DB].tasks.create_index(
+            [('ev_handler', ASCENDING), ('priority', DESCENDING), ('run_at', ASCENDING)], background=True
+        )
+        await app.state.db[MONGO_DB].tasks.create_index(
+            [('dedup_key', ASCENDING)],
+            unique=True,
+            partialFilterExpression={'dedup_key': {'$exists': True}},
+            background=True,
+        )
 
         # Audit Log
         await app.state.db[MONGO_DB].action_log.create_index(
@@ -128,9 +250,19 @@ async def gflbans_init(app):
 
         logger.info('Mongo Indexes created')
 
+        if app.state.ip_database is not None:
+            logger.info(f'Loaded {len(app.state.ip_database)} IP ranges from {IP_DATABASE_PATH}')
+
         logger.info('Spawning task scheduler')
         asyncio.get_event_loop().create_task(task_loop(app))
 
+        asyncio.get_event_loop().create_task(
+            listen_forever(app.state.redis_client, VPN_INDEX_CHANNEL, app.state.vpn_index.invalidate)
+        )
+
+        logger.info('Spawning call admin claim watcher')
+        asyncio.get_event_loop().create_task(app.state.claim_watcher.run())
+
         # RPC Broker
         # app.state.rpc = ServerRPCBroker(app.state.redis_client, app)
         # await app.state.rpc.setup()
@@ -141,5 +273,12 @@ async def gflbans_init(app):
 
 
 async def gflbans_unload(app):
-    await app.state.db.disconnect()
+    # Queued webhooks go out first, they still need the http session
+    await app.state.webhooks.close()
     await app.state.aio_session.close()
+
+    app.state.db.close()
+    await app.state.redis_client.aclose()
+
+    app.state.avatar_engine.shutdown()
+    app.state.sync_processes.shutdown(wait=False, cancel_futures=True)
@@ -1,30 +1,161 @@
+import asyncio
 import io
-from typing import Optional
+from contextlib import suppress
+from typing import Dict, Optional, Tuple
 
 import PIL
+from aiohttp import ClientError
 from bson import ObjectId
+from gridfs import NoFile
+from motor.motor_asyncio import AsyncIOMotorGridFSBucket
 from PIL import Image
+from pymongo import DESCENDING
+from redis.exceptions import RedisError
 
 # Internal functions for managing map images used on the front end
 # Find the map image in the database
+from gflbans.internal import shard
+from gflbans.internal.config import (
+    MAP_IMAGE_CACHE_TIME,
+    MAP_IMAGE_HIT_CACHE_TIME,
+    MAP_IMAGE_MISS_CACHE_TIME,
+    MONGO_DB,
+)
 from gflbans.internal.log import logger
+from gflbans.internal.utils import single_flight
 
+DEFAULT_MAP_IMAGE = '/static/images/map_icon.png'
 
+# Lookups in progress on this worker, so a page full of servers on the same map only resolves it once
+_resolve_inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+
+
+# Uploaded images win over copies mirrored from GameTracker, and newer uploads win over older ones
 async def find_map_image(db_ref, mod: str, map_n: str) -> Optional[ObjectId]:
-    r = await db_ref.fs.files.find_one(
-        {'metadata.map_image': True, 'metadata.mod_name': mod, 'metadata.map_name': map_n}
-    )
+    mirrored = None
+    fallback = None
+
+    # Images for the map under any mod, so the fallback below doesn't need a second query
+    async for r in db_ref.fs.files.find(
+        {'metadata.map_image': True, 'metadata.map_name': map_n},
+        {'_id': 1, 'metadata.mod_name': 1, 'metadata.mirrored_from': 1},
+    ).sort('uploadDate', DESCENDING):
+        if r['metadata'].get('mod_name') == mod:
+            if 'mirrored_from' not in r['metadata']:
+                return r['_id']
+
+            if mirrored is None:
+                mirrored = r['_id']
+
+        # Try the map name without the mod
+        elif fallback is None:
+            fallback = r['_id']
+
+    return mirrored if mirrored is not None else fallback
+
+
+# Removes the GameTracker copies of a map image, once an admin uploaded their own
+async def delete_mirrored_map_images(db_ref, mod: str, map_n: str):
+    bucket = AsyncIOMotorGridFSBucket(database=db_ref)
+
+    async for r in db_ref.fs.files.find(
+        {
+            'metadata.map_image': True,
+            'metadata.mod_name': mod,
+            'metadata.map_name': map_n,
+            'metadata.mirrored_from': {'$exists': True},
+        },
+        {'_id': 1},
+    ):
+        with suppress(NoFile):
+            await bucket.delete(r['_id'])
+
+
+def gametracker_url(mod: str, map_n: str) -> str:
+    return f'https://image.gametracker.com/images/maps/160x120/{mod}/{map_n}.jpg'
+
+
+def _cache_key(mod: str, map_n: str) -> str:
+    return f'{mod}/{map_n}'
+
+
+async def _resolve_map_image(app, mod: str, map_n: str) -> dict:
+    with suppress(RedisError):
+        resolved = await app.state.cache.get(_cache_key(mod, map_n), 'map_image')
+
+        if resolved is not None:
+            return resolved
 
-    if r is not None:
-        return r['_id']
+    file_id = await find_map_image(app.state.db[MONGO_DB], mod, map_n)
 
-    # Try the map name without the mod
-    r = await db_ref.fs.files.find_one({'metadata.map_image': True, 'metadata.map_name': map_n})
+    if file_id is not None:
+        resolved, expire_time = {'file_id': str(file_id)}, MAP_IMAGE_CACHE_TIME
+    else:
+        gt_url = gametracker_url(mod, map_n)
 
-    if r is not None:
-        return r['_id']
+        try:
+            async with app.state.aio_session.head(gt_url) as resp:
+                found = resp.status < 400
+        except (ClientError, asyncio.TimeoutError):
+            logger.debug('Failed to check if GameTracker has the map image we wanted', exc_info=True)
+            found = False
+
+        if found:
+            resolved, expire_time = {'url': gt_url, 'external': True}, MAP_IMAGE_HIT_CACHE_TIME
+        else:
+            resolved, expire_time = {'url': DEFAULT_MAP_IMAGE}, MAP_IMAGE_MISS_CACHE_TIME
+
+    with suppress(RedisError):
+        await app.state.cache.set(_cache_key(mod, map_n), resolved, 'map_image', expire_time=expire_time)
+
+    return resolved
+
+
+# Returns {'file_id': ...} for an image in GridFS, or {'url': ...} to redirect to
+async def resolve_map_image(app, mod: str, map_n: str) -> dict:
+    return await single_flight(_resolve_inflight, (mod, map_n), lambda: _resolve_map_image(app, mod, map_n))
+
+
+async def forget_map_image(app, mod: str, map_n: str):
+    with suppress(RedisError):
+        await app.state.cache.delete(_cache_key(mod, map_n), 'map_image')
+
+
+# Copies an image GameTracker has into GridFS, so it's served by us from then on
+async def mirror_map_image(app, mod: str, map_n: str, url: str):
+    # Only one shard needs to do this
+    try:
+        if not await app.state.redis_client.set(f'gflbans::map_image_mirror:{mod}/{map_n}', shard, nx=True, ex=300):
+            return
+    except RedisError:
+        return
+
+    try:
+        async with app.state.aio_session.get(url) as resp:
+            resp.raise_for_status()
+            b = await resp.read()
+
+        converted = await asyncio.get_running_loop().run_in_executor(None, conv_map_image, b)
+
+        file_id = await AsyncIOMotorGridFSBucket(database=app.state.db[MONGO_DB]).upload_from_stream(
+            f'{mod}.{map_n}.webp',
+            converted,
+            metadata={
+                'map_image': True,
+                'mod_name': mod,
+                'map_name': map_n,
+                'content-type': 'image/webp',
+                'mirrored_from': url,
+            },
+        )
+    except Exception:
+        logger.warning(f'Failed to mirror map image {url}', exc_info=True)
+        return
 
-    return None
+    with suppress(RedisError):
+        await app.state.cache.set(
+            _cache_key(mod, map_n), {'file_id': str(file_id)}, 'map_image', expire_time=MAP_IMAGE_CACHE_TIME
+        )
 
 
 # Synchronously convert the input image to webp and scale it to 160x120
@@ -3,10 +3,10 @@ from datetime import datetime
 from typing import Dict, List, Optional, Union
 
 from fastapi import Depends, Query
-from pydantic import BaseModel, Field, IPvAnyAddress, PositiveInt, conint, constr, root_validator, validator
+from pydantic import BaseModel, Field, IPvAnyAddress, PositiveInt, conint, conlist, constr, root_validator, validator
 
 # Infraction related API calls
-from gflbans.internal.config import MAX_UPLOAD_SIZE
+from gflbans.internal.config import INFRACTION_IMPORT_MAX_BATCH, MAX_UPLOAD_SIZE
 from gflbans.internal.flags import valid_types_regex
 from gflbans.internal.models.api import (
     AdminInfo,
@@ -146,6 +146,16 @@ class InfractionStatisticsReply(BaseModel):
     warning_longest: Optional[int]
 
 
+def _check_punishment_conflicts(values):
+    if 'playtime_based' in values and values['playtime_based'] and 'ban' in values['punishments']:
+        raise ValueError('Cannot have a ban that is based on playtime')
+
+    if 'ban' in values['punishments'] and 'session' in values and values['session']:
+        raise ValueError('Session bans do not make sense!')
+
+    return values
+
+
 class CreateInfraction(BaseModel):
     created: Optional[PositiveInt]
     duration: Optional[PositiveInt]
@@ -164,19 +174,47 @@ class CreateInfraction(BaseModel):
 
     @root_validator(pre=True)
     def check_conflicts(cls, values):
-        if 'playtime_based' in values and values['playtime_based'] and 'ban' in values['punishments']:
-            raise ValueError('Cannot have a ban that is based on playtime')
-
-        if 'ban' in values['punishments'] and 'session' in values and values['session']:
-            raise ValueError('Session bans do not make sense!')
-
-        return values
+        return _check_punishment_conflicts(values)
 
 
 class CreateInfractionReply(BaseModel):
     infraction: Infraction
 
 
+# Existing infractions from another system, always written in import mode (see CreateInfraction)
+class ImportInfraction(BaseModel):
+    created: PositiveInt
+    duration: Optional[PositiveInt]  # Time left from now on, omit for permanent
+    player: PlayerObjSimple
+    admin: Optional[Initiator]
+    reason: constr(min_length=1, max_length=280)
+    punishments: List[constr(regex=valid_types_regex)]
+    scope: constr(regex=r'^(server|global)$')
+    session: bool = False
+    playtime_based: bool = False
+    import_ref: Optional[constr(min_length=1, max_length=128)]  # Id in the source (e.g. sb:bans:123), imported once
+
+    @root_validator(pre=True)
+    def check_conflicts(cls, values):
+        return _check_punishment_conflicts(values)
+
+
+class ImportInfractions(BaseModel):
+    infractions: conlist(ImportInfraction, min_items=1, max_items=INFRACTION_IMPORT_MAX_BATCH)
+    server: Optional[str]  # Assign all of them to this server
+
+
+class ImportInfractionError(BaseModel):
+    index: conint(ge=0)  # Position in the request
+    detail: str
+
+
+class ImportInfractionsReply(BaseModel):
+    ids: List[Optional[str]]  # Same order as the request, None where the infraction was not imported
+    existing: List[conint(ge=0)] = []  # Positions whose import_ref was already imported, ids has the existing one
+    errors: List[ImportInfractionError]
+
+
 class CreateInfractionFromChatLog(BaseModel):
     chatlog_id: str
     preset: constr(regex=r'^(warn|text|silence)$') = 'text'
@@ -435,6 +473,7 @@ class RequestChatLogs(BaseModel):
     user: Optional[PlayerObjSimple]
     search: Optional[constr(min_length=1, max_length=256)]  # name or steamid
     content: Optional[constr(min_length=1, max_length=256)]  # search by message contents
+    whole_word: bool = False  # match content as whole words through the text index instead of as a substring
     command_mode: Optional[constr(regex=r'^(all|only|exclude)$')] = 'all'  # only displays messages starting with ! or /
 
     # Time range filters (unix seconds). 0 means unset.
@@ -0,0 +1,31 @@
+import asyncio
+from contextlib import suppress
+from typing import Callable
+
+from redis.exceptions import RedisError
+
+from gflbans.internal import shard
+from gflbans.internal.log import logger
+
+
+async def publish(redis_client, channel: str):
+    # Best effort, listeners are expected to have some other way of catching up if this is missed
+    with suppress(RedisError):
+        await redis_client.publish(channel, shard)
+
+
+async def listen_forever(redis_client, channel: str, callback: Callable[[bytes], None]):
+    while True:
+        pubsub = redis_client.pubsub()
+
+        try:
+            await pubsub.subscribe(channel)
+
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    callback(message['data'])
+        except Exception as e:
+            logger.warning(f'Lost connection to the {channel} channel, retrying', exc_info=e)
+            await asyncio.sleep(5)
+        finally:
+            await pubsub.aclose()
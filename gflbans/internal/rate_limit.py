@@ -0,0 +1,41 @@
+from datetime import datetime
+
+from dateutil.tz import UTC
+
+# Refills `capacity` tokens every `per` seconds. Returns how long to wait (0 if a token was taken)
+# Runs as a script so every shard shares one bucket without racing each other
+_TAKE_TOKEN = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+local updated = tonumber(redis.call('HGET', KEYS[1], 'updated'))
+
+if tokens == nil or updated == nil then
+    tokens = capacity
+    updated = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) * 2)
+
+return tostring(wait)
+"""
+
+
+async def take_token(redis_client, bucket: str, capacity: int, per: int) -> float:
+    wait = await redis_client.eval(
+        _TAKE_TOKEN, 1, f'TokenBucket::{bucket}', capacity, capacity / per, datetime.now(tz=UTC).timestamp()
+    )
+
+    return float(wait)
@@ -0,0 +1,50 @@
+from contextlib import suppress
+from functools import lru_cache
+
+import bbcode
+
+from gflbans.internal.config import RENDER_CACHE_SIZE
+
+
+def _comment_parser():
+    bbparser = bbcode.Parser()
+
+    # I only really want urls atm until i can unfuck the formatting
+
+    with suppress(KeyError):
+        ttk = set()
+
+        for tag in bbparser.recognized_tags:
+            if tag != 'url':
+                ttk.add(tag)
+
+        for tag in ttk:
+            del bbparser.recognized_tags[tag]
+
+    return bbparser
+
+
+def _chat_parser():
+    # Display any html tags in message as plain text
+    bbparser = bbcode.Parser()
+    bbparser.recognized_tags = {}
+    bbparser.replace_links = False
+
+    return bbparser
+
+
+# Parsers are configured once and shared, formatting doesn't change them
+comment_parser = _comment_parser()
+chat_parser = _chat_parser()
+
+
+# Rendering only depends on the text, and the same comments and chat lines get rendered over and over
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_comment(comment: str) -> str:
+    return comment_parser.format(comment)
+
+
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def render_chat_message(content: str) -> str:
+    # bbparser.format returns str with tags stripped; ensure no HTML is injected
+    return chat_parser.format(content)
@@ -1,55 +1,140 @@
 import asyncio
-from asyncio import CancelledError
 from datetime import datetime
-from typing import Dict
+from typing import Dict, Set
 
 from dateutil.tz import UTC
 
-from gflbans.internal.config import MONGO_DB
-from gflbans.internal.database.task import DTask
+from gflbans.internal.config import MONGO_DB, TASK_BATCH_SIZE, TASK_IDLE_WAIT
+from gflbans.internal.database.task import TASK_NOTIFY_CHANNEL, DTask
 from gflbans.internal.log import logger
-from gflbans.internal.tasks.infraction import GetUserData, GetVPNData
-from gflbans.internal.tasks.task import TaskBase
+from gflbans.internal.pubsub import listen_forever
+from gflbans.internal.tasks.infraction import GetUserData, GetVPNData, NotifyCreateInfraction, PushState, UserBackfill
+from gflbans.internal.tasks.task import TaskBase, TaskDeferred
+from gflbans.internal.tasks.vpn import VPNBackfill
 
-TASK_HANDLERS: Dict[str, TaskBase] = {'get_vpn_data': GetVPNData, 'get_user_data': GetUserData}
+TASK_HANDLERS: Dict[str, TaskBase] = {
+    'get_vpn_data': GetVPNData,
+    'get_user_data': GetUserData,
+    'vpn_backfill': VPNBackfill,
+    'notify_create_infraction': NotifyCreateInfraction,
+    'push_state': PushState,
+    'user_backfill': UserBackfill,
+}
 
 
-async def exec_loop(app_ref):
-    task = await DTask.pop_next_task(app_ref.state.db[MONGO_DB])
-    if task is None:
-        await asyncio.sleep(1)
-        return
+class TaskScheduler:
+    def __init__(self, app_ref, handlers: Dict[str, TaskBase] = None):
+        self.app = app_ref
+        self.handlers = TASK_HANDLERS if handlers is None else handlers
+        self.running: Dict[str, int] = {name: 0 for name in self.handlers}
+        self.workers: Set[asyncio.Task] = set()
+        self.wakeup = asyncio.Event()
 
-    if task.ev_handler not in TASK_HANDLERS:
-        logger.error(f'Tried to execute task {task.ev_handler}, but there is no handler for that task')
-        return
+    @property
+    def db(self):
+        return self.app.state.db[MONGO_DB]
 
-    task_handler = TASK_HANDLERS[task.ev_handler]
+    def free_handlers(self):
+        return [name for name, handler in self.handlers.items() if self.running[name] < handler.concurrency]
 
-    # Attempt to run the task
-    try:
-        await task_handler.handler(app_ref, task.task_data)
-    except Exception as e:
-        logger.error('Task failed', exc_info=e)
+    async def run(self):
+        listener = asyncio.get_event_loop().create_task(
+            listen_forever(self.app.state.redis_client, TASK_NOTIFY_CHANNEL, lambda _: self.wakeup.set())
+        )
 
-        if task_handler.allow_retry and task.failure_count <= len(task_handler.backoffs) - 1:
-            task.run_at = datetime.now(tz=UTC).timestamp() + task_handler.backoffs[task.failure_count]
-            task.failure_count += 1
+        try:
+            while True:
+                self.wakeup.clear()
 
-            await task.commit(app_ref.state.db[MONGO_DB])
+                try:
+                    claimed = await self.claim()
+                except Exception as e:
+                    logger.error('Internal task manager error', exc_info=e)
+                    claimed = 0
 
-        if isinstance(e, CancelledError):
-            raise
+                if claimed == 0:
+                    await self.wait()
+        finally:
+            # Anything still running keeps its lease, so another worker picks it up once it expires
+            listener.cancel()
+            for worker in self.workers:
+                worker.cancel()
 
-    await asyncio.sleep(0.1)
+    async def claim(self) -> int:
+        claimed = 0
 
+        for name in self.free_handlers():
+            handler = self.handlers[name]
+            limit = min(handler.concurrency - self.running[name], TASK_BATCH_SIZE)
+
+            for task in await DTask.claim_tasks(self.db, name, limit, handler.lease_time):
+                self.start(name, task)
+                claimed += 1
+
+        return claimed
+
+    async def wait(self):
+        timeout = TASK_IDLE_WAIT
+        free = self.free_handlers()
+
+        if free:
+            try:
+                next_run = await DTask.next_run_at(self.db, free)
+            except Exception as e:
+                logger.error('Failed to find the next scheduled task', exc_info=e)
+                next_run = None
+
+            if next_run is not None:
+                timeout = min(timeout, max(next_run - datetime.now(tz=UTC).timestamp(), 0.05))
+
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def start(self, name: str, task: DTask):
+        self.running[name] += 1
+
+        worker = asyncio.get_event_loop().create_task(self.execute(name, task))
+        self.workers.add(worker)
+        worker.add_done_callback(self.workers.discard)
+
+    async def keep_lease(self, task: DTask, lease_time: int):
+        while True:
+            await asyncio.sleep(lease_time / 2)
+
+            if not await task.renew_lease(self.db, lease_time):
+                logger.warning(f'Lost the lease on task {str(task.id)}, it may run more than once')
+                return
+
+    async def execute(self, name: str, task: DTask):
+        task_handler = self.handlers[name]
+        renewer = asyncio.get_event_loop().create_task(self.keep_lease(task, task_handler.lease_time))
 
-async def task_loop(app_ref):
-    while True:
         try:
-            await exec_loop(app_ref)
+            try:
+                await task_handler.handler(self.app, task.task_data)
+            except TaskDeferred as e:
+                logger.debug(f'Task {str(task.id)} deferred for {e.delay:.0f} seconds')
+                await task.reschedule(self.db, datetime.now(tz=UTC).timestamp() + e.delay, count_failure=False)
+                return
+            except Exception as e:
+                logger.error('Task failed', exc_info=e)
+
+                if task_handler.allow_retry and task.failure_count <= len(task_handler.backoffs) - 1:
+                    run_at = datetime.now(tz=UTC).timestamp() + task_handler.backoffs[task.failure_count]
+                    await task.reschedule(self.db, run_at)
+                    return
+
+            await task.complete(self.db)
         except Exception as e:
-            logger.error('Internal task manager error', exc_info=e)
+            logger.error(f'Failed to update task {str(task.id)} after running it', exc_info=e)
+        finally:
+            renewer.cancel()
+            self.running[name] -= 1
+            self.wakeup.set()
 
-            if isinstance(e, CancelledError):
-                raise
+
+async def task_loop(app_ref):
+    app_ref.state.task_scheduler = TaskScheduler(app_ref)
+    await app_ref.state.task_scheduler.run()
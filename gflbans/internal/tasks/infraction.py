@@ -1,4 +1,14 @@
-from gflbans.internal.infraction_utils import get_user_data, get_vpn_data
+from gflbans.internal.config import MONGO_DB
+from gflbans.internal.database.infraction import DInfraction
+from gflbans.internal.infraction_utils import (
+    backfill_user_data,
+    discord_notify_create_infraction,
+    get_user_data,
+    get_vpn_data,
+    push_state_to_nodes,
+)
+from gflbans.internal.log import logger
+from gflbans.internal.models.api import PlayerObjNoIp
 from gflbans.internal.tasks.task import TaskBase
 
 
@@ -7,8 +17,37 @@ async def ev_get_vpn_data(app, data):
 
 
 async def ev_get_user_data(app, data):
-    await get_user_data(app, data['i_id'], False)
+    await get_user_data(app, data['i_id'], False, data.get('print_map', False))
 
 
-GetVPNData = TaskBase(handler=ev_get_vpn_data, backoffs=[30, 60, 180, 360, 720, 3600, 3600 * 24, 3600 * 24 * 7])
-GetUserData = TaskBase(handler=ev_get_user_data, backoffs=[30, 60, 180, 360, 720, 3600, 3600 * 24, 3600 * 24 * 7])
+async def ev_user_backfill(app, data):
+    await backfill_user_data(app, data['gs_service'], data['gs_id'])
+
+
+async def ev_notify_create_infraction(app, data):
+    dinf = await DInfraction.from_id(app.state.db[MONGO_DB], data['i_id'])
+
+    if dinf is None:
+        logger.warning(f'Tried to notify_create_infraction for {str(data["i_id"])}, but no such document exists.')
+        return
+
+    # Waits until the webhooks have the message, the dispatcher's queue is in memory and would lose it on a restart.
+    # If only one of the webhooks failed, the retry posts to both again
+    await discord_notify_create_infraction(app, dinf, data.get('print_map', False), wait_for_delivery=True)
+
+
+async def ev_push_state(app, data):
+    user = PlayerObjNoIp(**data['user']) if data.get('user') else None
+
+    await push_state_to_nodes(app, user, data.get('ip'))
+
+
+GetVPNData = TaskBase(
+    handler=ev_get_vpn_data, backoffs=[30, 60, 180, 360, 720, 3600, 3600 * 24, 3600 * 24 * 7], concurrency=4
+)
+GetUserData = TaskBase(
+    handler=ev_get_user_data, backoffs=[30, 60, 180, 360, 720, 3600, 3600 * 24, 3600 * 24 * 7], concurrency=8
+)
+UserBackfill = TaskBase(handler=ev_user_backfill, backoffs=[60, 360, 3600, 3600 * 24], concurrency=4)
+NotifyCreateInfraction = TaskBase(handler=ev_notify_create_infraction, backoffs=[30, 60, 180, 360], concurrency=4)
+PushState = TaskBase(handler=ev_push_state, backoffs=[5, 30, 60, 180], concurrency=8, lease_time=60)
@@ -1,9 +1,18 @@
 from typing import Callable, List
 
-from pydantic import BaseModel, conint
+from pydantic import BaseModel, PositiveInt, conint
+
+
+class TaskDeferred(Exception):
+    # Raise from a task handler to run the task again later without counting it as a failure
+    def __init__(self, delay: float):
+        super().__init__(f'Task deferred for {delay:.0f} seconds')
+        self.delay = delay
 
 
 class TaskBase(BaseModel):
     handler: Callable
     allow_retry: bool = True
     backoffs: List[conint(ge=0)] = []
+    concurrency: PositiveInt = 1  # Max tasks of this type running at once per worker
+    lease_time: PositiveInt = 300  # Seconds before a claimed task is considered abandoned and can be reclaimed
@@ -0,0 +1,48 @@
+import random
+from contextlib import suppress
+
+from redis.exceptions import RedisError
+
+from gflbans.internal.asn import VPN_DUBIOUS, VPN_YES, check_vpn, iphub_retry_after, local_ip_data
+from gflbans.internal.config import IPHUB_BACKFILL_DAILY_LIMIT, IPHUB_WITH_IP_DATABASE, MONGO_DB
+from gflbans.internal.database.infraction import DInfraction
+from gflbans.internal.log import logger
+from gflbans.internal.rate_limit import take_token
+from gflbans.internal.tasks.task import TaskBase, TaskDeferred
+
+
+async def ev_vpn_backfill(app, data):
+    ip = data['ip']
+
+    iphub_data = None
+    with suppress(RedisError):
+        iphub_data = await app.state.ip_info_cache.get(ip, 'iphubinfo')
+
+    if IPHUB_WITH_IP_DATABASE or local_ip_data(app, ip) is None:
+        # A rate limit pause or a remembered failure would only fail the task and use up its retries, wait it out
+        # without spending a token
+        wait = await iphub_retry_after(app, ip, iphub_data)
+
+        if wait > 0:
+            raise TaskDeferred(wait + random.uniform(0, 60))
+
+        # Cached and local lookups don't cost anything, only spend the IPHub budget on real requests
+        if iphub_data is None:
+            # Backfill turned off after these tasks were scheduled, they wait for it to be turned on again
+            if IPHUB_BACKFILL_DAILY_LIMIT <= 0:
+                raise TaskDeferred(3600 * 24)
+
+            wait = await take_token(app.state.redis_client, 'iphub_backfill', IPHUB_BACKFILL_DAILY_LIMIT, 3600 * 24)
+
+            if wait > 0:
+                # Spread deferred tasks out so they don't all come back for the same token
+                raise TaskDeferred(wait + random.uniform(0, 3600))
+
+    vpn_state = await check_vpn(app, ip)
+
+    if vpn_state == VPN_YES or vpn_state == VPN_DUBIOUS:
+        flagged = await DInfraction.flag_vpn_ip(app.state.db[MONGO_DB], ip)
+        logger.info(f'{ip} is a vpn or suspicious IP address, flagged {flagged} infraction(s).')
+
+
+VPNBackfill = TaskBase(handler=ev_vpn_backfill, backoffs=[60, 360, 3600, 3600 * 24], concurrency=2)
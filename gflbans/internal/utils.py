@@ -1,7 +1,9 @@
+import asyncio
 import os
 import re
 import unicodedata
 from hashlib import sha512
+from typing import Any, Awaitable, Callable, Dict, Hashable
 
 import orjson
 from pydantic import BaseModel, validate_model
@@ -89,3 +91,25 @@ class ORJSONSerializer:
             return orjson.loads(content)
         except Exception as e:
             raise RedisError('Content cannot be decoded') from e
+
+
+def _single_flight_done(inflight: Dict[Hashable, asyncio.Task], key: Hashable, task: asyncio.Task):
+    if inflight.get(key) is task:
+        del inflight[key]
+
+    # Mark the exception as retrieved even if every waiter went away
+    if not task.cancelled():
+        task.exception()
+
+
+# Runs coro_fn once for every concurrent caller asking for the same key, they all get the same result
+async def single_flight(inflight: Dict[Hashable, asyncio.Task], key: Hashable, coro_fn: Callable[[], Awaitable[Any]]):
+    task = inflight.get(key)
+
+    if task is None:
+        task = asyncio.get_event_loop().create_task(coro_fn())
+        task.add_done_callback(lambda t: _single_flight_done(inflight, key, t))
+        inflight[key] = task
+
+    # Don't let one cancelled caller cancel the work for everyone else
+    return await asyncio.shield(task)
@@ -0,0 +1,105 @@
+import asyncio
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from dateutil.tz import UTC
+from motor.motor_asyncio import AsyncIOMotorDatabase
+from netaddr import AddrFormatError, IPAddress, IPNetwork
+
+from gflbans.internal.config import VPN_INDEX_MAX_AGE
+from gflbans.internal.database.vpn import DVPN
+from gflbans.internal.log import logger
+from gflbans.internal.pubsub import publish
+
+# Published whenever the VPN blocklist changes so every shard drops its copy of the index
+VPN_INDEX_CHANNEL = 'gflbans::vpn_index'
+
+_ADDR_BITS = {4: 32, 6: 128}
+
+
+# In memory copy of the VPN blocklist. CIDR rules are bucketed by (ip version, prefix length) and keyed by their
+# network address, so matching an IP is one dict lookup per distinct prefix length instead of a scan over every rule
+class VPNIndex:
+    def __init__(self, max_age: int = VPN_INDEX_MAX_AGE):
+        self.max_age = max_age
+        self.asns: Dict[str, DVPN] = {}
+        self.networks: Dict[Tuple[int, int], Dict[int, DVPN]] = {}
+        self.prefixes: List[Tuple[int, int]] = []
+
+        self.generation = 0
+        self.built_generation = None
+        self.built_at = 0.0
+        self.lock = asyncio.Lock()
+
+    def invalidate(self, *_):
+        self.generation += 1
+
+    def is_fresh(self) -> bool:
+        return (
+            self.built_generation == self.generation and datetime.now(tz=UTC).timestamp() - self.built_at < self.max_age
+        )
+
+    async def ensure(self, db_ref: AsyncIOMotorDatabase):
+        if self.is_fresh():
+            return
+
+        async with self.lock:
+            if not self.is_fresh():
+                await self.rebuild(db_ref)
+
+    async def rebuild(self, db_ref: AsyncIOMotorDatabase):
+        generation = self.generation
+        asns = {}
+        networks = {}
+
+        async for doc in db_ref[DVPN.__collection__].find({}):
+            vpn = DVPN.load_document(doc)
+
+            if vpn.is_asn:
+                asns[vpn.payload] = vpn
+                continue
+
+            try:
+                net = IPNetwork(vpn.payload)
+            except (AddrFormatError, ValueError):
+                logger.warning(f'Skipping VPN rule {vpn.id} with invalid CIDR {vpn.payload}')
+                continue
+
+            networks.setdefault((net.version, net.prefixlen), {}).setdefault(int(net.network), vpn)
+
+        # Most specific rules first
+        self.prefixes = sorted(networks.keys(), key=lambda k: k[1], reverse=True)
+        self.networks = networks
+        self.asns = asns
+        self.built_generation = generation
+        self.built_at = datetime.now(tz=UTC).timestamp()
+
+        logger.debug(f'Built VPN index with {len(asns)} ASN and {sum(len(n) for n in networks.values())} CIDR rules')
+
+    async def find_asn_rule(self, db_ref: AsyncIOMotorDatabase, asn) -> Optional[DVPN]:
+        await self.ensure(db_ref)
+
+        return self.asns.get(str(asn))
+
+    async def find_cidr_rule(self, db_ref: AsyncIOMotorDatabase, ip: IPAddress) -> Optional[DVPN]:
+        await self.ensure(db_ref)
+
+        ip_int = int(ip)
+        bits = _ADDR_BITS[ip.version]
+
+        for version, prefixlen in self.prefixes:
+            if version != ip.version:
+                continue
+
+            mask = ((1 << bits) - 1) ^ ((1 << (bits - prefixlen)) - 1)
+            rule = self.networks[(version, prefixlen)].get(ip_int & mask)
+
+            if rule is not None:
+                return rule
+
+        return None
+
+
+async def invalidate_vpn_index(app):
+    app.state.vpn_index.invalidate()
+    await publish(app.state.redis_client, VPN_INDEX_CHANNEL)
@@ -0,0 +1,25 @@
+from bson import ObjectId
+
+from gflbans.internal.database.base import construct_trusted
+from gflbans.internal.database.infraction import DInfraction
+
+
+def test_trusted_read_of_float_timestamps_matches_validation():
+    # create_dinfraction stores datetime.timestamp() floats
+    doc = {
+        '_id': ObjectId(),
+        'flags': 0,
+        'created': 1700000000.75,
+        'expires': 1700003600.25,
+        'reason': 'test',
+        'user': {'gs_service': 'steam', 'gs_id': '76561197960265729'},
+        'comments': [],
+        'files': [],
+    }
+
+    trusted = construct_trusted(DInfraction, doc)
+    validated = DInfraction(**doc)
+
+    assert type(trusted.created) is int and type(trusted.expires) is int
+    assert trusted.dict() == validated.dict()
+    assert trusted.__fields_set__ == validated.__fields_set__
@@ -0,0 +1,39 @@
+from types import SimpleNamespace
+
+import pytest
+from mongomock_motor import AsyncMongoMockClient
+
+from gflbans import deprecation
+from gflbans.deprecation import chat_command_backfill_done
+from gflbans.internal.config import MONGO_DB
+
+
+@pytest.mark.anyio
+async def test_chat_command_backfill_done_is_shared_through_version_info():
+    app = SimpleNamespace(state=SimpleNamespace(db=AsyncMongoMockClient()))
+
+    assert not await chat_command_backfill_done(app)
+
+    # Another worker finished the backfill, this one notices once its last check is old enough
+    await app.state.db[MONGO_DB]['version_info'].insert_one({'_id': 'gflbans_info', 'chat_command_backfill_done': True})
+    assert not await chat_command_backfill_done(app)
+
+    app.state.chat_command_backfill_checked = 0
+    assert await chat_command_backfill_done(app)
+
+
+@pytest.mark.anyio
+async def test_full_vpn_check_is_off_with_a_daily_limit_of_zero(monkeypatch):
+    monkeypatch.setattr(deprecation, 'IPHUB_API_KEY', 'key')
+    monkeypatch.setattr(deprecation, 'IPHUB_BACKFILL_DAILY_LIMIT', 0)
+
+    app = SimpleNamespace(state=SimpleNamespace(db=AsyncMongoMockClient()))
+    db = app.state.db[MONGO_DB]
+    await db['version_info'].insert_one({'_id': 'gflbans_info'})
+    await db['infractions'].insert_one({'ip': '1.2.3.4', 'flags': 0})
+
+    await deprecation.full_vpn_check(app)
+
+    # Nothing scheduled and not marked done, so setting a limit later still runs it
+    assert await db['tasks'].count_documents({}) == 0
+    assert 'vpn_backfill_done' not in await db['version_info'].find_one({'_id': 'gflbans_info'})
@@ -0,0 +1,47 @@
+from netaddr import IPAddress
+
+from gflbans.internal.ip_database import IPDatabase
+from tools import import_ip_db
+
+
+def build(tmp_path, monkeypatch, name, content, answers):
+    source = tmp_path / name
+    source.write_text(content)
+    output = tmp_path / 'ip_database.bin'
+
+    replies = iter([str(source), *answers, str(output)])
+    monkeypatch.setattr('builtins.input', lambda prompt: next(replies))
+
+    import_ip_db.main()
+
+    return IPDatabase(str(output))
+
+
+def test_maxmind_asn_organization_is_not_a_country(tmp_path, monkeypatch):
+    db = build(
+        tmp_path,
+        monkeypatch,
+        'GeoLite2-ASN-Blocks-IPv4.csv',
+        'network,autonomous_system_number,autonomous_system_organization\n8.8.8.0/24,15169,GOOGLE\n',
+        ['', ''],
+    )
+
+    record = db.lookup(IPAddress('8.8.8.8'))
+
+    assert record.asn == 15169
+    assert record.country is None
+    assert db.countries == []
+
+
+def test_explicit_country_column(tmp_path, monkeypatch):
+    db = build(tmp_path, monkeypatch, 'blocks.csv', '8.8.8.0/24,15169,GOOGLE,US\n', ['3', ''])
+
+    assert db.lookup(IPAddress('8.8.8.8')).country == 'US'
+
+
+def test_range_format_defaults_to_fourth_column(tmp_path, monkeypatch):
+    db = build(tmp_path, monkeypatch, 'ip2asn.tsv', '1.0.0.0\t1.0.0.255\t13335\tUS\tCLOUDFLARENET\n', ['', ''])
+
+    record = db.lookup(IPAddress('1.0.0.1'))
+
+    assert (record.asn, record.country) == (13335, 'US')
@@ -0,0 +1,29 @@
+from types import SimpleNamespace
+
+import pytest
+
+from gflbans.internal.loader import configure_app, gflbans_unload
+
+
+@pytest.mark.anyio
+async def test_unload_drains_webhooks_and_closes_everything():
+    app = SimpleNamespace(state=SimpleNamespace())
+    configure_app(app)
+
+    posted = []
+
+    async def post(url, message):
+        posted.append((url, app.state.aio_session.closed))
+        return 0
+
+    app.state.webhooks.post = post
+    delivered = app.state.webhooks.send('https://discord.invalid/api/webhooks/1/a', {'embeds': [{'title': 'x'}]})
+
+    await gflbans_unload(app)
+
+    # Sent before the session it needs was closed
+    assert posted == [('https://discord.invalid/api/webhooks/1/a', False)]
+    assert delivered.result() is True
+    assert app.state.aio_session.closed
+    assert app.state.avatar_engine.pool._shutdown_thread
+    assert app.state.sync_processes._shutdown_thread
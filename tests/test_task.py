@@ -0,0 +1,48 @@
+from datetime import datetime
+
+import pytest
+from dateutil.tz import UTC
+from mongomock_motor import AsyncMongoMockClient
+from pymongo import ASCENDING
+
+from gflbans.internal.database.task import DTask
+
+
+@pytest.fixture
+async def db():
+    db = AsyncMongoMockClient()['gflbans_test']
+    await db.tasks.create_index(
+        [('dedup_key', ASCENDING)], unique=True, partialFilterExpression={'dedup_key': {'$exists': True}}
+    )
+    return db
+
+
+def now() -> float:
+    return datetime.now(tz=UTC).timestamp()
+
+
+@pytest.mark.anyio
+async def test_rescheduled_task_keeps_its_dedup_key(db):
+    assert await DTask.enqueue(db, 'vpn_backfill', {'ip': '1.2.3.4'}, now(), dedup_key='vpn:1.2.3.4')
+
+    (task,) = await DTask.claim_tasks(db, 'vpn_backfill', 10, 300)
+    await task.reschedule(db, now() + 60, count_failure=False)
+
+    # Queueing the same work again is absorbed by the rescheduled task
+    assert not await DTask.enqueue(db, 'vpn_backfill', {'ip': '1.2.3.4'}, now(), dedup_key='vpn:1.2.3.4')
+    assert await db.tasks.count_documents({}) == 1
+    assert (await db.tasks.find_one({}))['dedup_key'] == 'vpn:1.2.3.4'
+
+
+@pytest.mark.anyio
+async def test_rescheduled_task_yields_to_work_queued_while_it_ran(db):
+    await DTask.enqueue(db, 'vpn_backfill', {'ip': '1.2.3.4'}, now(), dedup_key='vpn:1.2.3.4')
+
+    (task,) = await DTask.claim_tasks(db, 'vpn_backfill', 10, 300)
+    assert await DTask.enqueue(db, 'vpn_backfill', {'ip': '1.2.3.4'}, now(), dedup_key='vpn:1.2.3.4')
+
+    await task.reschedule(db, now() + 60)
+
+    remaining = await db.tasks.find({}).to_list(None)
+    assert len(remaining) == 1
+    assert remaining[0]['_id'] != task.id
@@ -0,0 +1,75 @@
+#! /usr/bin/env python3
+
+# Run from the repository root with `python3 -m tools.bench_load_document [documents] [comments per document]`
+# Compares loading infraction documents with full validation against the trusted read path used by
+# DBase.load_document. No database is needed, the documents are generated in memory
+
+import sys
+from datetime import datetime
+from time import perf_counter
+
+from bson import ObjectId
+
+from gflbans.internal.database.base import construct_trusted
+from gflbans.internal.database.infraction import DInfraction
+
+
+def make_document(i, comments):
+    return {
+        '_id': ObjectId(),
+        'flags': 1 << 7,
+        'server': ObjectId(),
+        'created': 1700000000 + i,
+        'user': {
+            'gs_service': 'steam',
+            'gs_id': str(76561197960265728 + i),
+            'gs_name': f'Player {i}',
+            'gs_avatar': {'gridfs_file': str(ObjectId()), 'file_name': 'avatar.webp'},
+        },
+        'ip': f'10.0.{i // 256 % 256}.{i % 256}',
+        'admin': ObjectId(),
+        'reason': 'Benchmark infraction',
+        'expires': 1800000000 + i,
+        'comments': [
+            {'content': f'Comment {c}', 'author': ObjectId(), 'private': c % 2 == 0, 'created': datetime.now()}
+            for c in range(comments)
+        ],
+        'files': [{'gridfs_file': str(ObjectId()), 'file_name': 'demo.dem', 'uploaded_by': ObjectId()}],
+    }
+
+
+def bench(name, fn, docs, rounds=5):
+    best = None
+
+    for _ in range(rounds):
+        start = perf_counter()
+
+        for doc in docs:
+            fn(doc)
+
+        elapsed = perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    print(f'{name:>10}: {len(docs) / best:>10.0f} documents/s ({best * 1000:.1f}ms for {len(docs)})')
+
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    comments = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    docs = [make_document(i, comments) for i in range(count)]
+
+    # Both paths must agree before their speed means anything
+    for doc in docs[:10]:
+        assert DInfraction(**doc) == construct_trusted(DInfraction, doc)
+
+    validated = bench('validated', lambda doc: DInfraction(**doc), docs)
+    trusted = bench('trusted', lambda doc: construct_trusted(DInfraction, doc), docs)
+
+    print(f'Trusted reads are {validated / trusted:.1f}x faster with {comments} comments per infraction')
+
+
+if __name__ == '__main__':
+    main()
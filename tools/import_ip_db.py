@@ -0,0 +1,146 @@
+#! /usr/bin/env python3
+
+# Run from the repository root with `python3 -m tools.import_ip_db`
+# Builds the file used by IP_DATABASE_PATH from an IP range dump, so VPN and location checks can be answered
+# without calling IPHub. Supported input (CSV or TSV, optionally gzipped):
+#   range_start, range_end, as_number, country[, ...]  e.g. ip2asn-combined.tsv from https://iptoasn.com/
+#   network, as_number[, ...]                         e.g. a MaxMind GeoLite2-ASN-Blocks CSV
+# The third column of the MaxMind format is the AS organization, so those files have no country unless a country
+# column is given explicitly
+
+import csv
+import gzip
+import sys
+from typing import Optional
+
+import orjson
+from netaddr import AddrFormatError, IPAddress, IPNetwork
+
+from gflbans.internal.ip_database import IP_DB_HEADER, IP_DB_MAGIC, IP_DB_V4_RECORD, IP_DB_V6_RECORD
+
+NO_COUNTRY = 0xFFFF
+
+
+def default(v, d):
+    if v == '':
+        return d
+    else:
+        return v
+
+
+def open_text(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+
+    return open(path, 'r', encoding='utf-8', newline='')
+
+
+def load_country_names(path):
+    names = {}
+
+    with open_text(path) as f:
+        for row in csv.reader(f):
+            if len(row) >= 2:
+                names[row[0].strip().upper()] = row[1].strip()
+
+    return names
+
+
+# country_column is the 0-based column holding the country, or None for the default of the format
+def parse_row(row, country_column: Optional[int] = None):
+    if '/' in row[0]:
+        net = IPNetwork(row[0].strip())
+        version, start, end, asn = net.version, int(net.first), int(net.last), int(row[1])
+    else:
+        first = IPAddress(row[0].strip())
+        last = IPAddress(row[1].strip())
+
+        if first.version != last.version:
+            raise ValueError('range start and end are different ip versions')
+
+        version, start, end, asn = first.version, int(first), int(last), int(row[2])
+
+        if country_column is None:
+            country_column = 3
+
+    country = row[country_column].strip() if country_column is not None and len(row) > country_column else None
+
+    return version, start, end, asn, country
+
+
+def main():
+    source = default(input('IP range file [ip2asn-combined.tsv]: '), 'ip2asn-combined.tsv')
+    country_column = default(input('Country column, counting from 0 [3 for ranges, none for networks]: '), None)
+    names_file = default(input('Country code to name CSV (code,name) [none]: '), None)
+    output = default(input('Output file [ip_database.bin]: '), 'ip_database.bin')
+
+    country_column = int(country_column) if country_column is not None else None
+    country_names = load_country_names(names_file) if names_file else {}
+    countries = []
+    country_idx = {}
+    ranges = {4: [], 6: []}
+    skipped = 0
+
+    with open_text(source) as f:
+        sample = f.readline()
+        f.seek(0)
+
+        for row in csv.reader(f, delimiter='\t' if '\t' in sample else ','):
+            if not row:
+                continue
+
+            try:
+                version, start, end, asn, country = parse_row(row, country_column)
+            except (AddrFormatError, ValueError, IndexError):
+                skipped += 1  # header rows and garbage
+                continue
+
+            if asn == 0:
+                continue  # not routed, nothing useful to say about these
+
+            if country is None or country in ('', 'None', 'ZZ'):
+                idx = NO_COUNTRY
+            else:
+                country = country_names.get(country.upper(), country)
+
+                if country not in country_idx:
+                    country_idx[country] = len(countries)
+                    countries.append(country)
+
+                idx = country_idx[country]
+
+            ranges[version].append((start, end, asn, idx))
+
+    if len(countries) >= NO_COUNTRY:
+        print('Too many distinct countries in the input file!')
+        sys.exit(1)
+
+    overlaps = 0
+    for version in ranges:
+        ranges[version].sort()
+
+        for prev, cur in zip(ranges[version], ranges[version][1:]):
+            if cur[0] <= prev[1]:
+                overlaps += 1
+
+    if overlaps:
+        print(f'WARNING: {overlaps} overlapping ranges, the one starting last wins')
+
+    table = orjson.dumps(countries)
+
+    with open(output, 'wb') as f:
+        f.write(IP_DB_HEADER.pack(IP_DB_MAGIC, len(ranges[4]), len(ranges[6]), len(table)))
+        f.write(table)
+
+        for start, end, asn, idx in ranges[4]:
+            f.write(IP_DB_V4_RECORD.pack(start, end, asn, idx))
+
+        for start, end, asn, idx in ranges[6]:
+            f.write(IP_DB_V6_RECORD.pack(start.to_bytes(16, 'big'), end.to_bytes(16, 'big'), asn, idx))
+
+    print(f'Wrote {len(ranges[4])} IPv4 and {len(ranges[6])} IPv6 ranges to {output} ({skipped} rows skipped)')
+    print(f'Set IP_DATABASE_PATH={output} in your .env to use it')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,8 @@
 #! /usr/bin/env python3
 
 import asyncio
-import math
+import json
+import os
 from datetime import datetime
 
 import aiohttp
@@ -26,10 +27,27 @@ mysql_pass = default(input('SourceBans MySQL Pass [password]: '), 'password')
 mysql_port = int(default(input('SourceBans MySQL Port [3306]: '), '3306'))
 mysql_db = default(input('SourceBans MySQL Database [site_sourcebans]: '), 'site_sourcebans')
 
-checkpoint_bans = int(default(input('Bans import checkpoint [0]'), '0'))
-checkpoint_comms = int(default(input('Comms import checkpoint [0]'), '0'))
+# The last imported ban and comm ids are saved here after every batch, so an interrupted import picks up where it
+# stopped when run again
+checkpoint_file = default(input('Checkpoint file [import_sb.checkpoint.json]: '), 'import_sb.checkpoint.json')
+batch_size = int(default(input('Infractions per request [500]: '), '500'))
 
-session = aiohttp.ClientSession()
+
+def load_checkpoint():
+    if not os.path.exists(checkpoint_file):
+        return {'bans': 0, 'comms': 0}
+
+    with open(checkpoint_file) as f:
+        return json.load(f)
+
+
+def save_checkpoint(checkpoint):
+    tmp = checkpoint_file + '.tmp'
+
+    with open(tmp, 'w') as f:
+        json.dump(checkpoint, f)
+
+    os.replace(tmp, checkpoint_file)
 
 
 def id_to_64(steamid):
@@ -54,143 +72,169 @@ def slash_fix(url: str) -> str:
     return url
 
 
-# don't want to overwhelm the server by running 200k+ requests at the same time
-async def batched(coros):
-    processed = 0
-    for i in range(int(math.ceil(len(coros) / 10))):
-        d = []
-        for i2 in range(10):
-            idx = (i * 10) + i2
-            if len(coros) > idx:
-                d.append(coros[idx])
-                processed += 1
+def convert_ban(adminid64, ban):
+    # skip expired and removed bans
+    if (ban[6] > 0 and ban[5] < datetime.now(tz=UTC).timestamp()) or (ban[13] and ban[13] != ''):
+        print(f'skip ban {ban[0]} as it is expired or removed.')
+        return None
+
+    api_req = {
+        'created': ban[4],
+        'player': {},
+        'punishments': ['ban'],
+        'scope': 'global',  # all sourcebans were global
+    }
+
+    if adminid64:
+        api_req['admin'] = {'gs_admin': {'gs_service': 'steam', 'gs_id': str(adminid64)}}
+
+    if ban[2] and ban[2] != '' and id_to_64(ban[2]):
+        api_req['player']['gs_service'] = 'steam'
+        api_req['player']['gs_id'] = str(id_to_64(ban[2]))
+
+    if ban[1] and ban[1] != '':
+        api_req['player']['ip'] = ban[1]
+
+    if 'ip' not in api_req['player'] and 'gs_id' not in api_req['player']:
+        print(f'could not find a valid player id, skipping {ban[0]}')
+        return None
+
+    if ban[7] and ban[7] != '':
+        api_req['reason'] = ban[7][:279]
+    else:
+        api_req['reason'] = 'No Reason Specified'
 
-        await asyncio.gather(*d)
+    if ban[6] > 0:
+        # permanent bans are when duration is omitted, otherwise it's the time remaining
+        api_req['duration'] = max(int(ban[5] - datetime.now(tz=UTC).timestamp()), 1)
 
-    return processed
+    return api_req
+
+
+def convert_comm(adminid64, comm):
+    # skip expired and removed comms
+    if (comm[5] > 0 and comm[4] < datetime.now(tz=UTC).timestamp()) or (comm[11] and comm[11] != ''):
+        print(f'skip comm {comm[0]} as it is expired or removed.')
+        return None
 
+    gs_id = id_to_64(comm[1])
 
-async def process_ban(adminid64, ban):
-    try:
-        # skip expired and removed bans
-        if (ban[6] > 0 and ban[5] < datetime.now(tz=UTC).timestamp()) or (ban[13] and ban[13] != ''):
-            print(f'skip ban {ban[0]} as it is expired or removed.')
-            return
+    if not gs_id:
+        print(f'failed parsing steamid for comm {comm[0]}')
+        return None
 
-        api_req = {
-            'created': ban[4],
-            'player': {},
-            'punishments': ['ban'],
-            'import_mode': True,
-            'scope': 'global',  # all sourcebans were global
-        }
+    api_req = {
+        'created': comm[3],
+        'player': {'gs_service': 'steam', 'gs_id': str(gs_id)},
+        'scope': 'global',  # all sourcebans were global
+    }
 
-        if adminid64:
-            api_req['admin'] = {'gs_admin': {'gs_service': 'steam', 'gs_id': adminid64}}
+    if adminid64:
+        api_req['admin'] = {'gs_admin': {'gs_service': 'steam', 'gs_id': str(adminid64)}}
 
-        if ban[2] and ban[2] != '' and id_to_64(ban[2]):
-            api_req['player']['gs_service'] = 'steam'
-            api_req['player']['gs_id'] = id_to_64(ban[2])
+    if comm[6] and comm[6] != '' and len(comm[6]) <= 120:
+        api_req['reason'] = comm[6][:279]
+    else:
+        api_req['reason'] = 'No Reason Specified'
 
-        if ban[1] and ban[1] != '':
-            api_req['player']['ip'] = ban[1]
+    if comm[5] == 0:
+        pass  # permanent comms are when duration is omitted
+    elif comm[5] < 0:
+        api_req['session'] = True
+    else:
+        api_req['duration'] = max(int(comm[4] - datetime.now(tz=UTC).timestamp()), 1)  # the time remaining
 
-        if 'ip' not in api_req['player'] and ('gs_id' not in api_req['player'] or not api_req['player']['gs_id']):
-            print(f'could not find a valid player id, skipping {ban[0]}')
-            return
+    if comm[13] == 1:
+        api_req['punishments'] = ['voice_block']
+    else:
+        api_req['punishments'] = ['chat_block']
 
-        if ban[7] and ban[7] != '':
-            api_req['reason'] = ban[7][:279]
-        else:
-            api_req['reason'] = 'No Reason Specified'
+    return api_req
 
-        if ban[6] <= 0:
-            pass  # permanent bans are when duration is omitted
-        else:
-            api_req['duration'] = ban[5] - ban[4]  # sets the duration to the time remaining
 
+# Returns how many of the batch were imported. Entries the API can't validate are reported and left out, the rest of
+# the batch is sent again without them. Entries imported by an earlier run are skipped by the API and not counted
+async def send_batch(session, sb_ids, batch):
+    while batch:
         async with session.post(
-            f'{slash_fix(gflbans_instance)}api/infractions/',
-            headers={
-                'Authorization': f'API {gflbans_api_key_id} {gflbans_api_key_secret}',
-                'Content-Type': 'application/json',
-            },
-            json=api_req,
+            f'{slash_fix(gflbans_instance)}api/infractions/import',
+            headers={'Authorization': f'API {gflbans_api_key_id} {gflbans_api_key_secret}'},
+            json={'infractions': batch},
         ) as resp:
+            if resp.status == 422:
+                bad = set()
+
+                for err in (await resp.json())['detail']:
+                    loc = err.get('loc', [])
+
+                    if len(loc) > 2 and loc[1] == 'infractions' and isinstance(loc[2], int):
+                        bad.add(loc[2])
+                        print(f'invalid infraction from {sb_ids[loc[2]]}: {err["msg"]}')
+
+                if not bad:
+                    raise RuntimeError(f'import request rejected: {await resp.text()}')
+
+                sb_ids = [i for n, i in enumerate(sb_ids) if n not in bad]
+                batch = [b for n, b in enumerate(batch) if n not in bad]
+                continue
+
             if resp.status >= 400:
-                print(f'failed to create infraction (HTTP {resp.status}): {await resp.text()}, api request:')
-                print(api_req)
-                return
+                raise RuntimeError(f'import request failed (HTTP {resp.status}): {await resp.text()}')
 
             j = await resp.json()
 
-            print(f'created infraction {j["id"]}')
+            for err in j['errors']:
+                print(f'failed to import {sb_ids[err["index"]]}: {err["detail"]}')
 
-        print(f'processed ban {ban[0]}')
-    except Exception as e:
-        print(f'could not process ban {ban[0]}: {e}')
+            if j.get('existing'):
+                print(f'skipped {len(j["existing"])} infractions that were already imported')
 
+            return len([i for i in j['ids'] if i is not None]) - len(j.get('existing', []))
 
-async def process_comm(adminid64, comm):
-    try:
-        # skip expired and removed bans
-        if (comm[5] > 0 and comm[4] < datetime.now(tz=UTC).timestamp()) or (comm[11] and comm[11] != ''):
-            print(f'skip comm {comm[0]} as it is expired or removed.')
-            return
+    return 0
 
-        api_req = {
-            'created': comm[3],
-            'player': {'gs_service': 'steam', 'gs_id': id_to_64(comm[1])},
-            'import_mode': True,
-            'scope': 'global',  # all sourcebans were global
-        }
 
-        if not api_req['player']['gs_id']:
-            print(f'failed parsing steamid for comm {comm[0]}')
-            return
+# Reads the table one batch at a time in id order, so memory use doesn't grow with the table. The checkpoint is only
+# moved once a batch is stored, an interrupted run repeats at most the batch it was working on. Every infraction is
+# sent with its SourceBans id as import_ref, so the API skips the ones that were already stored
+async def import_table(conn, session, checkpoint, key, table, id_column, admin_column, convert, admins):
+    imported = 0
 
-        if adminid64:
-            api_req['admin'] = {'gs_admin': {'gs_service': 'steam', 'gs_id': adminid64}}
+    while True:
+        async with conn.cursor() as cur:
+            await cur.execute(
+                f'SELECT * FROM {table} WHERE {id_column} > %s ORDER BY {id_column} LIMIT %s;',
+                (checkpoint[key], batch_size),
+            )
+            rows = await cur.fetchall()
 
-        if comm[6] and comm[6] != '' and len(comm[6]) <= 120:
-            api_req['reason'] = comm[6][:279]
-        else:
-            api_req['reason'] = 'No Reason Specified'
+        if not rows:
+            break
 
-        if comm[5] == 0:
-            pass  # permanent bans are when duration is omitted
-        elif comm[5] < 0:
-            api_req['session'] = True
-        else:
-            api_req['duration'] = comm[4] - comm[3]  # Sets the duration to the time remaining
+        sb_ids, batch = [], []
 
-        if comm[13] == 1:
-            api_req['punishments'] = ['voice_block']
-        else:
-            api_req['punishments'] = ['chat_block']
+        for row in rows:
+            api_req = convert(admins.get(row[admin_column]), row)
 
-        async with session.post(
-            f'{slash_fix(gflbans_instance)}api/infractions/',
-            headers={
-                'Authorization': f'API {gflbans_api_key_id} {gflbans_api_key_secret}',
-                'Content-Type': 'application/json',
-            },
-            json=api_req,
-        ) as resp:
-            if resp.status >= 400:
-                print(f'failed to create infraction (HTTP {resp.status}): {await resp.text()}')
-                return
+            if api_req is not None:
+                api_req['import_ref'] = f'sb:{key}:{row[0]}'
+                sb_ids.append(f'{key} {row[0]}')
+                batch.append(api_req)
 
-            j = await resp.json()
+        if batch:
+            imported += await send_batch(session, sb_ids, batch)
+
+        checkpoint[key] = rows[-1][0]
+        save_checkpoint(checkpoint)
 
-            print(f'created infraction {j["id"]}')
+        print(f'{key} checkpoint: {checkpoint[key]}, {imported} imported so far')
 
-        print(f'processed comm {comm[0]}')
-    except Exception as e:
-        print(f'could not process ban {comm[0]}: {e}')
+    return imported
 
 
 async def moin():
+    checkpoint = load_checkpoint()
+
     conn = await aiomysql.connect(
         host=mysql_host,
         port=mysql_port,
@@ -206,68 +250,30 @@ async def moin():
     async with conn.cursor() as admin_cur:
         await admin_cur.execute('SELECT * FROM sb_admins;')
 
-        admins = await admin_cur.fetchall()
-
         adminid_to_steamid64 = {}
 
-        for admin in admins:
-            admin_steamid = admin[2]  # authid
-
-            adminid_to_steamid64[admin[0]] = id_to_64(admin_steamid)
+        for admin in await admin_cur.fetchall():
+            adminid_to_steamid64[admin[0]] = id_to_64(admin[2])  # authid
 
     print(f'fetched {len(adminid_to_steamid64)} admins')
 
-    async with conn.cursor() as bans_cur:
-        print(f'converting bans after {checkpoint_bans}')
-
-        await bans_cur.execute('SELECT *  FROM sb_bans;')
-        bans = await bans_cur.fetchall()
+    async with aiohttp.ClientSession() as session:
+        print(f'converting bans after {checkpoint["bans"]}')
+        n = await import_table(
+            conn, session, checkpoint, 'bans', 'sb_bans', 'bid', 8, convert_ban, adminid_to_steamid64
+        )
+        print(f'imported {n} bans')
 
-        b = []
+        print(f'converting comms after {checkpoint["comms"]}')
+        n = await import_table(
+            conn, session, checkpoint, 'comms', 'sb_comms', 'bid', 7, convert_comm, adminid_to_steamid64
+        )
+        print(f'imported {n} comms')
 
-        print(f'{len(bans)} bans to convert')
-
-        for ban in bans:
-            if ban[0] <= checkpoint_bans:
-                print(f'skipping {ban[0]} to get to the checkpoint')
-
-            if ban[8] in adminid_to_steamid64:
-                adm = adminid_to_steamid64[ban[8]]
-            else:
-                adm = None
-            b.append(process_ban(adm, ban))
-
-        print(f'processed {await batched(b)} bans')
-
-    print('converting comms')
-
-    async with conn.cursor() as comms_cur:
-        await comms_cur.execute('SELECT * FROM sb_comms;')
-        comms = await comms_cur.fetchall()
-
-    c = []
-
-    print(f'{len(comms)} comms to convert')
-
-    for comm in comms:
-        if comm[0] <= checkpoint_comms:
-            print(f'skipping {comm[0]} to get to the checkpoint')
-            continue
-
-        if comm[7] in adminid_to_steamid64:
-            adm = adminid_to_steamid64[comm[7]]
-        else:
-            adm = None
-
-        c.append(process_comm(adm, comm))
-
-    print(f'processed {await batched(c)} comms')
+    conn.close()
 
     print('all done!')
 
-    print(f'ban checkpoint: {ban[0]}')
-    print(f'comms checkpoint: {comm[0]}')
-
 
 if __name__ == '__main__':
     asyncio.get_event_loop().run_until_complete(moin())